@@ -0,0 +1,165 @@
+"""
+Requests/sec of the signaling views, before and after they became async
+single-pass views.
+
+    python bench_views.py signalserver
+    python bench_views.py perfect_negociation
+    python bench_views.py perfect_negociation_needed
+
+"before" are the previous sync views, which the ASGI handler runs through
+its thread pool. "after" are the current views of the project. Both are
+driven through the full handler and middleware stack by AsyncClient, with
+--concurrency requests in flight. --no-middleware drops the middleware, whose
+thread pool hops (every MiddlewareMixin under django 3.2) otherwise dominate.
+
+For signalserver, --store sqlite runs both against SQLiteSessionStore, in a
+temporary database, instead of the MemorySessionStore of settings.py.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+
+# a realistic payload, an offer with a handful of host candidates
+SDP = "v=0\r\no=- 0 0 IN IP4 127.0.0.1\r\ns=-\r\nt=0 0\r\n" + "".join(
+    "a=candidate:%d 1 udp 2130706431 192.168.1.%d 5%04d typ host\r\n" % (i, i, i) for i in range(12)
+) + "m=application 9 DTLS/SCTP 5000\r\na=mid:0\r\na=sctpmap:5000 webrtc-datachannel 256\r\n" * 4
+
+
+def setup_django(project, middleware, store):
+    sys.path.insert(0, str(HERE / project))
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'signalserver.settings'
+    import django
+    from django.conf import settings
+    django.setup()
+    settings.ALLOWED_HOSTS = ['*']
+    if not middleware:
+        settings.MIDDLEWARE = []
+    if store == 'sqlite':
+        settings.SIGNAL_SESSION_STORE = {
+            'BACKEND': 'mainapp.sessionstore.SQLiteSessionStore',
+            'OPTIONS': {'path': Path(tempfile.mkdtemp()) / 'sessions.sqlite3'},
+        }
+    # serve the legacy views of this script next to the project's own urls
+    settings.ROOT_URLCONF = __name__
+
+
+def legacy_views():
+    # the sync views as they were before the async rewrite
+    from django.http import JsonResponse
+    from django.http.response import HttpResponse
+    from django.views.decorators.csrf import csrf_exempt
+    from django_eventstream import send_event
+    from mainapp import views
+
+    @csrf_exempt
+    def offer(request):
+        request_body = json.loads(request.body)
+        room = views.get_room(request_body)
+        received_offer = json.dumps(request_body['offer'])
+        returned_offer = views.get_session_store().exchange(room, request_body['user'], received_offer)
+        peer_offer_sdp = json.loads(returned_offer) if returned_offer is not None else ""
+        return JsonResponse({'offer': peer_offer_sdp})
+
+    @csrf_exempt
+    def answer(request):
+        request_body = json.loads(request.body)
+        send_event(views.room_channel(views.get_room(request_body)), 'message', request_body['answer'])
+        return HttpResponse("ok")
+
+    last_impolite_offer_message = {}
+
+    @csrf_exempt
+    def sdp_with_replay(request):
+        request_body = json.loads(request.body)
+        room = views.get_room(request_body)
+        message_to_send = {"sdp": json.dumps(request_body['sdp']), "user": request_body['user']}
+        # the replay hack serialized the description a second time
+        user = request_body['user']
+        replay = {"sdp": json.dumps(request_body['sdp']), "user": user}
+        if user == "impolite" and request_body['sdp']['type'] == "offer":
+            last_impolite_offer_message[room] = replay
+        send_event(views.room_channel(room), 'message', message_to_send)
+        return HttpResponse("ok")
+
+    @csrf_exempt
+    def sdp(request):
+        request_body = json.loads(request.body)
+        send_event(views.room_channel(views.get_room(request_body)), 'message', request_body)
+        return HttpResponse("ok")
+
+    return {
+        'signalserver': {'offer': offer, 'answer': answer},
+        'perfect_negociation': {'sdp': sdp_with_replay},
+        'perfect_negociation_needed': {'sdp': sdp},
+    }
+
+
+def make_body(endpoint, i):
+    description = {"type": "offer", "sdp": SDP}
+    room = "bench-%d" % (i % 100)
+    if endpoint == 'offer':
+        return {"room": room, "user": "user%d" % (i % 2 + 1), "offer": description}
+    if endpoint == 'answer':
+        return {"room": room, "answer": dict(description, type="answer")}
+    return {"room": room, "user": "impolite" if i % 2 else "polite", "sdp": description}
+
+
+async def run(client, path, endpoint, requests, concurrency):
+    bodies = [json.dumps(make_body(endpoint, i)) for i in range(requests)]
+    queue = iter(bodies)
+
+    async def worker():
+        for body in queue:
+            response = await client.post(path, body, content_type='application/json')
+            assert response.status_code == 200, response.status_code
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return requests / (time.perf_counter() - start)
+
+
+async def bench(endpoints, requests, concurrency):
+    from django.test import AsyncClient
+    client = AsyncClient()
+    results = {}
+    for endpoint in endpoints:
+        # warm up both paths before measuring
+        await run(client, '/legacy/' + endpoint, endpoint, 200, concurrency)
+        await run(client, '/' + endpoint, endpoint, 200, concurrency)
+        before = await run(client, '/legacy/' + endpoint, endpoint, requests, concurrency)
+        after = await run(client, '/' + endpoint, endpoint, requests, concurrency)
+        results[endpoint] = {'before_rps': round(before), 'after_rps': round(after),
+                             'speedup': round(after / before, 2)}
+    return results
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Signaling views microbenchmark")
+    ap.add_argument("project", choices=["signalserver", "perfect_negociation", "perfect_negociation_needed"])
+    ap.add_argument("--requests", type=int, default=5000)
+    ap.add_argument("--concurrency", type=int, default=32)
+    ap.add_argument("--no-middleware", dest="middleware", action="store_false",
+                    help="Measure the views alone, without the project's middleware")
+    ap.add_argument("--store", choices=["memory", "sqlite"], default="memory",
+                    help="Session store of signalserver (default: memory, as in settings.py)")
+    return ap.parse_args()
+
+
+urlpatterns = []
+
+if __name__ == "__main__":
+    args = parse_args()
+    setup_django(args.project, args.middleware, args.store)
+    from django.urls import include, path
+    legacy = legacy_views()[args.project]
+    urlpatterns += [path('legacy/' + name, view) for name, view in legacy.items()]
+    urlpatterns += [path('', include('mainapp.urls'))]
+
+    print(json.dumps(asyncio.run(bench(legacy, args.requests, args.concurrency)), indent=2))
@@ -0,0 +1,252 @@
+"""
+Recent signaling events of each room, kept so that no SSE client misses one.
+
+Plugged into django_eventstream as its storage, which gives every event of a
+channel an increasing id and makes the event stream resume on Last-Event-ID:
+
+EVENTSTREAM_STORAGE_CLASS = 'mainapp.history.RoomHistoryStorage'
+SIGNAL_ROOM_HISTORY = {'MAX_EVENTS': 100, 'MAX_AGE': 300}
+
+- A client reconnecting with Last-Event-ID gets every event it missed, as
+  long as they are still in the history. If some were already evicted it is
+  told to reset (stream-reset) instead of silently skipping them.
+- The ids of a channel start from the time its history was created, in
+  microseconds. An id of an earlier history of the channel, from a previous
+  process or from before the idle room was swept, is below every id of the
+  current one, and gets a reset too.
+- A client joining with the id 0 gets the events that are still relevant:
+  the ones not marked stale by supersede(), see views.sdp.
+
+Each room keeps at most MAX_EVENTS events, none older than MAX_AGE seconds.
+The history lives in the memory of the process, like the listeners of
+django_eventstream it serves. With 'PERSIST': <path of a SQLite database>
+it is written behind to that database too and loaded back on start: the
+clients reconnecting to a restarted server resume from their Last-Event-ID
+and the offers nobody answered yet are still replayed, nobody has to
+negotiate again.
+"""
+from collections import deque
+from functools import lru_cache
+from itertools import islice
+import json
+import threading
+import time
+
+from django.conf import settings
+from django_eventstream.event import Event
+from django_eventstream.storage import EventDoesNotExist, StorageBase
+
+from .persist import BatchWriter, connect
+
+DEFAULT_MAX_EVENTS = 100
+DEFAULT_MAX_AGE = 300
+
+ROOM_EVENT_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS room_event ('
+    ' channel TEXT NOT NULL,'
+    ' id INTEGER NOT NULL,'
+    ' created REAL NOT NULL,'
+    ' type TEXT NOT NULL,'
+    ' data TEXT NOT NULL,'
+    ' stale INTEGER NOT NULL DEFAULT 0,'
+    ' PRIMARY KEY (channel, id))',
+    'CREATE INDEX IF NOT EXISTS room_event_created ON room_event (created)',
+)
+
+
+class HistoryEvent:
+    __slots__ = ('id', 'created', 'type', 'data', 'stale')
+
+    def __init__(self, id, created, type, data):
+        self.id = id
+        self.created = created
+        self.type = type
+        self.data = data
+        self.stale = False
+
+
+def new_base_id():
+    # above the ids of any earlier history of the channel, unless it got more than an event per microsecond
+    return time.time_ns() // 1000
+
+
+class ChannelHistory:
+    __slots__ = ('events', 'current_id', 'evicted_id')
+
+    def __init__(self, base_id=0):
+        self.events = deque()
+        # id of the last event appended, and of the last one evicted by the bounds.
+        # no id at or below base_id is of this history
+        self.current_id = base_id
+        self.evicted_id = base_id
+
+
+class RoomHistory:
+    def __init__(self, max_events=DEFAULT_MAX_EVENTS, max_age=DEFAULT_MAX_AGE):
+        self.max_events = max_events
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.swept = time.monotonic()
+
+    def append(self, channel, event_type, data):
+        now = time.monotonic()
+        with self.lock:
+            history = self.channels.get(channel)
+            if history is None:
+                history = self.channels[channel] = ChannelHistory(new_base_id())
+            history.current_id += 1
+            history.events.append(HistoryEvent(history.current_id, now, event_type, data))
+            if len(history.events) > self.max_events:
+                history.evicted_id = history.events.popleft().id
+            self._expire(history, now - self.max_age)
+            self._sweep(now)
+            return history.current_id
+
+    def since(self, channel, last_id, limit):
+        """The events after `last_id`, or the relevant ones when `last_id` is 0."""
+        with self.lock:
+            history = self.channels.get(channel)
+            if history is not None:
+                self._expire(history, time.monotonic() - self.max_age)
+            current_id = history.current_id if history else 0
+            if last_id == 0:
+                events = [event for event in history.events if not event.stale] if history else []
+                return events[:limit]
+            if history is None or last_id > current_id or last_id < history.evicted_id:
+                # ids of an earlier history of the channel, or events that were evicted
+                raise EventDoesNotExist('No such event %d' % last_id, current_id)
+            # ids are contiguous, the event after last_id sits at a known offset
+            start = last_id + 1 - history.events[0].id if history.events else 0
+            return list(islice(history.events, start, start + limit))
+
+    def current_id(self, channel):
+        with self.lock:
+            history = self.channels.get(channel)
+            return history.current_id if history else 0
+
+    def supersede(self, channel, predicate):
+        """
+        Mark the events whose data matches `predicate` as no longer relevant to
+        a newcomer. Returns the ids of the events marked.
+        """
+        marked = []
+        with self.lock:
+            history = self.channels.get(channel)
+            if history is not None:
+                for event in history.events:
+                    if not event.stale and predicate(event.data):
+                        event.stale = True
+                        marked.append(event.id)
+        return marked
+
+    def counts(self):
+        """
+        (pending, stale) events over every room, pending being the ones a newcomer
+        is replayed. Events past MAX_AGE count until the next append sweeps them.
+        """
+        with self.lock:
+            stale = sum(event.stale for history in self.channels.values() for event in history.events)
+            return sum(len(history.events) for history in self.channels.values()) - stale, stale
+
+    def _expire(self, history, cutoff):
+        while history.events and history.events[0].created < cutoff:
+            history.evicted_id = history.events.popleft().id
+
+    def _sweep(self, now):
+        # the rooms nobody posts to any more, at most once per second
+        if now - self.swept < 1:
+            return
+        self.swept = now
+        cutoff = now - self.max_age
+        for channel, history in list(self.channels.items()):
+            self._expire(history, cutoff)
+            if not history.events:
+                # nothing left to resume from, a client coming back with an old id gets a reset
+                del self.channels[channel]
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(history.events) for history in self.channels.values())
+
+
+class PersistentRoomHistory(RoomHistory):
+    """
+    RoomHistory written behind to a SQLite database, see persist.py: appending
+    an event never waits for the disk. The events still within the bounds are
+    loaded back on start, with their ids, so Last-Event-ID keeps its meaning.
+    """
+
+    def __init__(self, path, max_events=DEFAULT_MAX_EVENTS, max_age=DEFAULT_MAX_AGE):
+        super().__init__(max_events, max_age)
+        self.writer = BatchWriter(path, ROOM_EVENT_SCHEMA, self.purge)
+        self._load(path)
+
+    def _load(self, path):
+        connection = connect(path)
+        try:
+            rows = connection.execute(
+                'SELECT channel, id, created, type, data, stale FROM room_event'
+                ' WHERE created > ? ORDER BY channel, id',
+                (time.time() - self.max_age,)).fetchall()
+        finally:
+            connection.close()
+        # the database has wall clock times, the memory monotonic ones
+        offset = time.monotonic() - time.time()
+        with self.lock:
+            for channel, id, created, event_type, data, stale in rows:
+                history = self.channels.get(channel)
+                if history is None:
+                    history = self.channels[channel] = ChannelHistory()
+                if history.events and id != history.current_id + 1:
+                    # since() relies on contiguous ids, keep what follows the gap
+                    history.events.clear()
+                if not history.events:
+                    history.evicted_id = id - 1
+                event = HistoryEvent(id, created + offset, event_type, json.loads(data))
+                event.stale = bool(stale)
+                history.events.append(event)
+                history.current_id = id
+                if len(history.events) > self.max_events:
+                    history.evicted_id = history.events.popleft().id
+
+    def append(self, channel, event_type, data):
+        event_id = super().append(channel, event_type, data)
+        self.writer.execute(
+            'INSERT OR REPLACE INTO room_event (channel, id, created, type, data) VALUES (?, ?, ?, ?, ?)',
+            (channel, event_id, time.time(), event_type, json.dumps(data)))
+        return event_id
+
+    def supersede(self, channel, predicate):
+        marked = super().supersede(channel, predicate)
+        for event_id in marked:
+            self.writer.execute('UPDATE room_event SET stale = 1 WHERE channel = ? AND id = ?', (channel, event_id))
+        return marked
+
+    def purge(self, connection):
+        # the events evicted by MAX_EVENTS go once they are MAX_AGE old too, _load skips them meanwhile
+        connection.execute('DELETE FROM room_event WHERE created <= ?', (time.time() - self.max_age,))
+
+
+@lru_cache(maxsize=None)
+def get_room_history():
+    config = getattr(settings, 'SIGNAL_ROOM_HISTORY', {})
+    bounds = (config.get('MAX_EVENTS', DEFAULT_MAX_EVENTS), config.get('MAX_AGE', DEFAULT_MAX_AGE))
+    if config.get('PERSIST'):
+        return PersistentRoomHistory(config['PERSIST'], *bounds)
+    return RoomHistory(*bounds)
+
+
+class RoomHistoryStorage(StorageBase):
+    # django_eventstream creates one instance per thread, the history itself is shared
+
+    def append_event(self, channel, event_type, data):
+        event_id = get_room_history().append(channel, event_type, data)
+        return Event(channel, event_type, data, id=event_id)
+
+    def get_events(self, channel, last_id, limit=100):
+        return [Event(channel, event.type, event.data, id=event.id)
+                for event in get_room_history().since(channel, last_id, limit)]
+
+    def get_current_id(self, channel):
+        return get_room_history().current_id(channel)
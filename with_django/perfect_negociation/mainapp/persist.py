@@ -0,0 +1,146 @@
+"""
+Write-behind persistence to SQLite, for state served from memory that should
+survive a restart of the server.
+
+The requests keep being served from the in-memory structure, every change of
+it is also queued to a BatchWriter. The writer thread commits whatever is
+queued in one transaction (group commit): a write costs the request a queue
+put, the database sees one commit per batch instead of one per request.
+
+The database is in WAL mode with synchronous=NORMAL, a batch committed
+survives a crash of the process. A power loss can lose the last batches.
+"""
+import atexit
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PURGE_INTERVAL = 60
+DEFAULT_MAX_BATCH = 1000
+
+# queued by close(), the writer stops once it committed what came before
+STOP = object()
+
+
+def connect(path):
+    connection = sqlite3.connect(str(path), timeout=5)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+
+class BatchWriter:
+    """
+    Runs the statements given to execute() in a thread of its own, in the order
+    they were given, in batches of at most `max_batch` statements per transaction.
+    `purge(connection)` is run in the same thread every `purge_interval` seconds.
+    """
+
+    def __init__(self, path, schema=(), purge=None, purge_interval=DEFAULT_PURGE_INTERVAL,
+                 max_batch=DEFAULT_MAX_BATCH):
+        self.path = str(path)
+        self.purge = purge
+        self.purge_interval = purge_interval
+        self.max_batch = max_batch
+        self.queue = queue.SimpleQueue()
+        self.batches = 0
+        self.statements = 0
+        connection = connect(self.path)
+        try:
+            with connection:
+                for statement in schema:
+                    connection.execute(statement)
+        finally:
+            connection.close()
+        self.thread = threading.Thread(target=self._run, name='sqlite-batch-writer', daemon=True)
+        self.thread.start()
+        # the writes still queued when the server stops
+        atexit.register(self.close)
+
+    def execute(self, sql, parameters=()):
+        self.queue.put((sql, parameters))
+
+    def flush(self, timeout=None):
+        """
+        Wait for the statements given so far to be committed. False on timeout,
+        or when some of the statements committed along with them were lost.
+        """
+        committed = threading.Event()
+        committed.lost = 0
+        self.queue.put(committed)
+        return committed.wait(timeout) and not committed.lost
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(STOP)
+            self.thread.join()
+
+    def _run(self):
+        connection = connect(self.path)
+        next_purge = time.monotonic() + self.purge_interval
+        running = True
+        while running:
+            try:
+                batch = [self.queue.get(timeout=max(0, next_purge - time.monotonic()))]
+            except queue.Empty:
+                batch = []
+            # what was queued while the previous batch was being committed goes in this one
+            while batch and len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            statements = []
+            flushed = []
+            for item in batch:
+                if item is STOP:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    flushed.append(item)
+                else:
+                    statements.append(item)
+            lost = self._commit(connection, statements) if statements else 0
+            if self.purge is not None and time.monotonic() >= next_purge:
+                try:
+                    with connection:
+                        self.purge(connection)
+                except Exception:
+                    logger.exception('purge of %s failed', self.path)
+                finally:
+                    next_purge = time.monotonic() + self.purge_interval
+            # only once the statements before them are committed, or known lost
+            for committed in flushed:
+                committed.lost = lost
+                committed.set()
+        connection.close()
+
+    def _commit(self, connection, statements):
+        """Commit `statements`, returns how many of them were lost."""
+        try:
+            with connection:
+                for statement in statements:
+                    connection.execute(*statement)
+        except Exception:
+            pass
+        else:
+            self.batches += 1
+            self.statements += len(statements)
+            return 0
+        # the whole batch was rolled back: one at a time, so that a bad statement only loses itself
+        lost = 0
+        for statement in statements:
+            try:
+                with connection:
+                    connection.execute(*statement)
+            except Exception:
+                # the memory is still right, only a restart would miss this write
+                logger.exception('write to %s lost: %s', self.path, statement[0])
+                lost += 1
+            else:
+                self.batches += 1
+                self.statements += 1
+        return lost
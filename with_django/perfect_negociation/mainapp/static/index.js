@@ -1,7 +1,11 @@
 import * as common from './common.js';
 console.log("\n".repeat(10))
 
-export async function start(username) {
+// signaling room, every message is posted to and received from this room only
+let room = "default"
+
+export async function start(username, roomName) {
+    room = roomName || room
     const [peerConnection, dataChannel] = initializeBeforeCreatingOffer(username)
     const makingOffer = withPerfectNegociationHandler(async sessionDescriptionProtocol => {
         if (sessionDescriptionProtocol.type === "offer") {
@@ -31,7 +35,7 @@ async function sendOfferSDP(peerConnection, makingOffer, username) {
         await common.waitForAllICE(peerConnection)
         const localOfferWithICECandidates = peerConnection.localDescription
         await fetch('http://127.0.0.1:10000/sdp', { method: 'POST',
-            body: JSON.stringify({ "user": username, "sdp": localOfferWithICECandidates})
+            body: JSON.stringify({ "room": room, "user": username, "sdp": localOfferWithICECandidates })
         })
     } catch (err) {
         console.log(err)
@@ -60,7 +64,7 @@ async function sendAnswerSDP(peerConnection, username) {
     await common.waitForAllICE(peerConnection)
     const localAnswerWithICECandidates = peerConnection.localDescription
     await fetch('http://127.0.0.1:10000/sdp', { method: 'POST',
-        body: JSON.stringify({"user": username, "sdp": localAnswerWithICECandidates})
+        body: JSON.stringify({ "room": room, "user": username, "sdp": localAnswerWithICECandidates })
     })
 }
 
@@ -103,7 +107,9 @@ function waitForDataChannelOpen(dataChannel) {
 
 function withPerfectNegociationHandler(user_function, peerConnection, username) {
     var makingOffer = {obj: false}
-    var es = new ReconnectingEventSource('/events?channel=testchannel');
+    // starting from id 0 replays the negotiation still in progress in the room, e.g. the
+    // offer the other peer sent before this tab was opened. reconnects resume from the last id seen
+    var es = new ReconnectingEventSource('/events/' + room + '/', {lastEventId: 'room-' + room + ':0'});
     es.addEventListener('message', async function ({data}) {
         try {
             if (shouldSkipMessage(data, peerConnection, username, makingOffer)) {
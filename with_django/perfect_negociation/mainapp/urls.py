@@ -7,8 +7,10 @@ import django_eventstream
 
 urlpatterns = [
     path('sdp', views.sdp, name='sdp'),
-    path('events/', include(django_eventstream.urls), {
-        'channels': ['testchannel']
+    path('metrics', views.metrics_view, name='metrics'),
+    path('events/<slug:room>/', include(django_eventstream.urls), {
+        'format-channels': ['room-{room}']
     }),
     path('home/<user>', views.home, name='home'),
+    path('home/<slug:room>/<user>', views.home, name='home_room'),
 ]
\ No newline at end of file
@@ -1,34 +1,73 @@
 from django.shortcuts import render
-from django.views.decorators.csrf import csrf_exempt
 from django_eventstream import send_event
-from django.http.response import HttpResponse
+from django.http.response import HttpResponse, HttpResponseBadRequest
 import json
+import re
 
-@csrf_exempt
-def sdp(request):
+from . import metrics
+from .history import get_room_history
+
+try:
+    from orjson import loads as json_loads, dumps as json_dumps
+except ImportError:
+    # orjson is optional, the stdlib codec gives the same result, only slower
+    from json import loads as json_loads
+
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+DEFAULT_ROOM = "default"
+ROOM_PATTERN = re.compile(r'^[-a-zA-Z0-9_]{1,64}$')
+
+
+def room_channel(room):
+    # must match the 'format-channels' of the events/<room>/ routes in urls.py and asgi.py
+    return 'room-%s' % room
+
+
+def get_room(request_body):
+    room = request_body.get('room', DEFAULT_ROOM)
+    if not isinstance(room, str) or not ROOM_PATTERN.match(room):
+        return None
+    return room
+
+
+def async_csrf_exempt(view):
+    # django 3.2's csrf_exempt wraps the view in a sync function, which would
+    # hide the coroutine from the handler and push the view into the thread pool
+    view.csrf_exempt = True
+    return view
+
+
+@async_csrf_exempt
+async def sdp(request):
     if request.method == "POST":
-        request_body = json.loads(request.body)
-        received_offer = json.dumps(request_body['sdp'])
+        request_body = json_loads(request.body)
+        room = get_room(request_body)
+        if room is None:
+            return HttpResponseBadRequest("invalid room")
+        # the browser expects the description as a JSON string inside the message
+        received_offer = json_dumps(request_body['sdp']).decode()
         user = request_body['user']
         message_to_send = {"sdp": received_offer, "user": user}
 
-        try_to_solve_impolite_to_polite_on_new_tabs(request_body)
-
-        send_event('testchannel', 'message', message_to_send)
+        # the room history keeps the message for the clients reconnecting or
+        # joining later. a joining tab only needs the offers nobody answered yet
+        channel = room_channel(room)
+        history = get_room_history()
+        sdp_type = request_body['sdp']['type']
+        if sdp_type == "offer":
+            # replaces the earlier messages of its sender
+            history.supersede(channel, lambda data: data['user'] == user)
+        with metrics.fanout():
+            send_event(channel, 'message', message_to_send)
+        if sdp_type == "answer":
+            # settles the negotiation, neither the answer nor anything before it is of use to a newcomer
+            history.supersede(channel, lambda data: True)
         return HttpResponse("ok")
 
-last_impolite_offer_message = {"obj": None}
-def try_to_solve_impolite_to_polite_on_new_tabs(request_body):
-    user = request_body['user']
-    received_offer = json.dumps(request_body['sdp'])
-    message_to_send = {"sdp": received_offer, "user": user}
-    is_offer = request_body['sdp']['type'] == "offer"
-    if user == "impolite" and is_offer:
-        last_impolite_offer_message['obj'] = message_to_send
-    if user == "polite" and is_offer and last_impolite_offer_message['obj'] is not None:
-        # the polite peer connected, 
-        send_event('testchannel', 'message', last_impolite_offer_message['obj'])
-        last_impolite_offer_message['obj'] = None
-
-def home(request, user):
-    return render(request, 'mainapp/index.html', {"user": user})
\ No newline at end of file
+async def metrics_view(request):
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def home(request, user, room=DEFAULT_ROOM):
+    return render(request, 'mainapp/index.html', {"user": user, "room": room})
\ No newline at end of file
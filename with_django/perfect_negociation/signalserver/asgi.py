@@ -18,9 +18,9 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "server.settings")
 
 application = ProtocolTypeRouter({
     'http': URLRouter([
-        re_path(r'^events/', AuthMiddlewareStack(
+        re_path(r'^events/(?P<room>[-a-zA-Z0-9_]+)/', AuthMiddlewareStack(
             URLRouter(django_eventstream.routing.urlpatterns)
-        ), { 'channels': ['testchannel'] }),
+        ), { 'format-channels': ['room-{room}'] }),
         re_path(r'', get_asgi_application()),
     ]),
 })
@@ -44,6 +44,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so that the request latency covers the other middlewares too
+    'mainapp.metrics.metrics_middleware',
     'django_grip.GripMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -85,6 +87,16 @@ TEMPLATES = [
 WSGI_APPLICATION = 'signalserver.wsgi.application'
 ASGI_APPLICATION = 'signalserver.asgi.application'
 
+# Recent events of each room, replayed to the SSE clients that reconnect
+# (Last-Event-ID) or join late, see mainapp/history.py. PERSIST, the path of
+# a SQLite database, keeps the history over restarts of the server
+EVENTSTREAM_STORAGE_CLASS = 'mainapp.history.RoomHistoryStorage'
+SIGNAL_ROOM_HISTORY = {
+    'MAX_EVENTS': 100,
+    'MAX_AGE': 300,
+    'PERSIST': None,
+}
+
 
 
 # Database
@@ -0,0 +1,156 @@
+"""
+Ping RTT while bulk data is streamed on the same peer connection.
+
+Two aiortc peer connections in one process, connected directly. The caller
+sends --pings pings, one every --interval seconds, first on an idle
+connection and then while it streams bulk chunks as fast as the flow control
+lets it. The callee answers each ping with a pong on the channel it came in.
+
+    python bench_channels.py --layout single
+    python bench_channels.py --layout pool
+
+--layout
+- single:   one reliable ordered channel, pings queue behind the bulk bytes
+            (what main_gpt2.py did before the channel pool)
+- separate: an unordered control channel next to the bulk one, the bulk
+            sender flow-controlled on HIGH_WATER as send_file does alone
+- pool:     the same two channels, the bulk sender waiting for
+            ChannelPool.writable() so that the control channel goes first
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from aiortc import RTCPeerConnection
+
+from channelpool import ChannelPool, ChannelSpec, wait_any_buffered_low
+from filetransfer import CHUNK_SIZE, HIGH_WATER, LOW_WATER
+from latency import summarize
+
+BULK = ChannelSpec("images", 0)
+CONTROL = ChannelSpec("control", 1, ordered=False, priority=1)
+LAYOUTS = {
+    "single": (BULK,),
+    "separate": (BULK, CONTROL),
+    "pool": (BULK, CONTROL),
+}
+
+
+async def wait_open(channel):
+    if channel.readyState != "open":
+        opened = asyncio.get_running_loop().create_future()
+        channel.once("open", lambda: opened.done() or opened.set_result(None))
+        await asyncio.wait_for(opened, 10)
+
+
+async def connect(specs):
+    caller, callee = RTCPeerConnection(), RTCPeerConnection()
+    sending, receiving = ChannelPool(caller, specs), ChannelPool(callee, specs)
+    await caller.setLocalDescription(await caller.createOffer())
+    await callee.setRemoteDescription(caller.localDescription)
+    await callee.setLocalDescription(await callee.createAnswer())
+    await caller.setRemoteDescription(callee.localDescription)
+    for channel in sending:
+        await wait_open(channel)
+    return caller, callee, sending, receiving
+
+
+def serve(receiving, counters):
+    # the callee: pongs on the channel of the ping, bulk bytes only counted
+    def attach(channel):
+        @channel.on("message")
+        def _on_message(msg):
+            if isinstance(msg, bytes):
+                counters["bulk_bytes"] += len(msg)
+                return
+            obj = json.loads(msg)
+            channel.send(json.dumps({"type": "pong", "seq": obj["seq"], "t": obj["t"]}))
+
+    for channel in receiving:
+        attach(channel)
+
+
+async def ping_loop(channel, pings, interval):
+    rtts = []
+    pending = {}
+
+    @channel.on("message")
+    def _on_message(msg):
+        if isinstance(msg, str):
+            obj = json.loads(msg)
+            future = pending.pop(obj["seq"], None)
+            if future is not None:
+                future.set_result((time.monotonic() - obj["t"]) * 1000)
+
+    for seq in range(pings):
+        pending[seq] = asyncio.get_running_loop().create_future()
+        channel.send(json.dumps({"type": "ping", "seq": seq, "t": time.monotonic()}))
+        rtts.append(await asyncio.wait_for(pending[seq], 30))
+        await asyncio.sleep(interval)
+    channel.remove_listener("message", _on_message)
+    return rtts
+
+
+async def bulk_loop(layout, pool, stop, counters):
+    channel = pool[BULK.label]
+    channel.bufferedAmountLowThreshold = LOW_WATER if layout != "pool" else 0
+    chunk = bytes(CHUNK_SIZE)
+    while not stop.is_set():
+        if layout == "pool":
+            await pool.writable(BULK.label)
+        elif channel.bufferedAmount > HIGH_WATER:
+            await wait_any_buffered_low([channel])
+        else:
+            # let the pings through the loop between two sends, like reading the next chunk would
+            await asyncio.sleep(0)
+        channel.send(chunk)
+        counters["bulk_sent"] += len(chunk)
+
+
+async def main(layout, pings, interval):
+    specs = LAYOUTS[layout]
+    caller, callee, sending, receiving = await connect(specs)
+    counters = {"bulk_bytes": 0, "bulk_sent": 0}
+    serve(receiving, counters)
+    ping_channel = sending[specs[-1].label]
+
+    idle = await ping_loop(ping_channel, pings, interval)
+
+    stop = asyncio.Event()
+    bulk = asyncio.ensure_future(bulk_loop(layout, sending, stop, counters))
+    started = time.monotonic()
+    loaded = await ping_loop(ping_channel, pings, interval)
+    elapsed = time.monotonic() - started
+    received = counters["bulk_bytes"]
+    stop.set()
+    await bulk
+
+    await caller.close()
+    await callee.close()
+    return {
+        "layout": layout,
+        "channels": [spec.label for spec in specs],
+        "idle_rtt_ms": summarize(idle),
+        "loaded_rtt_ms": summarize(loaded),
+        "bulk_mb_per_s": round(received / elapsed / 1e6, 2),
+    }
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Ping RTT under a concurrent bulk transfer")
+    ap.add_argument("--layout", choices=sorted(LAYOUTS), default="pool",
+                    help="Channels the pings and the bulk bytes go over (default: pool)")
+    ap.add_argument("--pings", type=int, default=50, help="Pings per phase, idle then loaded (default: 50)")
+    ap.add_argument("--interval", type=float, default=0.05,
+                    help="Seconds between a pong and the next ping (default: 0.05)")
+    ap.add_argument("--json", action="store_true", help="Print the histograms too")
+    return ap.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(main(args.layout, args.pings, args.interval))
+    if not args.json:
+        for key in ("idle_rtt_ms", "loaded_rtt_ms"):
+            report[key].pop("histogram", None)
+    print(json.dumps(report, indent=2))
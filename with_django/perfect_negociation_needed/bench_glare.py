@@ -0,0 +1,121 @@
+"""
+Glare resolution round trip, SSE+POST against WebSocket signaling.
+
+Two peers share a room, through the transports of signaling.py that main.py
+uses. Every round both send an offer at the same time (glare): the polite
+peer rolls back and answers the offer of the impolite one, which ignores the
+offer it got. A round lasts from the offers being sent until the answer
+reaches the impolite peer, i.e. an offer one way and an answer back.
+
+    python bench_glare.py --rounds 200
+    python bench_glare.py --transports ws --url http://127.0.0.1:8000
+
+The connections are opened, and a first round answered, before measuring,
+so only the per-message cost of each transport is compared.
+"""
+import argparse
+import asyncio
+import json
+import time
+from pathlib import Path
+
+from bench_signaling import SDP, start_server
+from latency import summarize
+from signaling import create_signaling
+
+
+def offer(user, seq):
+    return {"user": user, "seq": seq, "sdp": {"type": "offer", "sdp": SDP}}
+
+
+async def polite_peer(signaling):
+    async for data in signaling.messages():
+        message = json.loads(data)
+        if message.get("user") == "impolite" and message["sdp"]["type"] == "offer":
+            # rollback of its own offer, then the answer to the other one
+            await signaling.send({"user": "polite", "seq": message["seq"], "sdp": {"type": "answer", "sdp": SDP}})
+
+
+async def impolite_peer(signaling, answers):
+    async for data in signaling.messages():
+        message = json.loads(data)
+        # the offer of the polite peer is ignored
+        if message.get("user") == "polite" and message["sdp"]["type"] == "answer":
+            answered = answers.get(message["seq"])
+            if answered is not None and not answered.done():
+                answered.set_result(time.monotonic())
+
+
+async def glare(impolite, polite, seq, answers, timeout):
+    """The round trip of one glare in ms, None when no answer came within `timeout` seconds."""
+    answered = answers[seq] = asyncio.get_running_loop().create_future()
+    started = time.monotonic()
+    try:
+        await asyncio.gather(impolite.send(offer("impolite", seq)), polite.send(offer("polite", seq)))
+        return (await asyncio.wait_for(answered, timeout) - started) * 1000
+    except asyncio.TimeoutError:
+        return None
+    finally:
+        del answers[seq]
+
+
+async def bench(url, transport, rounds, gap, timeout):
+    room = "glare-" + transport
+    impolite = create_signaling(transport, url, room, "impolite")
+    polite = create_signaling(transport, url, room, "polite")
+    answers = {}
+    peers = [asyncio.ensure_future(polite_peer(polite)),
+             asyncio.ensure_future(impolite_peer(impolite, answers))]
+    try:
+        # until both streams are open, the first offers can be missed
+        seq = 0
+        while await glare(impolite, polite, seq, answers, 1.0) is None:
+            seq += 1
+        samples, lost = [], 0
+        for seq in range(seq + 1, seq + 1 + rounds):
+            round_trip = await glare(impolite, polite, seq, answers, timeout)
+            if round_trip is None:
+                lost += 1
+            else:
+                samples.append(round_trip)
+            await asyncio.sleep(gap)
+    finally:
+        for peer in peers:
+            peer.cancel()
+        await asyncio.gather(*peers, return_exceptions=True)
+        await impolite.close()
+        await polite.close()
+    return {"rounds": rounds, "lost": lost, "round_trip_ms": summarize(samples)}
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Glare resolution round trip over SSE+POST and WebSocket signaling")
+    ap.add_argument("--rounds", type=int, default=200)
+    ap.add_argument("--gap", type=float, default=0.02, help="Seconds between two rounds")
+    ap.add_argument("--timeout", type=float, default=5, help="Seconds to wait for the answer of a round")
+    ap.add_argument("--transports", nargs="+", choices=["sse", "ws"], default=["sse", "ws"])
+    ap.add_argument("--port", type=int, default=10060)
+    ap.add_argument("--url", default=None, help="Use this running server instead of starting one")
+    ap.add_argument("--output", type=Path, default=None, help="Also write the report here")
+    return ap.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = None
+    try:
+        if args.url:
+            url = args.url.rstrip("/")
+        else:
+            server = start_server(args.port)
+            url = "http://127.0.0.1:%d" % args.port
+        report = {transport: asyncio.run(bench(url, transport, args.rounds, args.gap, args.timeout))
+                  for transport in args.transports}
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    report["config"] = {k: v for k, v in vars(args).items() if k not in ("output",)}
+    text = json.dumps(report, indent=2, default=str)
+    print(text)
+    if args.output:
+        args.output.write_text(text)
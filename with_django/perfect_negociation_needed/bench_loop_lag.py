@@ -0,0 +1,111 @@
+"""
+Event-loop lag while posting signaling messages.
+
+A ticker coroutine asks to wake up every --tick seconds and records how late
+it actually wakes up. Meanwhile --messages signaling messages are posted to a
+stub /sdp endpoint that answers after --server-delay seconds, once with the
+blocking requests.post the peers used to call and once with HttpSignaling.
+
+    python bench_loop_lag.py --messages 50 --server-delay 0.05
+
+The stub server runs on its own thread and loop, so a blocked client loop
+cannot stall it.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import threading
+import time
+
+from aiohttp import web
+
+from signaling import HttpSignaling
+
+PORT = 10099
+
+
+def start_stub_server(delay):
+    ready = threading.Event()
+
+    async def sdp(request):
+        await request.read()
+        await asyncio.sleep(delay)
+        return web.Response(text="ok")
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_post('/sdp', sdp)
+        runner = web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', PORT).start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+    ready.wait()
+
+
+async def measure(post_all, tick):
+    lags = []
+    done = False
+
+    async def ticker():
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(tick)
+            lags.append(time.perf_counter() - start - tick)
+
+    task = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    await post_all()
+    elapsed = time.perf_counter() - started
+    done = True
+    await task
+    lags.sort()
+    return {
+        'elapsed_s': round(elapsed, 3),
+        'lag_p50_ms': round(statistics.median(lags) * 1000, 2),
+        'lag_p99_ms': round(lags[int(len(lags) * 0.99)] * 1000, 2),
+        'lag_max_ms': round(lags[-1] * 1000, 2),
+    }
+
+
+async def main(messages, delay, tick):
+    import requests
+
+    url = 'http://127.0.0.1:%d' % PORT
+    message = {"user": "polite", "sdp": {"type": "offer", "sdp": "v=0\r\n" * 50}}
+
+    async def blocking():
+        for _ in range(messages):
+            requests.post(url + "/sdp", json.dumps(dict(message, room="bench")))
+            await asyncio.sleep(0)
+
+    signaling = HttpSignaling(url, "bench")
+
+    async def pooled():
+        for _ in range(messages):
+            await signaling.send(message)
+
+    results = {
+        'requests.post': await measure(blocking, tick),
+        'HttpSignaling': await measure(pooled, tick),
+    }
+    await signaling.close()
+    return results
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Event-loop lag of the signaling client")
+    ap.add_argument("--messages", type=int, default=50)
+    ap.add_argument("--server-delay", type=float, default=0.05,
+                    help="Seconds the stub /sdp endpoint takes to answer")
+    ap.add_argument("--tick", type=float, default=0.005)
+    return ap.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    start_stub_server(args.server_delay)
+    print(json.dumps(asyncio.run(main(args.messages, args.server_delay, args.tick)), indent=2))
@@ -0,0 +1,170 @@
+"""
+Throughput of the media path: synthetic tracks sent between two peers over loopback.
+
+Two aiortc peer connections in one process, connected directly: the media
+still goes through the encoders, RTP over UDP on 127.0.0.1, the jitter
+buffers and the decoders. The caller sends a SyntheticVideoTrack (and a
+SyntheticAudioTrack with --audio), the callee reads the stamp of every
+decoded video frame.
+
+    python bench_media.py --size 1280x720 --fps 30 --duration 20
+
+After --warmup seconds, for --duration seconds:
+- delivered fps, and the frames never delivered (gaps in the frame indexes)
+- end-to-end latency, from the frame being generated to it being decoded
+- bitrate received, from the bytes of the transport (video, audio and RTCP)
+- with --stats-interval, the CPU a StatsSampler of each peer costs, and the
+  last sample of the callee
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from aiortc import RTCPeerConnection
+from aiortc.mediastreams import MediaStreamError
+
+from latency import summarize
+from statssampler import StatsSampler
+from synthetic import SyntheticAudioTrack, SyntheticVideoTrack, frame_age_ms, read_stamp
+
+
+def video_size(text):
+    # WIDTHxHEIGHT
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+async def connect(tracks):
+    caller, callee = RTCPeerConnection(), RTCPeerConnection()
+    received = {}
+    callee.on("track", lambda track: received.setdefault(track.kind, track))
+    for track in tracks:
+        caller.addTrack(track)
+    await caller.setLocalDescription(await caller.createOffer())
+    await callee.setRemoteDescription(caller.localDescription)
+    await callee.setLocalDescription(await callee.createAnswer())
+    await caller.setRemoteDescription(callee.localDescription)
+    return caller, callee, received
+
+
+async def bytes_received(pc):
+    report = await pc.getStats()
+    return sum(stats.bytesReceived for stats in report.values() if stats.type == "transport")
+
+
+async def measure_video(track, warmup, duration):
+    ages, indexes = [], []
+    started = time.monotonic()
+    measuring = started + warmup
+    end = measuring + duration
+    try:
+        while time.monotonic() < end:
+            frame = await track.recv()
+            index, sent_ms = read_stamp(frame.to_ndarray(format="gray"))
+            if time.monotonic() >= measuring:
+                ages.append(frame_age_ms(sent_ms))
+                indexes.append(index)
+    except MediaStreamError:
+        pass
+    delivered = len(indexes)
+    expected = indexes[-1] - indexes[0] + 1 if indexes else 0
+    return {
+        "frames": delivered,
+        "fps": round(delivered / duration, 1),
+        "missing": expected - delivered,
+        "latency_ms": summarize(ages),
+    }
+
+
+async def count_frames(track, warmup, duration):
+    frames = 0
+    measuring = time.monotonic() + warmup
+    try:
+        while time.monotonic() < measuring + duration:
+            await track.recv()
+            if time.monotonic() >= measuring:
+                frames += 1
+    except MediaStreamError:
+        pass
+    return {"frames": frames, "fps": round(frames / duration, 1)}
+
+
+class LastRecord:
+    # a sink keeping the last sample only
+    record = None
+
+    def write(self, record):
+        self.record = record
+
+    async def close(self):
+        pass
+
+
+async def main(size, fps, duration, warmup, audio, stats_interval=0):
+    width, height = size
+    tracks = [SyntheticVideoTrack(width, height, fps)]
+    if audio:
+        tracks.append(SyntheticAudioTrack())
+    caller, callee, received = await connect(tracks)
+    for _ in range(100):
+        if len(received) == len(tracks):
+            break
+        await asyncio.sleep(0.1)
+
+    samplers = []
+    if stats_interval:
+        last = LastRecord()
+        samplers = [StatsSampler(caller, stats_interval), StatsSampler(callee, stats_interval, [last])]
+        for sampler in samplers:
+            sampler.start()
+
+    measurements = [measure_video(received["video"], warmup, duration)]
+    if audio:
+        measurements.append(count_frames(received["audio"], warmup, duration))
+
+    async def bitrate():
+        await asyncio.sleep(warmup)
+        before = await bytes_received(callee)
+        await asyncio.sleep(duration)
+        return round((await bytes_received(callee) - before) * 8 / duration / 1e6, 3)
+
+    results = await asyncio.gather(bitrate(), *measurements)
+    for sampler in samplers:
+        await sampler.stop()
+    await caller.close()
+    await callee.close()
+    report = {
+        "size": "%dx%d" % size,
+        "fps_sent": fps,
+        "duration_s": duration,
+        "mbit_per_s": results[0],
+        "video": results[1],
+    }
+    if audio:
+        report["audio"] = results[2]
+    if samplers:
+        report["sampler"] = {"caller": samplers[0].overhead(), "callee": samplers[1].overhead(),
+                             "last_callee_sample": last.record}
+    return report
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Synthetic media sent over loopback: fps, latency, bitrate")
+    ap.add_argument("--size", type=video_size, default=(640, 480), help="WIDTHxHEIGHT (default: 640x480)")
+    ap.add_argument("--fps", type=float, default=30, help="Frames per second sent (default: 30)")
+    ap.add_argument("--duration", type=float, default=10, help="Seconds measured (default: 10)")
+    ap.add_argument("--warmup", type=float, default=3,
+                    help="Seconds left out first, while the encoder ramps its bitrate up (default: 3)")
+    ap.add_argument("--audio", action="store_true", help="Send a synthetic audio track too")
+    ap.add_argument("--stats-interval", type=float, default=0,
+                    help="Sample the statistics of both peers this often, 0 not to (default: 0)")
+    ap.add_argument("--json", action="store_true", help="Print the histogram too")
+    return ap.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(main(args.size, args.fps, args.duration, args.warmup, args.audio, args.stats_interval))
+    if not args.json:
+        report["video"]["latency_ms"].pop("histogram", None)
+    print(json.dumps(report, indent=2))
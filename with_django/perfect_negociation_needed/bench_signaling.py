@@ -0,0 +1,290 @@
+"""
+Load test of the /sdp -> events/<room>/ path of this project, over loopback.
+
+Starts the server (manage.py runserver, i.e. daphne) on --port, connects
+--subscribers SSE clients spread over --rooms rooms, then POSTs offers to
+/sdp at --rate per second for --duration seconds, round-robin over the rooms.
+
+    python bench_signaling.py --subscribers 2000 --rooms 100 --rate 200 --duration 20
+
+Every offer carries the monotonic time it was posted at, and subscribers run in
+this same process, so the delivery latency is measured on a single clock.
+The JSON report holds the delivery and POST latency percentiles, throughput,
+error counts, and the RSS and CPU of the server process, sampled from /proc
+(Linux only). Pass --url to load a server that is already running; its
+RSS/CPU are then only reported with --server-pid.
+
+With --workers N, N server processes are started on --port and the ports
+after it, connected by a broker (mainapp/broker.py). Subscribers and POSTs
+are spread round-robin over the workers, so most deliveries cross processes;
+RSS and CPU are summed over the workers and the broker.
+
+    python bench_signaling.py --workers 4 --subscribers 2000 --rooms 100 --rate 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+
+from latency import summarize
+from signaling import read_events
+
+PROJECT_DIR = Path(__file__).resolve().parent
+SDP = "v=0\r\no=- 0 0 IN IP4 127.0.0.1\r\ns=-\r\nt=0 0\r\n" + "a=candidate:1 1 udp 2130706431 127.0.0.1 9 typ host\r\n" * 10
+
+
+def start_server(port, broker=None):
+    env = dict(os.environ, SIGNAL_BROKER=broker) if broker else None
+    server = subprocess.Popen(
+        [sys.executable, "manage.py", "runserver", "--noreload", "127.0.0.1:%d" % port],
+        cwd=PROJECT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                break
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("signaling server did not start on port %d" % port)
+
+
+def start_broker(path):
+    broker = subprocess.Popen([sys.executable, "-m", "mainapp.broker", str(path)], cwd=PROJECT_DIR)
+    deadline = time.monotonic() + 10
+    while not path.exists():
+        if broker.poll() is not None or time.monotonic() > deadline:
+            broker.kill()
+            raise RuntimeError("broker did not start on %s" % path)
+        time.sleep(0.05)
+    return broker
+
+
+class ProcessSampler:
+    """RSS and CPU of processes, summed, read from /proc every `period` seconds."""
+
+    def __init__(self, pids, period=0.5):
+        self.pids = pids
+        self.period = period
+        self.rss_mb = []
+        self.cpu_percent = []
+
+    def cpu_seconds(self):
+        total = 0
+        for pid in self.pids:
+            with open("/proc/%d/stat" % pid) as f:
+                # the fields after the ")" closing the command name, utime and stime are the 12th and 13th
+                fields = f.read().rpartition(")")[2].split()
+            total += int(fields[11]) + int(fields[12])
+        return total / os.sysconf("SC_CLK_TCK")
+
+    def rss(self):
+        total = 0.0
+        for pid in self.pids:
+            with open("/proc/%d/status" % pid) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) / 1024
+        return total
+
+    async def run(self):
+        cpu, at = self.cpu_seconds(), time.monotonic()
+        while True:
+            await asyncio.sleep(self.period)
+            now_cpu, now = self.cpu_seconds(), time.monotonic()
+            self.cpu_percent.append(100 * (now_cpu - cpu) / (now - at))
+            self.rss_mb.append(self.rss())
+            cpu, at = now_cpu, now
+
+    def report(self):
+        if not self.rss_mb:
+            return {}
+        return {
+            "rss_mb_peak": round(max(self.rss_mb), 1),
+            "rss_mb_last": round(self.rss_mb[-1], 1),
+            "cpu_percent_mean": round(sum(self.cpu_percent) / len(self.cpu_percent), 1),
+            "cpu_percent_peak": round(max(self.cpu_percent), 1),
+        }
+
+
+class Stats:
+    def __init__(self):
+        self.connected = 0
+        self.subscriber_errors = 0
+        self.delivered = 0
+        self.delivery_ms = []
+        self.posted = 0
+        self.post_ok = 0
+        self.post_errors = 0
+        self.post_ms = []
+        self.expected = 0
+
+
+async def subscriber(session, url, room, stats, connected):
+    opened = False
+    try:
+        async with session.get("%s/events/%s/" % (url, room),
+                               timeout=aiohttp.ClientTimeout(total=None, sock_read=60)) as response:
+            response.raise_for_status()
+            async for event, data, _ in read_events(response.content):
+                if event == "stream-open" and not opened:
+                    opened = True
+                    stats.connected += 1
+                    connected.set()
+                elif event == "message":
+                    message = json.loads(data)
+                    if "t" in message:
+                        stats.delivery_ms.append((time.monotonic() - message["t"]) * 1000)
+                        stats.delivered += 1
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        stats.subscriber_errors += 1
+    finally:
+        if not opened:
+            # count the failure as "settled" so the ramp-up does not wait for it
+            connected.set()
+
+
+async def post_offer(session, url, room, seq, stats, per_room):
+    body = json.dumps({"user": "bench", "room": room, "seq": seq, "t": time.monotonic(),
+                       "sdp": {"type": "offer", "sdp": SDP}})
+    started = time.monotonic()
+    try:
+        async with session.post(url + "/sdp", data=body) as response:
+            await response.read()
+            if response.status == 200:
+                stats.post_ok += 1
+                stats.expected += per_room[room]
+                stats.post_ms.append((time.monotonic() - started) * 1000)
+            else:
+                stats.post_errors += 1
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        stats.post_errors += 1
+
+
+async def bench(urls, subscribers, rooms, rate, duration, connect_concurrency, drain, sampler):
+    stats = Stats()
+    room_names = ["bench-%d" % i for i in range(rooms)]
+    per_room = {room: 0 for room in room_names}
+    # no connection limit, every subscriber holds its own stream open
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0),
+                                    timeout=aiohttp.ClientTimeout(total=30))
+    sampling = asyncio.ensure_future(sampler.run()) if sampler else None
+
+    # ramp up, at most connect_concurrency streams being opened at once
+    streams = []
+    gate = asyncio.Semaphore(connect_concurrency)
+    ramp_started = time.monotonic()
+
+    async def open_stream(url, room):
+        async with gate:
+            connected = asyncio.Event()
+            streams.append(asyncio.ensure_future(subscriber(session, url, room, stats, connected)))
+            await connected.wait()
+
+    for i in range(subscribers):
+        per_room[room_names[i % rooms]] += 1
+    # the subscribers of a room land on different workers, as long as rooms and workers are coprime
+    await asyncio.gather(*(open_stream(urls[i % len(urls)], room_names[i % rooms]) for i in range(subscribers)))
+    ramp_s = time.monotonic() - ramp_started
+    # a failed stream delivers nothing, only count the ones that opened
+    per_room = {room: count * stats.connected / subscribers for room, count in per_room.items()}
+
+    # open loop: offers are fired on schedule whether or not the previous ones completed
+    posts = []
+    started = time.monotonic()
+    total = int(rate * duration)
+    for seq in range(total):
+        delay = started + seq / rate - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        posts.append(asyncio.ensure_future(
+            post_offer(session, urls[seq % len(urls)], room_names[seq % rooms], seq, stats, per_room)))
+        stats.posted += 1
+    await asyncio.gather(*posts)
+    send_s = time.monotonic() - started
+
+    # let the last events reach the subscribers
+    deadline = time.monotonic() + drain
+    while stats.delivered < stats.expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    elapsed = time.monotonic() - started
+
+    for stream in streams:
+        stream.cancel()
+    await asyncio.gather(*streams, return_exceptions=True)
+    if sampling:
+        sampling.cancel()
+    await session.close()
+
+    return {
+        "subscribers": {"requested": subscribers, "connected": stats.connected,
+                        "errors": stats.subscriber_errors, "ramp_s": round(ramp_s, 2)},
+        "posts": {"sent": stats.posted, "ok": stats.post_ok, "errors": stats.post_errors,
+                  "per_s": round(stats.post_ok / send_s, 1), "latency_ms": summarize(stats.post_ms)},
+        "deliveries": {"expected": round(stats.expected), "received": stats.delivered,
+                       "lost": max(0, round(stats.expected) - stats.delivered),
+                       "per_s": round(stats.delivered / elapsed, 1),
+                       "latency_ms": summarize(stats.delivery_ms)},
+        "server": sampler.report() if sampler else {},
+    }
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Load test of /sdp and events/<room>/ over loopback")
+    ap.add_argument("--subscribers", type=int, default=1000)
+    ap.add_argument("--rooms", type=int, default=50)
+    ap.add_argument("--rate", type=float, default=100, help="SDP POSTs per second")
+    ap.add_argument("--duration", type=float, default=10, help="Seconds of posting")
+    ap.add_argument("--connect-concurrency", type=int, default=100,
+                    help="SSE streams being opened at once during the ramp-up")
+    ap.add_argument("--drain", type=float, default=5,
+                    help="Seconds to wait for deliveries still in flight after the last POST")
+    ap.add_argument("--port", type=int, default=10050)
+    ap.add_argument("--workers", type=int, default=1,
+                    help="Server processes, on --port and the ports after it, linked by a broker (default: 1)")
+    ap.add_argument("--url", default=None, help="Load this running server instead of starting one")
+    ap.add_argument("--server-pid", type=int, default=None,
+                    help="Process to sample RSS/CPU from when --url is given")
+    ap.add_argument("--output", type=Path, default=None, help="Also write the report here")
+    return ap.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    processes = []
+    try:
+        if args.url:
+            urls, pids = [args.url.rstrip("/")], [args.server_pid] if args.server_pid else []
+        else:
+            broker = None
+            if args.workers > 1:
+                broker = Path(tempfile.gettempdir()) / ("signal-broker-%d.sock" % os.getpid())
+                processes.append(start_broker(broker))
+            for worker in range(args.workers):
+                processes.append(start_server(args.port + worker, broker))
+            urls = ["http://127.0.0.1:%d" % (args.port + worker) for worker in range(args.workers)]
+            pids = [process.pid for process in processes]
+        pids = [pid for pid in pids if os.path.exists("/proc/%d" % pid)]
+        sampler = ProcessSampler(pids) if pids else None
+        report = asyncio.run(bench(urls, args.subscribers, args.rooms, args.rate, args.duration,
+                                   args.connect_concurrency, args.drain, sampler))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+    report["config"] = {k: v for k, v in vars(args).items() if k not in ("output",)}
+    text = json.dumps(report, indent=2, default=str)
+    print(text)
+    if args.output:
+        args.output.write_text(text)
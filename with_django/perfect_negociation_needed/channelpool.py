@@ -0,0 +1,113 @@
+# channelpool.py
+"""
+Several negotiated data channels on one peer connection, each with its own
+reliability and priority.
+
+    pool = ChannelPool(pc, (
+        ChannelSpec("control", 1, ordered=False, priority=1),
+        ChannelSpec("images", 0),
+    ))
+    pool["control"].send(...)
+    await send_file(pool["images"], path, writable=pool.writer("images"))
+
+Both peers declare the same specs (label, id, ordered, max_retransmits,
+max_packet_life_time), the channels are negotiated so nothing is exchanged
+in-band to open them.
+
+Priority is enforced on the sending side. aiortc has a single queue for the
+messages of every channel of the association and serves it in order, so a
+ping sent on its own channel still waits for all the bulk bytes queued
+before it. A channel with a lower priority therefore only queues more data
+through writable(), which waits until
+- its own buffered amount is below `window`, and
+- no channel with a higher priority has anything buffered.
+A message of a higher priority channel then waits for at most `window` bytes
+of each lower priority channel, instead of everything a bulk sender queued.
+Latency-sensitive messages that are worthless once late (telemetry) are best
+sent unordered with max_packet_life_time, bulk data reliable and ordered.
+"""
+import asyncio
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Iterable, Iterator, Optional
+
+from aiortc import RTCDataChannel, RTCPeerConnection
+
+DEFAULT_WINDOW = 64 * 1024  # bytes a channel may have queued before writable() waits
+
+
+@dataclass(frozen=True)
+class ChannelSpec:
+    label: str
+    id: int
+    ordered: bool = True
+    max_retransmits: Optional[int] = None       # partially reliable: give up after this many retransmissions
+    max_packet_life_time: Optional[int] = None  # ... or after this many ms, not both
+    priority: int = 0                           # higher goes first
+    window: int = DEFAULT_WINDOW
+
+
+class ChannelPool:
+    def __init__(self, pc: RTCPeerConnection, specs: Iterable[ChannelSpec]):
+        self.specs: Dict[str, ChannelSpec] = {}
+        self.channels: Dict[str, RTCDataChannel] = {}
+        for spec in specs:
+            if spec.label in self.specs:
+                raise ValueError(f"channel {spec.label!r} declared twice")
+            channel = pc.createDataChannel(
+                spec.label, negotiated=True, id=spec.id, ordered=spec.ordered,
+                maxRetransmits=spec.max_retransmits, maxPacketLifeTime=spec.max_packet_life_time)
+            # "bufferedamountlow" once the queue is empty: a control message never gets
+            # above any other threshold, and a bulk sender refills a whole window at once
+            channel.bufferedAmountLowThreshold = 0
+            self.specs[spec.label] = spec
+            self.channels[spec.label] = channel
+
+    def __getitem__(self, label: str) -> RTCDataChannel:
+        return self.channels[label]
+
+    def __iter__(self) -> Iterator[RTCDataChannel]:
+        return iter(self.channels.values())
+
+    @property
+    def bufferedAmount(self) -> int:
+        return sum(channel.bufferedAmount for channel in self.channels.values())
+
+    def blocking(self, label: str) -> list:
+        """The channels `label` has to wait for before it queues more data."""
+        spec, channel = self.specs[label], self.channels[label]
+        busy = [other for other in self.channels.values()
+                if self.specs[other.label].priority > spec.priority and other.bufferedAmount > 0]
+        if not busy and channel.bufferedAmount >= spec.window:
+            busy.append(channel)
+        return busy
+
+    async def writable(self, label: str) -> None:
+        """Wait until `label` may queue more data. Returns at once if the channel is not open."""
+        while self.channels[label].readyState == "open":
+            busy = self.blocking(label)
+            if not busy:
+                return
+            await wait_any_buffered_low(busy)
+
+    def writer(self, label: str) -> Callable[[], Awaitable[None]]:
+        return lambda: self.writable(label)
+
+
+async def wait_any_buffered_low(channels: Iterable[RTCDataChannel]) -> None:
+    """Wait for one of `channels` to drain, or to close."""
+    drained = asyncio.get_running_loop().create_future()
+
+    def on_event():
+        if not drained.done():
+            drained.set_result(None)
+
+    registered = []
+    for channel in channels:
+        for event in ("bufferedamountlow", "close"):
+            channel.on(event, on_event)
+            registered.append((channel, event))
+    try:
+        await drained
+    finally:
+        for channel, event in registered:
+            channel.remove_listener(event, on_event)
@@ -1,53 +1,284 @@
 from aiortc import RTCPeerConnection
+from aiortc.sdp import candidate_from_sdp
 from functools import partial
-import requests
 import asyncio
+import time
 
 CHAT_CHANNEL = "chat"
+HEARTBEAT_CHANNEL = "heartbeat"
+# negotiated out of band with this id by both peers, well above the ids given to in-band channels
+HEARTBEAT_CHANNEL_ID = 1000
+
+
+# tasks started by spawn(), held until they are done: the event loop only keeps weak references
+_tasks = set()
+
+
+def spawn(coroutine):
+    task = asyncio.ensure_future(coroutine)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
 
 
 async def waitForEvent(user_function, timeout = 10):
-    
-    event = asyncio.Event()
-    fulfilled_value = None
-    
+    """
+    Wait for what user_function(fulfill) sets up to call fulfill(value), and return the value.
+
+    user_function can return a cleanup function (or be a coroutine returning one), which is
+    called however the wait ends: fulfilled, timed out or cancelled. That is where the
+    listeners it registered are removed, nothing outlives the wait.
+    """
+    future = asyncio.get_running_loop().create_future()
+
     def fulfill(value):
-        nonlocal fulfilled_value
-        fulfilled_value = value
+        if not future.done():
+            future.set_result(value)
+
+    cleanup = user_function(fulfill)
+    if asyncio.iscoroutine(cleanup):
+        cleanup = await cleanup
+    try:
+        # the future is cancelled on timeout, a late fulfill is then ignored
+        return await asyncio.wait_for(future, timeout=timeout)
+    finally:
+        if cleanup is not None:
+            cleanup()
+
 
-        event.set()
-    
-    async def waiter():
-        await event.wait()
+def waitForEmitterEvent(emitter, event, timeout = 10, predicate = None):
+    """
+    Wait for `event` of `emitter` (the pyee emitters of aiortc) for which predicate(*args)
+    holds, and return its argument. The listener is removed whatever happens.
+    """
+    def inner(fulfill):
+        def listener(*args):
+            if predicate is None or predicate(*args):
+                fulfill(args[0] if args else None)
 
-    asyncio.create_task(user_function(fulfill))
-    
-    await asyncio.wait_for(waiter(), timeout=timeout)
-    return fulfilled_value
+        emitter.add_listener(event, listener)
+        return partial(emitter.remove_listener, event, listener)
+
+    return waitForEvent(inner, timeout)
 
 
 def setTimeout(func, delay):
-    async def inner():
-        await asyncio.sleep(delay)
-        func()
-    asyncio.create_task(inner())
+    # a timer of the loop, no task: cancelled with clearTimeout, forgotten once it fired
+    return asyncio.get_running_loop().call_later(delay, func)
+
+
+def clearTimeout(handle):
+    if handle is not None:
+        handle.cancel()
+
+
+def candidateFromJSON(candidate):
+    # browsers send RTCIceCandidate.toJSON(): {"candidate": "candidate:...", "sdpMid": "0", "sdpMLineIndex": 0}
+    # null or an empty candidate string mark the end of candidates, aiortc expects None for that
+    if candidate is None or not candidate.get('candidate'):
+        return None
+    iceCandidate = candidate_from_sdp(candidate['candidate'].split(':', 1)[1])
+    iceCandidate.sdpMid = candidate.get('sdpMid')
+    iceCandidate.sdpMLineIndex = candidate.get('sdpMLineIndex')
+    return iceCandidate
+
+
+def supportsIceRestart(peerConnection):
+    # aiortc has neither restartIce() nor createOffer(iceRestart=True): its ICE transport
+    # connects once and "failed" is final, a lost connection can only be rebuilt
+    return callable(getattr(peerConnection, 'restartIce', None))
+
+
+def sdpAttribute(sdp, name):
+    prefix = 'a=' + name + ':'
+    for line in sdp.splitlines():
+        if line.startswith(prefix):
+            return line[len(prefix):].strip()
+    return None
+
+
+def remoteRestarted(peerConnection: RTCPeerConnection, description):
+    """
+    Whether the remote offer `description` cannot be applied to `peerConnection`
+    and needs a new one: the remote peer started over with a new peer connection
+    (new DTLS fingerprint), or restarted ICE and this one cannot follow.
+    """
+    current = peerConnection.remoteDescription
+    if description.type != "offer" or current is None:
+        return False
+    if sdpAttribute(description.sdp, 'fingerprint') != sdpAttribute(current.sdp, 'fingerprint'):
+        return True
+    return (sdpAttribute(description.sdp, 'ice-ufrag') != sdpAttribute(current.sdp, 'ice-ufrag')
+            and not supportsIceRestart(peerConnection))
+
+
+class ConnectionRecovery:
+    """
+    Brings a lost ICE connection back, the cheapest way first:
+    - an ICE restart, new credentials and candidates on the same peer connection.
+      The DTLS and SCTP associations, and so the data channels, are kept
+    - a new peer connection negotiated from scratch, when ICE cannot be restarted
+      or the restart did not reconnect within restartTimeout seconds
+
+    "disconnected" often heals by itself and is given disconnectedGrace seconds,
+    "failed" is recovered right away.
+
+    Like peerConnection['negociate'], the ways to recover are set by the caller:
+    - restartIce(), a coroutine starting an ICE restart, False when it cannot
+    - rebuild(), a coroutine replacing the peer connection and negotiating again
+    and onLost(state) and onRecovered(method, seconds) are told about each recovery.
+    """
+
+    def __init__(self, restartTimeout=5.0, disconnectedGrace=2.0):
+        self.restartIce = None
+        self.rebuild = None
+        self.onLost = None
+        self.onRecovered = None
+        self.restartTimeout = restartTimeout
+        self.disconnectedGrace = disconnectedGrace
+        # the peer connection in use, the replaced ones are ignored
+        self.current = None
+        self.connected = asyncio.Event()
+        self.lostAt = None
+        self.method = None
+        self.task = None
+
+    def watch(self, peerConnection: RTCPeerConnection):
+        self.current = peerConnection
+        self.connected.clear()
+
+    def connectionLost(self, peerConnection, state):
+        if peerConnection is not self.current:
+            return
+        self.connected.clear()
+        if self.lostAt is None:
+            # the recovery is timed from the first loss, whatever it takes after it
+            self.lostAt = time.monotonic()
+            if self.onLost is not None:
+                self.onLost(state)
+        if self.task is None or self.task.done():
+            self.task = spawn(self.__recover(peerConnection, state))
+
+    def connectionRestored(self, peerConnection):
+        if peerConnection is not self.current:
+            return
+        self.connected.set()
+        if self.lostAt is not None:
+            seconds, self.lostAt = time.monotonic() - self.lostAt, None
+            if self.onRecovered is not None:
+                self.onRecovered(self.method, seconds)
+
+    async def __waitConnected(self, timeout):
+        try:
+            await asyncio.wait_for(self.connected.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def __recover(self, peerConnection, state):
+        if state == "disconnected":
+            self.method = "waiting"
+            if await self.__waitConnected(self.disconnectedGrace):
+                return
+        if self.restartIce is not None and await self.restartIce():
+            self.method = "ice_restart"
+            print("restarting ICE")
+            if await self.__waitConnected(self.restartTimeout):
+                return
+            print("ICE restart did not reconnect")
+        if peerConnection is self.current and not self.connected.is_set():
+            self.method = "rebuild"
+            print("rebuilding the peer connection")
+            # done once the new one connects, connectionRestored times it
+            await self.rebuild()
+
+
+class Heartbeat:
+    """
+    Liveness of the remote peer, from beats exchanged on a dedicated negotiated
+    data channel, so the channels of the application carry no probe.
+
+    Both peers send a beat every `interval` seconds. The remote peer is declared
+    dead after `misses` intervals without a beat from it, which bounds the
+    detection to (misses + 1) * interval seconds, and alive again at its next
+    beat. onDead() and onAlive() are called on those changes.
+
+    Beats are unordered and never retransmitted, a late beat is worth nothing.
+    """
+
+    def __init__(self, peerConnection: RTCPeerConnection, interval=1.0, misses=3):
+        # created before the first offer, so that no extra negotiation is needed
+        self.channel = peerConnection.createDataChannel(
+            HEARTBEAT_CHANNEL, negotiated=True, id=HEARTBEAT_CHANNEL_ID, ordered=False, maxRetransmits=0)
+        self.interval = interval
+        self.misses = misses
+        self.onDead = None
+        self.onAlive = None
+        # None until the channel opens
+        self.alive = None
+        self.lastBeat = None
+        self.task = None
+        self.channel.on('open', self.start)
+        self.channel.on('message', self.__onBeat)
+        self.channel.on('close', self.stop)
+
+    @property
+    def dead(self):
+        return self.alive is False
+
+    def start(self):
+        self.lastBeat = time.monotonic()
+        self.alive = True
+        self.task = spawn(self.__run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def __onBeat(self, message):
+        self.lastBeat = time.monotonic()
+        if self.alive is False:
+            self.alive = True
+            if self.onAlive is not None:
+                self.onAlive()
+
+    async def __run(self):
+        lastTick = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if now - lastTick > 2 * self.interval:
+                # our own loop stalled (or the process was suspended): the beats of
+                # the remote peer were not read, their absence says nothing about it
+                self.lastBeat = now
+            lastTick = now
+            if self.channel.readyState == "open":
+                self.channel.send("beat")
+            if self.alive and now - self.lastBeat > self.interval * self.misses:
+                self.alive = False
+                if self.onDead is not None:
+                    self.onDead()
+            await asyncio.sleep(self.interval)
 
 
-def addConnectionStateHandler(peerConnection: RTCPeerConnection, username):
-    peerConnection.add_listener('iceconnectionstatechange', partial(__onIceConnectionStateChange, peerConnection, username))
+def addConnectionStateHandler(peerConnection: RTCPeerConnection, username, recovery=None, heartbeat=None):
+    if recovery is not None:
+        recovery.watch(peerConnection)
+        if heartbeat is not None:
+            # a silent peer is lost long before ICE consent expires
+            heartbeat.onDead = partial(recovery.connectionLost, peerConnection, "dead")
+            heartbeat.onAlive = partial(recovery.connectionRestored, peerConnection)
+    peerConnection.add_listener('iceconnectionstatechange', partial(__onIceConnectionStateChange, peerConnection, username, recovery))
 
-def __onIceConnectionStateChange(peerConnection: RTCPeerConnection, username):
+def __onIceConnectionStateChange(peerConnection: RTCPeerConnection, username, recovery):
     state = peerConnection.iceConnectionState
-    print(state)
-    if state == "disconnected" or state == "failed":
-        retrieveOffer(username)
-    elif state == "connected":
-        clearBothOffers(username)
-
-def retrieveOffer(username):
-    # I was just too lazy to implement this
-    pass
-
-def clearBothOffers(username):
-    # I was just too lazy to implement this
-    pass
\ No newline at end of file
+    print(username, "ICE", state)
+    if recovery is None:
+        return
+    if state == "disconnected" or state == "failed" or state == "closed":
+        # when consent expires, aiortc closes the whole peer connection by itself. the
+        # ones closed on purpose are replaced first, recovery ignores them
+        recovery.connectionLost(peerConnection, state)
+    elif state == "connected" or state == "completed":
+        # aiortc goes straight from checking to completed
+        recovery.connectionRestored(peerConnection)
@@ -0,0 +1,131 @@
+# filetransfer.py
+"""
+Streaming file transfer over an RTCDataChannel.
+
+The sender reads the file one chunk at a time and stops reading while more
+than HIGH_WATER bytes are queued on the channel, resuming on
+"bufferedamountlow" or on the close of the channel, or only when a
+`writable` callback lets it, see channelpool.py. The receiver appends each chunk to a .part file and
+renames it once complete. Neither side ever holds more than a few chunks,
+whatever the size of the file.
+
+On the wire, next to the existing JSON control messages:
+- text   {"type": "file", "name": ..., "size": ..., "chunks": ...}
+- binary CHUNK_HEADER (chunk index) followed by the chunk bytes, in order
+- text   {"type": "file-end", "name": ..., "chunks": ...}
+"""
+import json
+import math
+import struct
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+from aiortc import RTCDataChannel
+
+from channelpool import wait_any_buffered_low
+
+CHUNK_SIZE = 16 * 1024        # safe for every SCTP implementation
+HIGH_WATER = 1024 * 1024      # stop reading above this many queued bytes
+LOW_WATER = 256 * 1024        # ... and resume once the queue drains below this
+CHUNK_HEADER = struct.Struct("!I")
+
+Progress = Callable[[str, int, int], None]  # name, bytes done, total bytes
+
+
+async def send_file(dc: RTCDataChannel, path: Path, chunk_size: int = CHUNK_SIZE,
+                    progress: Optional[Progress] = None,
+                    writable: Optional[Callable[[], Awaitable[None]]] = None) -> None:
+    # `writable` is awaited before every chunk instead of the HIGH_WATER/LOW_WATER flow control
+    size = path.stat().st_size
+    chunks = math.ceil(size / chunk_size)
+    if writable is None:
+        dc.bufferedAmountLowThreshold = LOW_WATER
+    dc.send(json.dumps({"type": "file", "name": path.name, "size": size, "chunks": chunks}))
+
+    sent = 0
+    with path.open("rb") as f:
+        for index in range(chunks):
+            if writable is not None:
+                await writable()
+            elif dc.bufferedAmount > HIGH_WATER:
+                # a channel closing with bytes queued never emits "bufferedamountlow", only "close"
+                await wait_any_buffered_low([dc])
+            if dc.readyState != "open":
+                raise ConnectionError(f"datachannel {dc.readyState} after {sent}/{size} bytes")
+            chunk = f.read(chunk_size)
+            dc.send(CHUNK_HEADER.pack(index) + chunk)
+            sent += len(chunk)
+            if progress:
+                progress(path.name, sent, size)
+    dc.send(json.dumps({"type": "file-end", "name": path.name, "chunks": chunks}))
+
+
+class FileReceiver:
+    """Fed the "file"/"file-end" control messages and the binary chunks, in channel order."""
+
+    def __init__(self, directory: Path, progress: Optional[Progress] = None):
+        self.directory = directory
+        self.progress = progress
+        self.file = None
+        self.path = None
+        self.size = 0
+        self.received = 0
+        self.next_index = 0
+
+    def start(self, header: dict) -> None:
+        self.abort()
+        # only the base name, a peer does not get to choose where we write
+        name = header.get("name")
+        name = Path(name).name if isinstance(name, str) else ""
+        path = self.directory / name
+        if name in ("", ".", "..") or path.parent != self.directory:
+            raise ValueError(f"refused file name {header.get('name')!r}")
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.size = header["size"]
+        self.received = 0
+        self.next_index = 0
+        self.file = self.path.with_name(self.path.name + ".part").open("wb")
+
+    def write_chunk(self, frame: bytes) -> None:
+        if self.file is None:
+            raise ValueError("chunk received outside of a transfer")
+        (index,) = CHUNK_HEADER.unpack_from(frame)
+        if index != self.next_index:
+            raise ValueError(f"chunk {index} received, expected {self.next_index}")
+        self.file.write(memoryview(frame)[CHUNK_HEADER.size:])
+        self.next_index += 1
+        self.received += len(frame) - CHUNK_HEADER.size
+        if self.progress:
+            self.progress(self.path.name, self.received, self.size)
+
+    def finish(self, trailer: dict) -> Path:
+        if self.file is None:
+            raise ValueError("file-end received outside of a transfer")
+        part = Path(self.file.name)
+        self.file.close()
+        self.file = None
+        if self.next_index != trailer["chunks"] or self.received != self.size:
+            raise ValueError(f"incomplete {self.path.name}: {self.received}/{self.size} bytes, "
+                             f"{self.next_index}/{trailer['chunks']} chunks")
+        part.replace(self.path)
+        return self.path
+
+    def abort(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            Path(self.file.name).unlink(missing_ok=True)
+            self.file = None
+
+
+def print_progress(role: str, step: float = 0.1) -> Progress:
+    """A progress callback printing every `step` of the file."""
+    last = {}
+
+    def progress(name, done, total):
+        fraction = done / total if total else 1.0
+        if fraction >= 1.0 or fraction - last.get(name, 0.0) >= step:
+            last[name] = fraction
+            print(f"[{role}] {name}: {done}/{total} bytes ({fraction:.0%})")
+
+    return progress
@@ -0,0 +1,208 @@
+# filewatch.py
+"""
+Waiting for the signaling mailbox files (offer.json, <session>.answer.json, ...).
+
+One watcher per event loop serves every session of the process:
+- InotifyWatcher (Linux) puts one inotify watch on each mailbox directory and
+  wakes the waiters of a file as soon as it is renamed into place (or closed
+  after writing). Nothing runs while nobody writes.
+- PollingWatcher is the fallback elsewhere. A single task stats each awaited
+  path once per tick, however many sessions wait on it.
+"""
+import asyncio
+import ctypes
+import ctypes.util
+import json
+import os
+import struct
+import time
+import weakref
+from pathlib import Path
+from typing import Optional
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+# a file that exists but does not parse is read again after each change of its directory, this many times
+READ_ATTEMPTS = 20
+# seconds to wait for that change, a write landing between the read and the wait is not missed for long
+READ_RETRY_WAIT = 0.5
+
+
+class PollingWatcher:
+    def __init__(self, poll: float = 0.2):
+        self.poll = poll
+        self.waiters = {}  # path -> set of futures
+        self.task = None
+
+    async def wait_for(self, path: Path, timeout: Optional[float] = None) -> None:
+        """Return once `path` exists, raise asyncio.TimeoutError after `timeout` seconds."""
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(path, set()).add(future)
+        try:
+            if path.exists():
+                return
+            if self.task is None or self.task.done():
+                self.task = asyncio.ensure_future(self._poll())
+            await asyncio.wait_for(future, timeout)
+        finally:
+            self._discard(path, future)
+
+    async def wait_for_change(self, directory: Path, timeout: Optional[float] = None) -> None:
+        """Return after a tick, callers rescan `directory` themselves."""
+        await asyncio.sleep(self.poll if timeout is None else min(self.poll, timeout))
+
+    def _discard(self, path, future):
+        futures = self.waiters.get(path)
+        if futures is not None:
+            futures.discard(future)
+            if not futures:
+                del self.waiters[path]
+
+    async def _poll(self):
+        while self.waiters:
+            await asyncio.sleep(self.poll)
+            for path, futures in list(self.waiters.items()):
+                if path.exists():
+                    wake(futures)
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+
+
+class InotifyWatcher:
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.loop = asyncio.get_running_loop()
+        self.directories = {}  # directory -> watch descriptor
+        self.waiters = {}  # (watch descriptor, file name or None for any file) -> set of futures
+        self.loop.add_reader(self.fd, self._read)
+
+    def _watch(self, directory: Path) -> int:
+        wd = self.directories.get(directory)
+        if wd is None:
+            # a mailbox nobody wrote to yet, inotify can only watch a directory that exists
+            directory.mkdir(parents=True, exist_ok=True)
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_MOVED_TO | IN_CLOSE_WRITE)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+            self.directories[directory] = wd
+        return wd
+
+    async def wait_for(self, path: Path, timeout: Optional[float] = None) -> None:
+        """Return once `path` exists, raise asyncio.TimeoutError after `timeout` seconds."""
+        path = path.absolute()
+        key = (self._watch(path.parent), os.fsencode(path.name))
+        future = self.loop.create_future()
+        # registered before checking, so a file landing in between is not missed
+        self.waiters.setdefault(key, set()).add(future)
+        try:
+            if path.exists():
+                return
+            await asyncio.wait_for(future, timeout)
+        finally:
+            self._discard(key, future)
+
+    async def wait_for_change(self, directory: Path, timeout: Optional[float] = None) -> None:
+        """Return once any file is written or renamed into `directory`, or after `timeout` seconds."""
+        key = (self._watch(directory.absolute()), None)
+        future = self.loop.create_future()
+        self.waiters.setdefault(key, set()).add(future)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._discard(key, future)
+
+    def _discard(self, key, future):
+        futures = self.waiters.get(key)
+        futures.discard(future)
+        if not futures:
+            del self.waiters[key]
+
+    def _read(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # events were dropped, let every waiter check its file again
+                for futures in list(self.waiters.values()):
+                    wake(futures)
+                continue
+            for key in ((wd, name), (wd, None)):
+                futures = self.waiters.get(key)
+                if futures:
+                    wake(futures)
+
+    def close(self):
+        self.loop.remove_reader(self.fd)
+        os.close(self.fd)
+
+
+def wake(futures):
+    for future in futures:
+        if not future.done():
+            future.set_result(None)
+
+
+# event loop -> its shared watcher
+_watchers = weakref.WeakKeyDictionary()
+
+
+def get_watcher(mode: str = "auto", poll: float = 0.2):
+    """The watcher shared by every session running on the current event loop."""
+    loop = asyncio.get_running_loop()
+    watcher = _watchers.get(loop)
+    if watcher is None:
+        watcher = None
+        if mode in ("auto", "inotify"):
+            try:
+                watcher = InotifyWatcher()
+            except (OSError, AttributeError):
+                if mode == "inotify":
+                    raise
+        if watcher is None:
+            watcher = PollingWatcher(poll)
+        _watchers[loop] = watcher
+    return watcher
+
+
+async def wait_for_file(path: Path, timeout: Optional[float] = None, watcher=None) -> dict:
+    """
+    Wait for `path`, consume it and return its JSON content. Raises TimeoutError
+    after `timeout` seconds, ValueError when it exists but never parses.
+    """
+    watcher = watcher or get_watcher()
+    deadline = time.monotonic() + timeout if timeout else None
+    last_err = None
+    for _ in range(READ_ATTEMPTS):
+        remaining = max(0.0, deadline - time.monotonic()) if deadline else None
+        try:
+            await watcher.wait_for(path, remaining)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Timed out waiting for {path} (last_err={last_err})")
+        try:
+            data = json.loads(path.read_text())
+            path.unlink(missing_ok=True)  # consume once
+            return data
+        except (OSError, ValueError) as e:
+            # consumed by someone else in the meantime, or not a complete JSON document yet:
+            # read it again once it changes, not in a loop
+            last_err = e
+            remaining = max(0.0, deadline - time.monotonic()) if deadline else None
+            await watcher.wait_for_change(path.parent, READ_RETRY_WAIT if remaining is None
+                                          else min(READ_RETRY_WAIT, remaining))
+    raise ValueError(f"{path} not readable after {READ_ATTEMPTS} attempts: {last_err}")
@@ -0,0 +1,44 @@
+# latency.py
+"""Percentiles and a log-scale histogram for latency samples, in milliseconds."""
+import math
+from typing import Dict, List, Sequence
+
+# upper bounds of the histogram buckets, in ms; the last bucket is unbounded
+BUCKETS_MS = (0.25, 0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+def percentile(ordered: Sequence[float], p: float) -> float:
+    """Nearest-rank percentile of an already sorted sequence."""
+    if not ordered:
+        return float("nan")
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def histogram(samples: Sequence[float], buckets=BUCKETS_MS) -> Dict[str, int]:
+    counts = {f"<={bound}": 0 for bound in buckets}
+    counts[f">{buckets[-1]}"] = 0
+    for sample in samples:
+        for bound in buckets:
+            if sample <= bound:
+                counts[f"<={bound}"] += 1
+                break
+        else:
+            counts[f">{buckets[-1]}"] += 1
+    return counts
+
+
+def summarize(samples: List[float]) -> dict:
+    ordered = sorted(samples)
+    if not ordered:
+        return {"count": 0}
+    return {
+        "count": len(ordered),
+        "min": round(ordered[0], 3),
+        "mean": round(sum(ordered) / len(ordered), 3),
+        "p50": round(percentile(ordered, 50), 3),
+        "p90": round(percentile(ordered, 90), 3),
+        "p99": round(percentile(ordered, 99), 3),
+        "max": round(ordered[-1], 3),
+        "histogram": histogram(ordered),
+    }
@@ -1,88 +1,195 @@
+import argparse
 import asyncio
 import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
 
 import aiortc
-import requests
-from aiosseclient import aiosseclient
 
 import common
-
-
-async def main():
-    username = "polite"
-    peerConnection, dataChannel = initializeBeforeCreatingOffer(username)
+from phasetimer import PhaseTimer
+from signaling import create_signaling
+from statssampler import JsonLinesSink, MetricsSink, StatsSampler
+from synthetic import SyntheticAudioTrack, SyntheticVideoTrack
+from trackconsumer import TrackConsumer
+
+SIGNALING_URL = "http://127.0.0.1:10000"
+
+
+EXECUTORS = {"thread": ThreadPoolExecutor, "process": ProcessPoolExecutor}
+
+
+async def main(username="polite", room="default", transport="sse", timing=None,
+               heartbeat_interval=1.0, heartbeat_misses=3,
+               track_pool="thread", track_workers=2, track_stats=5.0, send_video=None, send_audio=False,
+               stats=None, stats_interval=2.0, stats_metrics=False):
+    # subscribed as username, the server does not send our own messages back
+    signaling = create_signaling(transport, SIGNALING_URL, room, username)
+    trackOptions = {'executor': EXECUTORS[track_pool](max_workers=track_workers),
+                    'onFrame': describeFrame, 'statsInterval': track_stats,
+                    'sendVideo': send_video, 'sendAudio': send_audio}
+    peerConnection, dataChannel = initializeBeforeCreatingOffer(
+        username, PhaseTimer("main", room, username, timing),
+        {'interval': heartbeat_interval, 'misses': heartbeat_misses}, trackOptions)
+    sinks = ([JsonLinesSink(stats)] if stats else []) + ([MetricsSink(SIGNALING_URL, room, username)] if stats_metrics else [])
+    if sinks:
+        peerConnection['stats'] = StatsSampler(peerConnection['obj'], stats_interval, sinks)
+        peerConnection['stats'].start()
 
     async def inner(sessionDescriptionProtocol):
         if (sessionDescriptionProtocol.type == "offer"):
-            await beCallee(sessionDescriptionProtocol, peerConnection, username, dataChannel)
+            await beCallee(sessionDescriptionProtocol, peerConnection, username, signaling, dataChannel)
         else:
             await beCaller(sessionDescriptionProtocol, peerConnection, dataChannel)
 
-    withPerfectNegociationHandler(inner, peerConnection, username, dataChannel)
+    withPerfectNegociationHandler(inner, peerConnection, username, signaling, dataChannel)
     await firstNegotiationNeededEvent(peerConnection, dataChannel)
 
     await asyncio.sleep(100000)
 
-def initializeBeforeCreatingOffer(username):
-    peerConnection = {'obj': None, 'negociate': None}
-    peerConnection['obj'] = initializeRTCPeerConnection(username)
+def initializeBeforeCreatingOffer(username, timer, heartbeatOptions, trackOptions):
+    # pendingCandidates: remote candidates received before the remote description they belong to
+    # timer: when each setup phase happened, see phasetimer.py
+    # recovery: what to do when the connection is lost, see addRecoveryHandler
+    # heartbeat: liveness of the remote peer, see common.Heartbeat. one per RTCPeerConnection
+    # tracks: a TrackConsumer per received track, processing its frames with trackOptions
+    # trackOptions also say which synthetic tracks are sent, see synthetic.py
+    # stats: the StatsSampler of the current RTCPeerConnection, if any
+    peerConnection = {'obj': None, 'negociate': None, 'pendingCandidates': [], 'timer': timer,
+                      'recovery': common.ConnectionRecovery(), 'heartbeat': None,
+                      'heartbeatOptions': heartbeatOptions, 'tracks': [], 'trackOptions': trackOptions,
+                      'stats': None}
+    initializeRTCPeerConnection(peerConnection, username)
+    timer.watch(peerConnection['obj'])
     dataChannel = {'obj': None}
     return peerConnection, dataChannel
 
 
-def initializeRTCPeerConnection(username):
-    peerConnection = aiortc.RTCPeerConnection()
-    common.addConnectionStateHandler(peerConnection, username)
-    @peerConnection.on('track')
+def initializeRTCPeerConnection(peerConnection, username):
+    peerConnectionObj = aiortc.RTCPeerConnection()
+    peerConnection['heartbeat'] = common.Heartbeat(peerConnectionObj, **peerConnection['heartbeatOptions'])
+    common.addConnectionStateHandler(peerConnectionObj, username, peerConnection['recovery'], peerConnection['heartbeat'])
+    @peerConnectionObj.on('track')
     def ontrack(track):
-        print("received track")
-    return peerConnection
+        print("received %s track %s" % (track.kind, track.id))
+        options = peerConnection['trackOptions']
+        consumer = TrackConsumer(track, options['onFrame'], options['executor'])
+        consumer.start()
+        # the consumers of a replaced peer connection end with its tracks
+        peerConnection['tracks'] = [c for c in peerConnection['tracks'] if not c.ended.is_set()] + [consumer]
+        if options['statsInterval']:
+            common.spawn(printTrackStats(consumer, options['statsInterval']))
+    peerConnection['obj'] = peerConnectionObj
+
+
+def addSyntheticTracks(peerConnectionObj, trackOptions, answering=False):
+    """
+    Add the synthetic tracks of trackOptions this RTCPeerConnection does not send yet, new
+    ones: a track feeds a single sender. Returns the kinds left out when answering, aiortc
+    cannot answer with a kind of media the offer does not have.
+    """
+    kinds = (["video"] if trackOptions['sendVideo'] is not None else []) + (["audio"] if trackOptions['sendAudio'] else [])
+    sending = {sender.track.kind for sender in peerConnectionObj.getSenders() if sender.track is not None}
+    offered = {transceiver.kind for transceiver in peerConnectionObj.getTransceivers()}
+    leftOut = []
+    for kind in kinds:
+        if kind in sending:
+            continue
+        if answering and kind not in offered:
+            leftOut.append(kind)
+        elif kind == "video":
+            peerConnectionObj.addTrack(SyntheticVideoTrack(*trackOptions['sendVideo']))
+        else:
+            peerConnectionObj.addTrack(SyntheticAudioTrack())
+    return leftOut
+
+
+def videoFormat(text):
+    # WIDTHxHEIGHT@FPS, the fps being optional
+    size, _, fps = text.lower().partition("@")
+    width, height = size.split("x")
+    return int(width), int(height), float(fps or 30)
+
+
+def describeFrame(array):
+    # the processing of every received frame, run in the track executor: a stand-in for real work
+    return array.shape, float(array.mean())
+
 
+async def printTrackStats(consumer, interval):
+    while not consumer.ended.is_set():
+        try:
+            await asyncio.wait_for(consumer.ended.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        stats = consumer.stats()
+        print("%s track: %d received, %d processed, %d dropped, %.1f/%.1f fps, latency p50 %s p99 %s ms%s" % (
+            stats["kind"], stats["received"], stats["processed"], stats["dropped"],
+            stats["fps_in"], stats["fps_out"], stats["latency_ms"].get("p50"),
+            stats["latency_ms"].get("p99"), ", ended" if stats["ended"] else ""))
 
-async def beCallee(remoteOffer, peerConnection, username, dataChannel):
-    # the callee always expects a new data channel.
+
+async def beCallee(remoteOffer, peerConnection, username, signaling, dataChannel):
+    # the callee always expects a new data channel. listened for before the answer
+    # is sent, the channel can open before sendAnswerSDP returns
+    newDataChannel = common.spawn(waitForDataChannel(peerConnection))
     await receiveOfferSDP(peerConnection, remoteOffer)
-    await sendAnswerSDP(peerConnection, username)
+    leftOut = addSyntheticTracks(peerConnection['obj'], peerConnection['trackOptions'], answering=True)
+    await sendAnswerSDP(peerConnection, username, signaling)
 
     try:
-        # the new datachannel can happen earlier than the call to waitForDataChannel, so this waiting won't catch any event and it can result in timeout
-        dataChannel['obj'] = await waitForDataChannel(peerConnection)
-    except:
-        print("waited too long for data channel. probably it was already received asynchronously")
+        dataChannel['obj'] = await newDataChannel
+    except asyncio.TimeoutError:
+        # a renegotiation adding tracks only brings no new channel
+        print("waited too long for data channel, keeping the current one")
     finally:
         print("Sending message, check the other tab", dataChannel['obj'].readyState)
         dataChannel['obj'].send("World")
         print("finished sending message")
 
+    if leftOut:
+        # offered by us then, as the browser does with its tracks
+        await peerConnection['negociate']()
+
 
 async def receiveOfferSDP(peerConnection, remoteOffer):
-    await peerConnection['obj'].setRemoteDescription(remoteOffer)
+    with peerConnection['timer'].phase("setRemoteDescription"):
+        await peerConnection['obj'].setRemoteDescription(remoteOffer)
+    await addPendingCandidates(peerConnection)
 
 
-async def sendAnswerSDP(peerConnection, username):
-    localAnswer = await peerConnection['obj'].createAnswer()
-    await peerConnection['obj'].setLocalDescription(localAnswer)
-    # no need to wait for all ICE
+async def sendAnswerSDP(peerConnection, username, signaling):
+    timer = peerConnection['timer']
+    with timer.phase("createAnswer"):
+        localAnswer = await peerConnection['obj'].createAnswer()
+    # aiortc gathers all the local candidates inside setLocalDescription, no need to wait for ICE
+    with timer.phase("setLocalDescription"):
+        await peerConnection['obj'].setLocalDescription(localAnswer)
 
     localAnswerWithICECandidates = peerConnection['obj'].localDescription
     localAnswerWithICECandidatesSerializable = {
         "type": localAnswerWithICECandidates.type,
         "sdp": localAnswerWithICECandidates.sdp,
     }
-    requests.post("http://127.0.0.1:10000/sdp", json.dumps({"user": username, "sdp": localAnswerWithICECandidatesSerializable}))
+    with timer.phase("signaling_send"):
+        await signaling.send({"user": username, "sdp": localAnswerWithICECandidatesSerializable})
 
 def waitForDataChannel(peerConnection):
-    async def inner(fulfill):
+    def inner(fulfill):
         peerConnectionObj = peerConnection['obj']
 
         # aiortc.RTCDataChannel
-        @peerConnectionObj.on('datachannel')
         def ondatachannel(channel):
             print("received channel ?")
             channel.add_listener('message', lambda e: print(e))
+            peerConnection['timer'].watch_channel(channel)
 
             fulfill(channel)
-    
+
+        peerConnectionObj.add_listener('datachannel', ondatachannel)
+        return partial(peerConnectionObj.remove_listener, 'datachannel', ondatachannel)
+
     return common.waitForEvent(inner)
 
 async def beCaller(remoteAnswer, peerConnection, dataChannel):
@@ -92,11 +199,27 @@ async def beCaller(remoteAnswer, peerConnection, dataChannel):
 
 async def receiveAnswerSDP(peerConnection, remoteAnswer):
     print("Received answer")
-    spanac = await peerConnection['obj'].setRemoteDescription(remoteAnswer)
+    with peerConnection['timer'].phase("setRemoteDescription"):
+        await peerConnection['obj'].setRemoteDescription(remoteAnswer)
+    await addPendingCandidates(peerConnection)
+
+
+async def receiveCandidate(peerConnection, candidate):
+    # trickled by the browser, they can arrive before the description they belong to
+    candidate = common.candidateFromJSON(candidate)
+    if peerConnection['obj'].remoteDescription is None:
+        peerConnection['pendingCandidates'].append(candidate)
+    else:
+        await peerConnection['obj'].addIceCandidate(candidate)
+
+
+async def addPendingCandidates(peerConnection):
+    pendingCandidates, peerConnection['pendingCandidates'] = peerConnection['pendingCandidates'], []
+    for candidate in pendingCandidates:
+        await peerConnection['obj'].addIceCandidate(candidate)
 
 
 async def sendMessage(dataChannel):
-    await asyncio.sleep(3)
     if (secondOfferIsJustWithVideoTracks(dataChannel)):
         await waitForDataChannelOpen(dataChannel)
     print("Sending message. Check the other tab")
@@ -109,88 +232,134 @@ def secondOfferIsJustWithVideoTracks(dataChannel):
     return dataChannel['obj'] != None and dataChannel['obj'].readyState != "open"
 
 def waitForDataChannelOpen(dataChannel):
-    async def inner(fulfill):
-        dataChannel['obj'].add_listener('open', lambda: fulfill(None))
-    
-    return common.waitForEvent(inner)
+    return common.waitForEmitterEvent(dataChannel['obj'], 'open')
     
-def withPerfectNegociationHandler(user_function, peerConnection, username, dataChannel):
+def withPerfectNegociationHandler(user_function, peerConnection, username, signaling, dataChannel):
     makingOffer = {'obj': False}
+    # set when the last remote offer was ignored, so that its candidates are ignored as well
+    ignoreOffer = {'obj': False}
 
-    addNegociationNeededHandler(peerConnection, makingOffer, username)
+    addNegociationNeededHandler(peerConnection, makingOffer, username, signaling)
+    addRecoveryHandler(peerConnection, makingOffer, username, signaling, dataChannel)
     async def eventSource():
-        events = aiosseclient('http://127.0.0.1:10000/events?channel=testchannel')
-        async for event in events: 
-            message = str(event)
+        # only the events of our own room are streamed
+        async for message in signaling.messages():
             if message:
-                if shouldSkipMessage(message, peerConnection, username, makingOffer):
+                if shouldSkipMessage(message, peerConnection, username, makingOffer, ignoreOffer):
                     continue
 
-                if await peerRefreshedPage(dataChannel) or shouldAcceptOffer(peerConnection, username):
-                    peerConnection['obj'].close()
-                    peerConnection['obj'] = initializeRTCPeerConnection(username)
-                    addNegociationNeededHandler(peerConnection, makingOffer, username)
-                
-                SDP = json.loads(message)['sdp']
+                parsedMessage = json.loads(message)
+                if 'candidate' in parsedMessage:
+                    await receiveCandidate(peerConnection, parsedMessage['candidate'])
+                    continue
+
+                SDP = parsedMessage['sdp']
                 SDP = aiortc.RTCSessionDescription(**SDP)
+                if (peerConnection['heartbeat'].dead or shouldAcceptOffer(peerConnection, username, SDP)
+                        or common.remoteRestarted(peerConnection['obj'], SDP)):
+                    await rebuildRTCPeerConnection(peerConnection, makingOffer, username, signaling)
+
+                peerConnection['timer'].mark(SDP.type + "_received")
                 await user_function(SDP)
-    asyncio.create_task(eventSource())
+    common.spawn(eventSource())
 
 
-def shouldAcceptOffer(peerConnection, username):
-    if username == "polite" and peerConnection['obj'].signalingState == "have-local-offer":
+def shouldAcceptOffer(peerConnection, username, description):
+    # an answer to our own offer after a recovery is not a colliding offer
+    if (username == "polite" and description.type == "offer"
+            and peerConnection['obj'].signalingState == "have-local-offer"):
         return True
     return False
 
-def shouldSkipMessage(data, peerConnection, username, makingOffer):
+def shouldSkipMessage(data, peerConnection, username, makingOffer, ignoreOffer):
     message = json.loads(data)
-    if (messageIsReflected(message, username)):
-        return True
+    if 'candidate' in message:
+        return ignoreOffer['obj']
 
     description = message['sdp']
 
-    if (shouldIgnoreOffer(description, makingOffer, peerConnection, username)):
+    ignoreOffer['obj'] = shouldIgnoreOffer(description, makingOffer, peerConnection, username)
+    if (ignoreOffer['obj']):
         return True
 
     return False
 
 
-def messageIsReflected(message, username):
-    # Because of the chosen simplification, both peers are subscribed to the same channel.
-    # Thus, messages are pushed back to the sender and we want to skip them.
-    return message['user'] == username
-
-
 def shouldIgnoreOffer(description, makingOffer, peerConnection, username):
     offerCollision = (description['type'] == "offer") and (makingOffer['obj'] or peerConnection['obj'].signalingState != "stable")
     shouldIgnore = (username == "impolite") and offerCollision
     return shouldIgnore
 
 
-async def peerRefreshedPage(dataChannel):
-    # aparently the aiortc API is not perfect. it does not detect that the datachannel has been closed
-    try:
-        if dataChannel['obj'] != None and dataChannel['obj'].readyState == "open":
-            print("Aparently the only way to check if the connection is still open is by trying to send a message")
-            dataChannel['obj'].send("test message")
-    except:
+async def rebuildRTCPeerConnection(peerConnection, makingOffer, username, signaling):
+    # the data channels go with the old peer connection, the new one negotiates its own.
+    # replaced before it is closed, so that its closing is not taken for a lost connection
+    oldPeerConnection = peerConnection['obj']
+    initializeRTCPeerConnection(peerConnection, username)
+    rebuilt = peerConnection['obj']
+    await oldPeerConnection.close()
+    peerConnection['pendingCandidates'] = []
+    peerConnection['timer'].watch(rebuilt)
+    if peerConnection['stats'] is not None:
+        peerConnection['stats'].watch(rebuilt)
+    addNegociationNeededHandler(peerConnection, makingOffer, username, signaling)
+    return rebuilt
+
+
+def addRecoveryHandler(peerConnection, makingOffer, username, signaling, dataChannel):
+    recovery = peerConnection['recovery']
+
+    async def restartIce():
+        if not common.supportsIceRestart(peerConnection['obj']):
+            return False
+        # as in browsers, the restart fires negotiationneeded and the new offer carries the new ICE credentials
+        peerConnection['obj'].restartIce()
+        await peerConnection['negociate']()
         return True
-    return False
-
 
-def addNegociationNeededHandler(peerConnection, makingOffer, username):
-    # collectedIce = False # no longer needed since the API automatically gathers them during setLocalDescription
+    async def rebuild():
+        rebuilt = await rebuildRTCPeerConnection(peerConnection, makingOffer, username, signaling)
+        # unless an offer of the remote peer came in meanwhile and replaced it again to answer
+        if peerConnection['obj'] is rebuilt:
+            await firstNegotiationNeededEvent(peerConnection, dataChannel)
+
+    def onLost(state):
+        print(f"connection {state}, recovering")
+        # the recovery gets a record of its own in the --timing file
+        peerConnection['timer'] = peerConnection['timer'].for_recovery(state)
+
+    def onRecovered(method, seconds):
+        print(f"connection recovered by {method} in {seconds * 1000:.0f} ms")
+        timer = peerConnection['timer']
+        timer.recovery["method"] = method
+        timer.mark("recovered")
+        if method != "rebuild":
+            # the data channels were kept, nothing else to wait for
+            timer.finish(completed=True)
+
+    recovery.restartIce = restartIce
+    recovery.rebuild = rebuild
+    recovery.onLost = onLost
+    recovery.onRecovered = onRecovered
+
+
+def addNegociationNeededHandler(peerConnection, makingOffer, username, signaling):
     async def inner():
+        timer = peerConnection['timer']
         makingOffer['obj'] = True
-        await peerConnection['obj'].setLocalDescription(await peerConnection['obj'].createOffer())
-        print("Sleeping in order to gather candidates")
-        await asyncio.sleep(2)
+        addSyntheticTracks(peerConnection['obj'], peerConnection['trackOptions'])
+        with timer.phase("createOffer"):
+            localOffer = await peerConnection['obj'].createOffer()
+        # aiortc gathers all the local candidates inside setLocalDescription, the offer can be sent right away
+        with timer.phase("setLocalDescription"):
+            await peerConnection['obj'].setLocalDescription(localOffer)
         localOfferWithICECandidates = peerConnection['obj'].localDescription
         localOfferWithICECandidatesSerializable = {
             "type": localOfferWithICECandidates.type,
             "sdp": localOfferWithICECandidates.sdp,
         }
-        requests.post("http://127.0.0.1:10000/sdp", json.dumps({"user": username, "sdp": localOfferWithICECandidatesSerializable}))
+        with timer.phase("signaling_send"):
+            await signaling.send({"user": username, "sdp": localOfferWithICECandidatesSerializable})
         makingOffer['obj'] = False
 
     peerConnection['negociate'] = inner
@@ -199,14 +368,51 @@ def addNegociationNeededHandler(peerConnection, makingOffer, username):
 async def firstNegotiationNeededEvent(peerConnection, dataChannel):
     dataChannelObj = peerConnection['obj'].createDataChannel(common.CHAT_CHANNEL)
     dataChannel['obj'] = dataChannelObj
+    peerConnection['timer'].watch_channel(dataChannelObj)
     @dataChannelObj.on('message')
     def onmessage(msg):
         print(msg)
 
     @dataChannelObj.on('close')
-    def onclose(msg):
+    def onclose():
         print("closed dataChannel")
     
     await peerConnection['negociate']()
 
-asyncio.run(main())
\ No newline at end of file
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="aiortc peer using perfect negotiation over the signaling server")
+    ap.add_argument("--user", choices=["polite", "impolite"], default="polite")
+    ap.add_argument("--room", default="default",
+                    help="Signaling room; only peers in the same room see each other")
+    ap.add_argument("--transport", choices=["sse", "ws"], default="sse",
+                    help="sse: POST /sdp and read events/<room>/, ws: one websocket to ws/<room>/ for both")
+    ap.add_argument("--timing", type=Path, default=None,
+                    help="Append the setup phase timings of this peer as a JSON line to this file")
+    ap.add_argument("--heartbeat-interval", type=float, default=1.0,
+                    help="Seconds between two beats on the heartbeat channel (default: 1)")
+    ap.add_argument("--heartbeat-misses", type=int, default=3,
+                    help="Beats missed in a row before the remote peer is declared dead (default: 3)")
+    ap.add_argument("--track-pool", choices=sorted(EXECUTORS), default="thread",
+                    help="Where the frames of received tracks are processed (default: thread)")
+    ap.add_argument("--track-workers", type=int, default=2,
+                    help="Threads or processes of that pool (default: 2)")
+    ap.add_argument("--track-stats", type=float, default=5.0,
+                    help="Seconds between two stats lines per received track, 0 to disable (default: 5)")
+    ap.add_argument("--send-video", type=videoFormat, default=None, metavar="WIDTHxHEIGHT[@FPS]",
+                    help="Send a synthetic video track, e.g. 640x480@30 (default: none)")
+    ap.add_argument("--send-audio", action="store_true", help="Send a synthetic audio track")
+    ap.add_argument("--stats", type=Path, default=None,
+                    help="Append a transport/RTP statistics sample as a JSON line to this file periodically")
+    ap.add_argument("--stats-interval", type=float, default=2.0,
+                    help="Seconds between two statistics samples (default: 2)")
+    ap.add_argument("--stats-metrics", action="store_true",
+                    help="Also post the samples to the signaling server, which serves them on /metrics")
+    return ap.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    asyncio.run(main(args.user, args.room, args.transport, args.timing,
+                     args.heartbeat_interval, args.heartbeat_misses,
+                     args.track_pool, args.track_workers, args.track_stats, args.send_video, args.send_audio,
+                     args.stats, args.stats_interval, args.stats_metrics))
\ No newline at end of file
@@ -3,7 +3,7 @@ import argparse
 import asyncio
 import json
 import os
-import time
+from contextlib import nullcontext
 from pathlib import Path
 from typing import Optional
 
@@ -11,6 +11,10 @@ from aiortc import RTCPeerConnection, RTCSessionDescription
 from aiortc.contrib.signaling import BYE  # just to mirror terminology, not used
 from aiortc.sdp import candidate_from_sdp
 
+import filewatch
+from phasetimer import PhaseTimer
+from statssampler import JsonLinesSink, StatsSampler
+
 # ---------- Tiny “signaling via files” helpers ----------
 
 SIGNAL_DIR = Path(".")
@@ -23,20 +27,18 @@ async def write_json(path: Path, data: dict) -> None:
     tmp.replace(path)
 
 async def wait_for_file(path: Path, timeout: Optional[float] = None, poll=0.2) -> dict:
-    start = time.time()
-    while True:
-        if path.exists():
-            try:
-                return json.loads(path.read_text())
-            finally:
-                # consume once
-                path.unlink(missing_ok=True)
-        await asyncio.sleep(poll)
-        if timeout and (time.time() - start) > timeout:
-            raise TimeoutError(f"Timed out waiting for {path}")
+    # woken by inotify where available, otherwise one shared poller checks every `poll` seconds
+    return await filewatch.wait_for_file(path, timeout, filewatch.get_watcher(poll=poll))
 
 # ---------- WebRTC core ----------
 
+def start_sampler(pc: RTCPeerConnection, stats: Optional[Path], interval: float) -> Optional[StatsSampler]:
+    if not stats:
+        return None
+    sampler = StatsSampler(pc, interval, [JsonLinesSink(stats)])
+    sampler.start()
+    return sampler
+
 def make_pc(ice_server: Optional[str]) -> RTCPeerConnection:
     ice_servers = [{"urls": [ice_server]}] if ice_server else []
     pc = RTCPeerConnection(configuration={"iceServers": ice_servers} if ice_servers else None)
@@ -50,23 +52,34 @@ def negotiated_data_channel(pc: RTCPeerConnection, label="images", id_=0):
     dc = pc.createDataChannel(label, negotiated=True, id=id_)
     return dc
 
-async def gather_and_serialize_local_desc(pc: RTCPeerConnection, desc_type: str) -> dict:
+async def gather_and_serialize_local_desc(pc: RTCPeerConnection, desc_type: str,
+                                          timer: Optional[PhaseTimer] = None) -> dict:
+    phase = timer.phase if timer else (lambda name: nullcontext())
     # Create and set local description
     if desc_type == "offer":
-        await pc.setLocalDescription(await pc.createOffer())
+        with phase("createOffer"):
+            desc = await pc.createOffer()
     elif desc_type == "answer":
-        await pc.setLocalDescription(await pc.createAnswer())
+        with phase("createAnswer"):
+            desc = await pc.createAnswer()
     else:
         raise ValueError("desc_type must be 'offer' or 'answer'")
+    with phase("setLocalDescription"):
+        await pc.setLocalDescription(desc)
 
-    # Let ICE gather for a short moment (non-trickle)
-    await asyncio.sleep(1.0)
+    # aiortc finishes ICE gathering inside setLocalDescription, so the
+    # description already carries every local candidate, no need to wait
     ld = pc.localDescription
     return {"type": ld.type, "sdp": ld.sdp}
 
-async def run_caller(stun_url: Optional[str], file_to_send: Optional[Path]):
+async def run_caller(stun_url: Optional[str], file_to_send: Optional[Path], timing: Optional[Path] = None,
+                     stats: Optional[Path] = None, stats_interval: float = 2.0):
     pc = make_pc(stun_url)
     dc = negotiated_data_channel(pc, label="images", id_=0)
+    sampler = start_sampler(pc, stats, stats_interval)
+    timer = PhaseTimer("main_gpt", "offer.json", "caller", timing)
+    timer.watch(pc)
+    timer.watch_channel(dc)
 
     @dc.on("open")
     def _on_open():
@@ -85,23 +98,34 @@ async def run_caller(stun_url: Optional[str], file_to_send: Optional[Path]):
             print(f"[caller] received: {msg}")
 
     # Create offer, write to file
-    local_offer = await gather_and_serialize_local_desc(pc, "offer")
-    await write_json(OFFER_FILE, {"sdp": local_offer})
+    local_offer = await gather_and_serialize_local_desc(pc, "offer", timer)
+    with timer.phase("signaling_send"):
+        await write_json(OFFER_FILE, {"sdp": local_offer})
     print("[caller] wrote offer.json; waiting for answer.json ...")
 
     # Wait for answer, apply
-    ans = await wait_for_file(ANSWER_FILE, timeout=60)
+    with timer.phase("signaling_wait"):
+        ans = await wait_for_file(ANSWER_FILE, timeout=60)
     remote = RTCSessionDescription(**ans["sdp"])
-    await pc.setRemoteDescription(remote)
+    with timer.phase("setRemoteDescription"):
+        await pc.setRemoteDescription(remote)
     print("[caller] setRemoteDescription(answer) ✓")
 
     # Keep alive long enough for demo traffic
     await asyncio.sleep(10)
+    timer.finish()
+    if sampler:
+        await sampler.stop()
     await pc.close()
 
-async def run_callee(stun_url: Optional[str]):
+async def run_callee(stun_url: Optional[str], timing: Optional[Path] = None,
+                     stats: Optional[Path] = None, stats_interval: float = 2.0):
     pc = make_pc(stun_url)
     dc = negotiated_data_channel(pc, label="images", id_=0)
+    sampler = start_sampler(pc, stats, stats_interval)
+    timer = PhaseTimer("main_gpt", "offer.json", "callee", timing)
+    timer.watch(pc)
+    timer.watch_channel(dc)
 
     @dc.on("open")
     def _on_open():
@@ -117,18 +141,24 @@ async def run_callee(stun_url: Optional[str]):
 
     # Wait for offer, apply
     print("[callee] waiting for offer.json ...")
-    off = await wait_for_file(OFFER_FILE, timeout=60)
+    with timer.phase("signaling_wait"):
+        off = await wait_for_file(OFFER_FILE, timeout=60)
     remote = RTCSessionDescription(**off["sdp"])
-    await pc.setRemoteDescription(remote)
+    with timer.phase("setRemoteDescription"):
+        await pc.setRemoteDescription(remote)
     print("[callee] setRemoteDescription(offer) ✓")
 
     # Create answer, write to file
-    local_answer = await gather_and_serialize_local_desc(pc, "answer")
-    await write_json(ANSWER_FILE, {"sdp": local_answer})
+    local_answer = await gather_and_serialize_local_desc(pc, "answer", timer)
+    with timer.phase("signaling_send"):
+        await write_json(ANSWER_FILE, {"sdp": local_answer})
     print("[callee] wrote answer.json")
 
     # Keep alive long enough for demo traffic
     await asyncio.sleep(10)
+    timer.finish()
+    if sampler:
+        await sampler.stop()
     await pc.close()
 
 def parse_args():
@@ -139,6 +169,12 @@ def parse_args():
                     help="Optional STUN URL, e.g. stun:stun.l.google.com:19302")
     ap.add_argument("--send", type=Path, default=None,
                     help="Caller: optional path to a file (e.g., jpg) to send as bytes")
+    ap.add_argument("--timing", type=Path, default=None,
+                    help="Append the setup phase timings of this peer as a JSON line to this file")
+    ap.add_argument("--stats", type=Path, default=None,
+                    help="Append a transport/SCTP statistics sample as a JSON line to this file periodically")
+    ap.add_argument("--stats-interval", type=float, default=2.0,
+                    help="Seconds between two statistics samples (default: 2)")
     return ap.parse_args()
 
 if __name__ == "__main__":
@@ -150,5 +186,5 @@ if __name__ == "__main__":
         # let callee consume the offer, so ensure stale answer is gone
         OFFER_FILE.unlink(missing_ok=True)
 
-    asyncio.run(run_caller(args.stun, args.send) if args.role == "caller"
-                else run_callee(args.stun))
+    asyncio.run(run_caller(args.stun, args.send, args.timing, args.stats, args.stats_interval) if args.role == "caller"
+                else run_callee(args.stun, args.timing, args.stats, args.stats_interval))
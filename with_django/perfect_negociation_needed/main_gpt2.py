@@ -4,15 +4,30 @@ import asyncio
 import json
 import os
 import time
+from contextlib import nullcontext
 from pathlib import Path
 from typing import Optional
 
 from aiortc import RTCPeerConnection, RTCSessionDescription
 
+import filewatch
+from channelpool import ChannelPool, ChannelSpec
+from filetransfer import FileReceiver, print_progress, send_file
+from latency import summarize
+from phasetimer import PhaseTimer
+from statssampler import JsonLinesSink, StatsSampler
+
 # ----------------- Settings -----------------
-MAX_EXCHANGES = 5           # number of ping/pong pairs
-CHANNEL_LABEL = "images"    # negotiated channel label
-CHANNEL_ID = 0              # negotiated channel id
+MAX_EXCHANGES = 5           # default number of ping/pong pairs
+IDLE_TIMEOUT = 20           # seconds without any message before giving up, plus --interval
+CHANNEL_LABEL = "images"    # bulk channel: file chunks and bye, reliable and ordered
+CHANNEL_ID = 0
+CONTROL_LABEL = "control"   # hello and ping/pong, unordered and ahead of the bulk bytes
+CONTROL_ID = 1
+CHANNELS = (
+    ChannelSpec(CHANNEL_LABEL, CHANNEL_ID),
+    ChannelSpec(CONTROL_LABEL, CONTROL_ID, ordered=False, priority=1),
+)
 
 # ----------------- Session file helpers -----------------
 def session_paths(session: str):
@@ -29,20 +44,8 @@ async def write_json(path: Path, data: dict) -> None:
     tmp.replace(path)
 
 async def wait_for_file(path: Path, timeout: Optional[float] = None, poll=0.2) -> dict:
-    start = time.time()
-    last_err = None
-    while True:
-        if path.exists():
-            try:
-                text = path.read_text()
-                data = json.loads(text)
-                path.unlink(missing_ok=True)  # consume once
-                return data
-            except Exception as e:
-                last_err = e
-        await asyncio.sleep(poll)
-        if timeout and (time.time() - start) > timeout:
-            raise TimeoutError(f"Timed out waiting for {path} (last_err={last_err})")
+    # woken by inotify where available, otherwise one shared poller checks every `poll` seconds
+    return await filewatch.wait_for_file(path, timeout, filewatch.get_watcher(poll=poll))
 
 def elect_initiator(lock_path: Path) -> bool:
     try:
@@ -59,23 +62,31 @@ def make_pc(stun_url: Optional[str]) -> RTCPeerConnection:
     cfg = {"iceServers": ice} if ice else None
     return RTCPeerConnection(configuration=cfg)
 
-def negotiated_dc(pc: RTCPeerConnection, label=CHANNEL_LABEL, id_=CHANNEL_ID):
-    return pc.createDataChannel(label, negotiated=True, id=id_)
+def negotiated_channels(pc: RTCPeerConnection, specs=CHANNELS) -> ChannelPool:
+    return ChannelPool(pc, specs)
 
-async def gather_local_desc(pc: RTCPeerConnection, kind: str) -> dict:
+async def gather_local_desc(pc: RTCPeerConnection, kind: str, timer: Optional[PhaseTimer] = None) -> dict:
+    phase = timer.phase if timer else (lambda name: nullcontext())
     if kind == "offer":
-        await pc.setLocalDescription(await pc.createOffer())
+        with phase("createOffer"):
+            desc = await pc.createOffer()
     elif kind == "answer":
-        await pc.setLocalDescription(await pc.createAnswer())
+        with phase("createAnswer"):
+            desc = await pc.createAnswer()
     else:
         raise ValueError("kind must be 'offer' or 'answer'")
-    # short non-trickle wait to collect some ICE candidates
-    await asyncio.sleep(1.0)
+    # aiortc finishes ICE gathering inside setLocalDescription, so the
+    # description already carries every local candidate, no need to wait
+    with phase("setLocalDescription"):
+        await pc.setLocalDescription(desc)
     ld = pc.localDescription
     return {"type": ld.type, "sdp": ld.sdp}
 
 # ----------------- App logic -----------------
-async def run(session: str, stun_url: Optional[str], file_to_send: Optional[Path]):
+async def run(session: str, stun_url: Optional[str], file_to_send: Optional[Path],
+              recv_dir: Path = Path("received"), count: int = MAX_EXCHANGES,
+              interval: float = 0.0, report_path: Optional[Path] = None, timing: Optional[Path] = None,
+              stats: Optional[Path] = None, stats_interval: float = 2.0):
     paths = session_paths(session)
 
     is_initiator = elect_initiator(paths["lock"])
@@ -88,52 +99,109 @@ async def run(session: str, stun_url: Optional[str], file_to_send: Optional[Path
         paths["offer"].unlink(missing_ok=True)
         paths["answer"].unlink(missing_ok=True)
 
-    # Build peer + channel
+    # Build peer + channels
     pc = make_pc(stun_url)
-    dc = negotiated_dc(pc)
+    channels = negotiated_channels(pc)
+    dc, control = channels[CHANNEL_LABEL], channels[CONTROL_LABEL]
+    timer = PhaseTimer("main_gpt2", session, role, timing)
+    timer.watch(pc)
+    timer.watch_channel(control)
+    sampler = StatsSampler(pc, stats_interval, [JsonLinesSink(stats)]) if stats else None
+    if sampler:
+        sampler.start()
 
     # state for ping/pong
     state = {
         "seq": 0,                    # last ping sent by initiator
         "exchanges": 0,              # completed ping→pong pairs
-        "closed": False
+        "rtts": [],                  # ms, one per completed exchange
+        "closed": False,
+        "last_activity": time.monotonic(),  # a transfer in progress keeps the peer alive
+        "transfer": None,            # the file being sent, alongside the pings
     }
 
+    closed = asyncio.Event()
+    report = print_progress(role)
+
+    def progress(name, done, total):
+        state["last_activity"] = time.monotonic()
+        report(name, done, total)
+
+    receiver = FileReceiver(recv_dir, progress)
+
+    def write_report():
+        report = {
+            "session": session,
+            "run": run_id,
+            "pings": state["seq"],
+            "requested": count,
+            "interval_s": interval,
+            "lost": state["seq"] - state["exchanges"],
+            "rtt_ms": summarize(state["rtts"]),
+        }
+        report_path.write_text(json.dumps(report, indent=2))
+        print(f"[{role}] wrote {report_path}")
+
     async def graceful_close():
         if not state["closed"]:
             state["closed"] = True
+            if is_initiator and report_path:
+                write_report()
+            timer.finish()
+            if sampler:
+                await sampler.stop()
             # give a moment for any final console output
             await asyncio.sleep(0.3)
             await pc.close()
             if is_initiator:
                 paths["lock"].unlink(missing_ok=True)
             print(f"[{role}] closed")
+            closed.set()
 
-    def send_json(obj: dict):
-        if dc.readyState == "open":
-            dc.send(json.dumps(obj))
+    def send_json(obj: dict, channel=control):
+        if channel.readyState == "open":
+            channel.send(json.dumps(obj))
 
-    @dc.on("open")
+    @control.on("open")
     def _on_open():
-        print(f"[{role}] datachannel open")
+        print(f"[{role}] datachannels open")
         # greet
         send_json({"type": "hello", "role": role, "run": run_id})
-        # initiator sends an optional file then starts ping/pong
+        # initiator streams an optional file while it runs the ping/pong
         if is_initiator:
             if file_to_send and file_to_send.exists():
-                payload = file_to_send.read_bytes()
-                print(f"[{role}] sending {file_to_send.name} ({len(payload)} bytes)")
-                dc.send(payload)
-            # start ping/pong
-            state["seq"] = 1
-            print(f"[{role}] -> ping {state['seq']}")
-            send_json({"type": "ping", "seq": state["seq"]})
-
-    @dc.on("message")
+                state["transfer"] = asyncio.ensure_future(transfer())
+            send_ping()
+
+    async def transfer():
+        print(f"[{role}] sending {file_to_send.name} ({file_to_send.stat().st_size} bytes)")
+        try:
+            await send_file(dc, file_to_send, progress=progress, writable=channels.writer(CHANNEL_LABEL))
+        except ConnectionError as e:
+            print(f"[{role}] transfer aborted: {e}")
+
+    async def say_bye():
+        if state["transfer"]:
+            await state["transfer"]
+        # on the bulk channel, so that it cannot overtake the end of the file
+        send_json({"type": "bye"}, dc)
+        # close after a short delay to flush outbound
+        await graceful_close()
+
+    def send_ping():
+        state["seq"] += 1
+        print(f"[{role}] -> ping {state['seq']}")
+        # the responder echoes t back, so only our own monotonic clock is involved
+        send_json({"type": "ping", "seq": state["seq"], "t": time.monotonic()})
+
     def _on_message(msg):
-        # binary payload (e.g., image bytes)
+        state["last_activity"] = time.monotonic()
+        # binary payload: a chunk of the file being received
         if isinstance(msg, bytes):
-            print(f"[{role}] received {len(msg)} bytes")
+            try:
+                receiver.write_chunk(msg)
+            except ValueError as e:
+                print(f"[{role}] dropped chunk: {e}")
             return
 
         # textual JSON control messages
@@ -144,80 +212,133 @@ async def run(session: str, stun_url: Optional[str], file_to_send: Optional[Path
             return
 
         typ = obj.get("type")
-        if typ == "hello":
+        if typ == "file":
+            print(f"[{role}] receiving {obj.get('name')} ({obj.get('size')} bytes) into {recv_dir}/")
+            try:
+                receiver.start(obj)
+            except ValueError as e:
+                print(f"[{role}] transfer refused: {e}")
+        elif typ == "file-end":
+            try:
+                print(f"[{role}] saved {receiver.finish(obj)}")
+            except (OSError, ValueError) as e:
+                print(f"[{role}] transfer failed: {e}")
+        elif typ == "hello":
             print(f"[{role}] received hello from {obj.get('role')}, run={obj.get('run')}")
         elif typ == "ping":
             seq = obj.get("seq")
             print(f"[{role}] <- ping {seq}")
             # respond with pong
-            send_json({"type": "pong", "seq": seq})
+            send_json({"type": "pong", "seq": seq, "t": obj.get("t")})
             print(f"[{role}] -> pong {seq}")
         elif typ == "pong":
             seq = obj.get("seq")
-            print(f"[{role}] <- pong {seq}")
             if is_initiator:
+                sent = obj.get("t")
+                if not isinstance(sent, (int, float)):
+                    print(f"[{role}] <- pong {seq} without a send time, ignored")
+                    return
                 # one exchange completed
+                rtt = (time.monotonic() - sent) * 1000
+                state["rtts"].append(rtt)
+                print(f"[{role}] <- pong {seq} rtt={rtt:.3f} ms")
                 state["exchanges"] += 1
-                if state["exchanges"] >= MAX_EXCHANGES:
+                if state["exchanges"] >= count:
                     print(f"[{role}] exchanges done ({state['exchanges']}). Sending bye.")
-                    send_json({"type": "bye"})
-                    # close after a short delay to flush outbound
-                    asyncio.create_task(graceful_close())
+                    asyncio.ensure_future(say_bye())
+                elif interval:
+                    asyncio.get_running_loop().call_later(interval, send_ping)
                 else:
-                    # send next ping
-                    state["seq"] += 1
-                    print(f"[{role}] -> ping {state['seq']}")
-                    send_json({"type": "ping", "seq": state["seq"]})
+                    send_ping()
+            else:
+                print(f"[{role}] <- pong {seq}")
         elif typ == "bye":
             print(f"[{role}] received bye; closing.")
             asyncio.create_task(graceful_close())
         else:
             print(f"[{role}] received: {obj}")
 
+    for channel in channels:
+        channel.on("message", _on_message)
+
     try:
         if is_initiator:
-            local_offer = await gather_local_desc(pc, "offer")
-            await write_json(paths["offer"], {"sdp": local_offer, "run": run_id})
+            local_offer = await gather_local_desc(pc, "offer", timer)
+            with timer.phase("signaling_send"):
+                await write_json(paths["offer"], {"sdp": local_offer, "run": run_id})
             print(f"[{role}] wrote {paths['offer'].name}; waiting for {paths['answer'].name} ...")
 
-            ans = await wait_for_file(paths["answer"], timeout=90)
+            with timer.phase("signaling_wait"):
+                ans = await wait_for_file(paths["answer"], timeout=90)
             if ans.get("run") != run_id:
                 raise RuntimeError("Stale/mismatched answer detected")
-            await pc.setRemoteDescription(RTCSessionDescription(**ans["sdp"]))
+            with timer.phase("setRemoteDescription"):
+                await pc.setRemoteDescription(RTCSessionDescription(**ans["sdp"]))
             print(f"[{role}] setRemoteDescription(answer) ✓")
 
         else:
             print(f"[{role}] waiting for {paths['offer'].name} ...")
-            off = await wait_for_file(paths["offer"], timeout=90)
-            await pc.setRemoteDescription(RTCSessionDescription(**off["sdp"]))
+            with timer.phase("signaling_wait"):
+                off = await wait_for_file(paths["offer"], timeout=90)
+            with timer.phase("setRemoteDescription"):
+                await pc.setRemoteDescription(RTCSessionDescription(**off["sdp"]))
             print(f"[{role}] setRemoteDescription(offer) ✓")
 
-            local_answer = await gather_local_desc(pc, "answer")
-            await write_json(paths["answer"], {"sdp": local_answer, "run": off.get("run")})
+            local_answer = await gather_local_desc(pc, "answer", timer)
+            with timer.phase("signaling_send"):
+                await write_json(paths["answer"], {"sdp": local_answer, "run": off.get("run")})
             print(f"[{role}] wrote {paths['answer'].name}")
 
-        # Keep the process alive long enough for pings/pongs (or earlier close)
-        # If nothing happens (e.g., channel never opens), we time out.
+        # Keep the process alive long enough for the transfer and pings/pongs (or earlier close)
+        # If nothing happens for IDLE_TIMEOUT s (e.g., channel never opens), we time out.
+        # the pings of a slow --interval are quiet that long by design
+        idle_timeout = IDLE_TIMEOUT + interval
         try:
-            await asyncio.sleep(20)
+            while not closed.is_set():
+                idle = time.monotonic() - state["last_activity"]
+                if idle >= idle_timeout:
+                    break
+                try:
+                    await asyncio.wait_for(closed.wait(), idle_timeout - idle)
+                except asyncio.TimeoutError:
+                    pass
         finally:
+            receiver.abort()
             await graceful_close()
 
     except Exception as e:
         print(f"[{role}] error: {e}")
         await graceful_close()
 
+    # for the callers running many sessions, e.g. shard.py
+    return {"session": session, "role": role, "exchanges": state["exchanges"], "rtts": state["rtts"]}
+
 # ----------------- CLI -----------------
 def parse_args():
     ap = argparse.ArgumentParser(description="Role-less WebRTC (file signaling) with ping/pong")
     ap.add_argument("--stun", default=None,
                     help="Optional STUN URL, e.g. stun:stun.l.google.com:19302")
     ap.add_argument("--send", type=Path, default=None,
-                    help="Optional path to a file to send (initiator only)")
+                    help="Optional path to a file to stream alongside the pings (initiator only)")
+    ap.add_argument("--recv-dir", type=Path, default=Path("received"),
+                    help="Where received files are written (default: ./received)")
     ap.add_argument("--session", default="session",
                     help="Session namespace (default: 'session')")
+    ap.add_argument("--count", type=int, default=MAX_EXCHANGES,
+                    help=f"Number of ping/pong exchanges (default: {MAX_EXCHANGES})")
+    ap.add_argument("--interval", type=float, default=0.0,
+                    help="Seconds between a pong and the next ping, added to the 20 s idle timeout (default: 0, back to back)")
+    ap.add_argument("--report", type=Path, default=None,
+                    help="Write the RTT report (percentiles, histogram) as JSON here (initiator only)")
+    ap.add_argument("--timing", type=Path, default=None,
+                    help="Append the setup phase timings of this peer as a JSON line to this file")
+    ap.add_argument("--stats", type=Path, default=None,
+                    help="Append a transport/SCTP statistics sample as a JSON line to this file periodically")
+    ap.add_argument("--stats-interval", type=float, default=2.0,
+                    help="Seconds between two statistics samples (default: 2)")
     return ap.parse_args()
 
 if __name__ == "__main__":
     args = parse_args()
-    asyncio.run(run(args.session, args.stun, args.send))
+    asyncio.run(run(args.session, args.stun, args.send, args.recv_dir,
+                    args.count, args.interval, args.report, args.timing, args.stats, args.stats_interval))
@@ -0,0 +1,218 @@
+"""
+Room messages relayed between the worker processes of the signaling server.
+
+django_eventstream and the websocket consumers only reach the subscribers
+connected to their own process. With more than one ASGI worker, every worker
+connects to a broker, a small process listening on a Unix domain socket, and
+rooms.publish() hands each message to it once, next to delivering it to its
+own subscribers. The broker forwards the message to the other workers that
+have subscribers in the room, which deliver it to theirs (rooms.relay).
+
+    python -m mainapp.broker /tmp/signal-broker.sock
+    SIGNAL_BROKER=/tmp/signal-broker.sock python manage.py runserver ...
+
+Every frame on the socket is a 4 byte big endian length then the frame:
+- b'S' room: the worker has subscribers in the room
+- b'U' room: it has none left
+- b'P' room b'\\n' message: a message published in the room, as encoded JSON
+
+The broker keeps nothing. A worker that lost its connection reconnects and
+subscribes again, the messages published meanwhile are not relayed to it.
+A worker that does not read what is relayed to it fast enough loses its
+connection the same way, rather than the broker buffering for it without end.
+"""
+import argparse
+import asyncio
+import os
+import signal
+import threading
+import time
+
+# seconds between two attempts of a worker to reach the broker
+RECONNECT_DELAY = 1.0
+# bytes relayed to a worker and not written to its socket yet before the broker drops it
+MAX_BUFFERED = 4 * 1024 * 1024
+
+
+def frame(payload):
+    return len(payload).to_bytes(4, 'big') + payload
+
+
+class FrameProtocol(asyncio.Protocol):
+    def __init__(self):
+        self.transport = None
+        self.buffer = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        while len(self.buffer) >= 4:
+            end = 4 + int.from_bytes(self.buffer[:4], 'big')
+            if len(self.buffer) < end:
+                break
+            payload = bytes(self.buffer[4:end])
+            del self.buffer[:end]
+            self.frame_received(payload)
+
+    def frame_received(self, payload):
+        raise NotImplementedError()
+
+
+class Broker:
+    def __init__(self):
+        # room -> connections of the workers that have subscribers in it
+        self.subscribers = {}
+        self.published = 0
+        self.forwarded = 0
+        self.dropped = 0
+
+    async def serve(self, path):
+        if os.path.exists(path):
+            try:
+                _, writer = await asyncio.open_unix_connection(path)
+            except OSError:
+                # left behind by a broker that did not stop cleanly
+                os.unlink(path)
+            else:
+                writer.close()
+                raise RuntimeError('a broker is already listening on %s' % path)
+        loop = asyncio.get_running_loop()
+        server = await loop.create_unix_server(lambda: BrokerConnection(self), path)
+        # stopped like the workers, the socket goes with it
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            os.unlink(path)
+
+
+class BrokerConnection(FrameProtocol):
+    def __init__(self, broker):
+        super().__init__()
+        self.broker = broker
+        self.rooms = set()
+
+    def frame_received(self, payload):
+        op = payload[:1]
+        if op == b'P':
+            room = payload[1:payload.index(b'\n')]
+            data = frame(payload)
+            self.broker.published += 1
+            for connection in list(self.broker.subscribers.get(room, ())):
+                # the publisher already delivered it to its own subscribers
+                if connection is self:
+                    continue
+                if connection.transport.get_write_buffer_size() > MAX_BUFFERED:
+                    connection.drop()
+                else:
+                    connection.transport.write(data)
+                    self.broker.forwarded += 1
+        elif op == b'S':
+            room = payload[1:]
+            self.rooms.add(room)
+            self.broker.subscribers.setdefault(room, set()).add(self)
+        elif op == b'U':
+            self.unsubscribe(payload[1:])
+
+    def unsubscribe(self, room):
+        self.rooms.discard(room)
+        connections = self.broker.subscribers.get(room)
+        if connections is not None:
+            connections.discard(self)
+            if not connections:
+                del self.broker.subscribers[room]
+
+    def drop(self):
+        """Disconnect a worker that stopped reading, it reconnects and subscribes again."""
+        self.broker.dropped += 1
+        self.connection_lost(None)
+        self.transport.abort()
+
+    def connection_lost(self, exc):
+        for room in list(self.rooms):
+            self.unsubscribe(room)
+
+
+class BrokerLink(FrameProtocol):
+    """
+    The connection of a worker to the broker. `relay(room, encoded)` is called
+    with the messages the other workers publish in the rooms subscribed to.
+    subscribe() and unsubscribe() can be called from any thread, the others
+    from the event loop of the worker only.
+    """
+
+    def __init__(self, path, relay):
+        super().__init__()
+        self.path = path
+        self.relay = relay
+        self.loop = None
+        self.lock = threading.Lock()
+        # room -> time of its last subscribe, sent again on every reconnect
+        self.rooms = {}
+
+    def start(self):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+            self.loop.create_task(self._connect())
+
+    async def _connect(self):
+        while True:
+            try:
+                await self.loop.create_unix_connection(lambda: self, self.path)
+                return
+            except OSError:
+                await asyncio.sleep(RECONNECT_DELAY)
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        with self.lock:
+            rooms = list(self.rooms)
+        transport.writelines(frame(b'S' + room.encode()) for room in rooms)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.buffer.clear()
+        self.loop.create_task(self._connect())
+
+    def subscribe(self, room):
+        with self.lock:
+            known = room in self.rooms
+            self.rooms[room] = time.monotonic()
+        if not known and self.loop is not None:
+            self.loop.call_soon_threadsafe(self._send, b'S' + room.encode())
+
+    def unsubscribe(self, room, unless_since=None):
+        """Forget the room, unless it was subscribed to again after `unless_since`."""
+        with self.lock:
+            subscribed = self.rooms.get(room)
+            if subscribed is None or (unless_since is not None and subscribed > unless_since):
+                return
+            del self.rooms[room]
+        self.loop.call_soon_threadsafe(self._send, b'U' + room.encode())
+
+    def publish(self, room, encoded):
+        self._send(b'P' + room.encode() + b'\n' + encoded.encode())
+
+    def _send(self, payload):
+        if self.transport is not None:
+            self.transport.write(frame(payload))
+
+    def frame_received(self, payload):
+        room, _, encoded = payload[1:].partition(b'\n')
+        self.relay(room.decode(), encoded.decode())
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Relay the room messages between the workers of the signaling server")
+    ap.add_argument("path", help="Unix socket to listen on, the SIGNAL_BROKER of the workers")
+    return ap.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    try:
+        asyncio.run(Broker().serve(args.path))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
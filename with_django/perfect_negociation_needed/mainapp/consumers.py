@@ -0,0 +1,40 @@
+from urllib.parse import parse_qs
+
+from channels.generic.websocket import AsyncWebsocketConsumer
+
+from . import rooms
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    # orjson is optional, the stdlib codec gives the same result, only slower
+    from json import loads as json_loads
+
+
+class SignalingConsumer(AsyncWebsocketConsumer):
+    """
+    One persistent connection per peer, carrying offers, answers and candidates
+    both ways. The client sends the same messages it would POST to /sdp, minus
+    the room which is taken from the URL, and receives what the SSE stream of
+    the room would deliver. With ws/<room>/?user=<user>, the messages of that
+    user are not sent back to it.
+    """
+
+    async def connect(self):
+        self.room = self.scope['url_route']['kwargs']['room']
+        self.user = parse_qs(self.scope['query_string'].decode()).get('user', [None])[0]
+        rooms.subscribe(self.room, self)
+        await self.accept()
+
+    async def disconnect(self, code):
+        rooms.unsubscribe(self.room, self)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        encoded = text_data if text_data is not None else bytes_data.decode()
+        try:
+            message = json_loads(encoded)
+        except ValueError:
+            return
+        if not isinstance(message, dict):
+            return
+        await rooms.publish(self.room, message, encoded)
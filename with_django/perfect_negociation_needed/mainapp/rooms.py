@@ -0,0 +1,179 @@
+"""
+Fan-out of signaling messages to the subscribers of a room.
+
+A room is reached over two transports:
+- SSE, events/<room>/ streamed by django_eventstream, messages posted to /sdp
+- WebSocket, ws/<room>/ served by consumers.SignalingConsumer, both directions
+
+Whatever transport a message comes in on, publish() delivers it to the
+subscribers of both.
+
+A subscriber can say who it is, events/<room>/<user>/ or ws/<room>/?user=<user>,
+and is then never sent back the messages it posts itself (the 'user' of the
+message). Subscribers that do not say get everything, their own messages included.
+
+With SIGNAL_BROKER set, the server can run as several worker processes: each
+message is also published once to the broker, which relays it to the other
+workers that have subscribers in the room, see broker.py.
+"""
+import asyncio
+import re
+import threading
+import time
+
+from django.conf import settings
+from django_eventstream import send_event
+from django_eventstream.channelmanager import DefaultChannelManager
+from django_eventstream.consumers import get_listener_manager
+
+from . import metrics
+from .broker import BrokerLink
+
+try:
+    from orjson import loads as json_loads, dumps as json_dumps
+except ImportError:
+    # orjson is optional, the stdlib codec gives the same result, only slower
+    import json
+    from json import loads as json_loads
+
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+DEFAULT_ROOM = "default"
+ROOM_PATTERN = re.compile(r'^[-a-zA-Z0-9_]{1,64}$')
+
+# room -> websocket consumers of that room. the SSE subscribers are tracked by django_eventstream
+websocket_subscribers = {}
+# room -> {user: time of its last connect} of the SSE subscribers that said who they are.
+# written by the thread pool (get_channels_for_request) and the event loop (deliver), under sse_users_lock
+sse_users = {}
+sse_users_lock = threading.Lock()
+# seconds a user without a live SSE stream stays listed, covering its reconnects
+SSE_USER_LINGER = 60
+# seconds a room stays subscribed to on the broker after its last subscriber came,
+# an SSE stream is only listed by django_eventstream some time after it was requested
+BROKER_LINGER = 10
+# websocket sends of the relayed messages, held until done: the event loop only keeps weak references
+relaying = set()
+
+
+def room_channel(room):
+    # must match the 'format-channels' of the events/<room>/ routes in urls.py and asgi.py
+    return 'room-%s' % room
+
+
+def user_channel(room, user):
+    # must match the 'format-channels' of the events/<room>/<user>/ routes. '.' is not a slug
+    # character, so no room/user pair can produce the channel of another
+    return 'room-%s.%s' % (room, user)
+
+
+def get_room(request_body):
+    room = request_body.get('room', DEFAULT_ROOM)
+    if not isinstance(room, str) or not ROOM_PATTERN.match(room):
+        return None
+    return room
+
+
+class RoomChannelManager(DefaultChannelManager):
+    """Notes which users have an SSE stream open in which room, publish() needs them."""
+
+    def get_channels_for_request(self, request, view_kwargs):
+        if 'user' in view_kwargs:
+            with sse_users_lock:
+                sse_users.setdefault(view_kwargs['room'], {})[view_kwargs['user']] = time.monotonic()
+        if broker is not None:
+            # called in a thread of the pool, the link passes it on to the event loop
+            broker.subscribe(view_kwargs['room'])
+        return super().get_channels_for_request(request, view_kwargs)
+
+
+def subscribe(room, consumer):
+    websocket_subscribers.setdefault(room, set()).add(consumer)
+    if broker is not None:
+        broker.subscribe(room)
+
+
+def unsubscribe(room, consumer):
+    consumers = websocket_subscribers.get(room)
+    if consumers is not None:
+        consumers.discard(consumer)
+        if not consumers:
+            del websocket_subscribers[room]
+
+
+async def publish(room, message, encoded=None):
+    """
+    Deliver `message` to every subscriber of `room` but its sender.
+    `encoded` is the message as received, if the caller still has it, so that
+    websocket subscribers get it relayed as is instead of encoded again.
+    """
+    with metrics.fanout():
+        if broker is not None:
+            if encoded is None:
+                encoded = json_dumps(message).decode()
+            broker.publish(room, encoded)
+        recipients = deliver(room, message)
+        if recipients:
+            if encoded is None:
+                encoded = json_dumps(message).decode()
+            await send_all(recipients, encoded)
+
+
+def relay(room, encoded):
+    """Deliver a message published on another worker, called by the broker link."""
+    metrics.BROKER_RELAYED.inc()
+    with metrics.FANOUT_SECONDS.time():
+        message = json_loads(encoded)
+        if not has_subscribers(room):
+            # the broker is told late, the few messages relayed meanwhile are dropped here
+            broker.unsubscribe(room, unless_since=time.monotonic() - BROKER_LINGER)
+            return
+        recipients = deliver(room, message)
+        if recipients:
+            task = asyncio.ensure_future(send_all(recipients, encoded))
+            relaying.add(task)
+            task.add_done_callback(relaying.discard)
+
+
+def deliver(room, message):
+    """Hand `message` to the SSE subscribers of `room`, and return the websocket ones it is for."""
+    sender = message.get('user')
+    listeners = get_listener_manager().listeners_by_channel
+    if room_channel(room) in listeners:
+        send_event(room_channel(room), 'message', message)
+    channels = []
+    with sse_users_lock:
+        users = sse_users.get(room)
+        if users:
+            now = time.monotonic()
+            for user, connected in list(users.items()):
+                if user == sender:
+                    continue
+                if user_channel(room, user) in listeners:
+                    channels.append(user_channel(room, user))
+                elif now - connected > SSE_USER_LINGER:
+                    del users[user]
+            if not users:
+                del sse_users[room]
+    for channel in channels:
+        send_event(channel, 'message', message)
+
+    consumers = websocket_subscribers.get(room)
+    if not consumers:
+        return []
+    return [consumer for consumer in consumers if consumer.user is None or consumer.user != sender]
+
+
+async def send_all(consumers, encoded):
+    await asyncio.gather(*(consumer.send(text_data=encoded) for consumer in consumers),
+                         return_exceptions=True)
+
+
+def has_subscribers(room):
+    if room in websocket_subscribers or room in sse_users:
+        return True
+    return room_channel(room) in get_listener_manager().listeners_by_channel
+
+
+broker = BrokerLink(settings.SIGNAL_BROKER, relay) if getattr(settings, 'SIGNAL_BROKER', None) else None
@@ -1,4 +1,7 @@
 export const CHAT_CHANNEL = "chat"
+// same negotiated channel as common.Heartbeat of the python peers
+export const HEARTBEAT_CHANNEL = "heartbeat"
+export const HEARTBEAT_CHANNEL_ID = 1000
 
 
 export function waitForAllICE(peerConnection) {
@@ -31,3 +34,42 @@ export function addConnectionStateHandler(peerConnection) {
         console.log("onicecandidateerror", event)
     };
 }
+
+
+export function createHeartbeat(peerConnection, interval = 1000, misses = 3) {
+    // beats on a dedicated negotiated channel: the remote peer is dead after `misses` intervals
+    // without one, alive again at its next beat. unordered and never retransmitted, a late beat is worth nothing
+    const channel = peerConnection.createDataChannel(HEARTBEAT_CHANNEL,
+        { negotiated: true, id: HEARTBEAT_CHANNEL_ID, ordered: false, maxRetransmits: 0 })
+    const heartbeat = { channel: channel, alive: null, lastBeat: null, onDead: null, onAlive: null, timer: null }
+
+    channel.onopen = () => {
+        heartbeat.lastBeat = performance.now()
+        heartbeat.alive = true
+        let lastTick = performance.now()
+        heartbeat.timer = setInterval(() => {
+            const now = performance.now()
+            if (now - lastTick > 2 * interval) {
+                // the timers of a background tab are throttled, the beats were not read
+                heartbeat.lastBeat = now
+            }
+            lastTick = now
+            if (channel.readyState === "open") {
+                channel.send("beat")
+            }
+            if (heartbeat.alive && now - heartbeat.lastBeat > interval * misses) {
+                heartbeat.alive = false
+                if (heartbeat.onDead) heartbeat.onDead()
+            }
+        }, interval)
+    }
+    channel.onmessage = () => {
+        heartbeat.lastBeat = performance.now()
+        if (heartbeat.alive === false) {
+            heartbeat.alive = true
+            if (heartbeat.onAlive) heartbeat.onAlive()
+        }
+    }
+    channel.onclose = () => clearInterval(heartbeat.timer)
+    return heartbeat
+}
@@ -1,7 +1,16 @@
 import * as common from './common.js';
 console.log("\n".repeat(10))
 
-export async function start(username) {
+// signaling room, every message is posted to and received from this room only
+let room = "default"
+
+// a disconnected ICE connection often comes back by itself, it is given this long before restarting ICE
+const DISCONNECTED_GRACE_MS = 2000
+// an ICE restart that did not reconnect within this long falls back to a new RTCPeerConnection
+const ICE_RESTART_TIMEOUT_MS = 5000
+
+export async function start(username, roomName) {
+    room = roomName || room
     const [peerConnection, dataChannel] = initializeBeforeCreatingOffer(username)
     withPerfectNegociationHandler(async sessionDescriptionProtocol => {
         if (sessionDescriptionProtocol.type === "offer") {
@@ -21,7 +30,10 @@ export async function start(username) {
 }
 
 function initializeBeforeCreatingOffer(username) {
-    const peerConnection = { obj: initializeRTCPeerConnection(username) }
+    // recovery: when the connection was lost and how it is being brought back, see addRecoveryHandler
+    // heartbeat: liveness of the remote peer, see common.createHeartbeat. one per RTCPeerConnection
+    const peerConnection = { obj: initializeRTCPeerConnection(username), recovery: { lostAt: null, method: null, timeout: null } }
+    peerConnection.heartbeat = common.createHeartbeat(peerConnection.obj)
     const dataChannel = { obj: null }
     return [peerConnection, dataChannel]
 }
@@ -32,9 +44,28 @@ function initializeRTCPeerConnection(username) {
     peerConnection.ontrack = (ev) => {
         console.log("received track")
     }
+    // trickle ICE: every candidate is sent as soon as it is gathered, null marks the end of gathering
+    peerConnection.onicecandidate = ({ candidate }) => {
+        sendCandidate(candidate, username)
+    }
     return peerConnection
 }
 
+async function sendCandidate(candidate, username) {
+    await fetch('http://127.0.0.1:10000/candidate', {
+        method: 'POST',
+        body: JSON.stringify({ "room": room, "user": username, "candidate": candidate }),
+    })
+}
+
+async function receiveCandidate(peerConnection, candidate) {
+    try {
+        await peerConnection.obj.addIceCandidate(candidate)
+    } catch (err) {
+        console.log(err)
+    }
+}
+
 async function beCallee(remoteOffer, peerConnection, username, dataChannel) {
     await receiveOfferSDP(peerConnection, remoteOffer)
     await sendAnswerSDP(peerConnection, username)
@@ -57,15 +88,13 @@ async function receiveOfferSDP(peerConnection, remoteOffer) {
 }
 
 async function sendAnswerSDP(peerConnection, username) {
-    // not necessary in this particular scenario to collect ICE candidates for answer
-    // to establish connection is sufficient from the caller to send his ICE candidates in the offer
+    // the answer is sent right away, its candidates follow through onicecandidate
     console.log("Sending answer")
     await peerConnection.obj.setLocalDescription()
-    // await common.waitForAllICE(peerConnection)
     const localAnswerWithICECandidates = peerConnection.obj.localDescription
     await fetch('http://127.0.0.1:10000/sdp', {
         method: 'POST',
-        body: JSON.stringify({ "user": username, "sdp": localAnswerWithICECandidates }),
+        body: JSON.stringify({ "room": room, "user": username, "sdp": localAnswerWithICECandidates }),
         redirect: 'manual',
     })
 }
@@ -118,23 +147,30 @@ function waitForDataChannelOpen(dataChannel) {
 
 function withPerfectNegociationHandler(user_function, peerConnection, username, dataChannel) {
     var makingOffer = { obj: false }
+    // set when the last remote offer was ignored, so that its candidates are ignored as well
+    var ignoreOffer = { obj: false }
 
     addNegotiationNeededHandler(peerConnection, makingOffer, username)
+    addRecoveryHandler(peerConnection, makingOffer, username, dataChannel)
 
-    var es = new ReconnectingEventSource('/events?channel=testchannel');
+    // subscribed as username, the server does not send our own messages back
+    var es = new ReconnectingEventSource('/events/' + room + '/' + username + '/');
     es.addEventListener('message', async function ({ data }) {
         try {
-            if (shouldSkipMessage(data, peerConnection, username, makingOffer)) {
+            if (shouldSkipMessage(data, peerConnection, username, makingOffer, ignoreOffer)) {
                 return;
             }
-            if (peerRefreshedPage(dataChannel) || shouldAcceptOffer(username, peerConnection)) {
+            const message = JSON.parse(data)
+            if ("candidate" in message) {
+                await receiveCandidate(peerConnection, message.candidate)
+                return;
+            }
+            if (peerConnection.heartbeat.alive === false || peerRefreshedPage(dataChannel) || shouldAcceptOffer(username, peerConnection)) {
                 console.log("Reinitialized RTCPeerConnection")
-                peerConnection.obj.close()
-                peerConnection.obj = initializeRTCPeerConnection()
-                addNegotiationNeededHandler(peerConnection, makingOffer, username)
+                rebuildRTCPeerConnection(peerConnection, makingOffer, username, dataChannel)
             }
 
-            const SDP = JSON.parse(data).sdp
+            const SDP = message.sdp
             await user_function(SDP)
         } catch (err) {
             console.error(err);
@@ -149,25 +185,20 @@ function shouldAcceptOffer(username, peerConnection) {
     return false
 }
 
-function shouldSkipMessage(data, peerConnection, username, makingOffer) {
+function shouldSkipMessage(data, peerConnection, username, makingOffer, ignoreOffer) {
     const message = JSON.parse(data)
-    if (messageIsReflected(message, username)) {
-        return true;
+    if ("candidate" in message) {
+        return ignoreOffer.obj
     }
     const description = message.sdp
 
-    if (shouldIgnoreOffer(description, makingOffer, peerConnection, username)) {
+    ignoreOffer.obj = shouldIgnoreOffer(description, makingOffer, peerConnection, username)
+    if (ignoreOffer.obj) {
         return true;
     }
     return false
 }
 
-function messageIsReflected(message, username) {
-    // Because of the chosen simplification, both peers are subscribed to the same channel.
-    // Thus, messages are pushed back to the sender and we want to skip them.
-    return message.user === username
-}
-
 function shouldIgnoreOffer(description, makingOffer, peerConnection, username) {
     const offerCollision = (description.type === "offer") && (makingOffer.obj || peerConnection.obj.signalingState !== "stable")
     const shouldIgnore = (username === "impolite") && offerCollision;
@@ -179,25 +210,79 @@ function peerRefreshedPage(dataChannel) {
     return dataChannel.obj !== null && (dataChannel.obj.readyState === "closing" || dataChannel.obj.readyState === "closed")
 }
 
+function rebuildRTCPeerConnection(peerConnection, makingOffer, username, dataChannel) {
+    // replaced before it is closed, so that its closing is not taken for a lost connection
+    const oldPeerConnection = peerConnection.obj
+    peerConnection.obj = initializeRTCPeerConnection(username)
+    peerConnection.heartbeat = common.createHeartbeat(peerConnection.obj)
+    oldPeerConnection.close()
+    addNegotiationNeededHandler(peerConnection, makingOffer, username)
+    addRecoveryHandler(peerConnection, makingOffer, username, dataChannel)
+}
+
+function addRecoveryHandler(peerConnection, makingOffer, username, dataChannel) {
+    // the cheapest way first: an ICE restart keeps the DTLS and SCTP associations, so the data
+    // channels stay open. only when it does not reconnect is the RTCPeerConnection rebuilt
+    const pc = peerConnection.obj
+    const recovery = peerConnection.recovery
+
+    function lost(state) {
+        if (peerConnection.obj !== pc || recovery.lostAt !== null) {
+            return
+        }
+        recovery.lostAt = performance.now()
+        recovery.method = "waiting"
+        recovery.timeout = setTimeout(() => {
+            if (peerConnection.obj !== pc || recovery.lostAt === null) {
+                return
+            }
+            console.log("restarting ICE")
+            recovery.method = "ice restart"
+            // fires negotiationneeded, the new offer carries new ICE credentials
+            pc.restartIce()
+            recovery.timeout = setTimeout(() => {
+                if (peerConnection.obj !== pc || recovery.lostAt === null) {
+                    return
+                }
+                console.log("ICE restart did not reconnect, rebuilding the RTCPeerConnection")
+                recovery.method = "rebuild"
+                rebuildRTCPeerConnection(peerConnection, makingOffer, username, dataChannel)
+                firstNegotiationNeededEvent(peerConnection, dataChannel)
+            }, ICE_RESTART_TIMEOUT_MS)
+        }, state === "disconnected" ? DISCONNECTED_GRACE_MS : 0)
+    }
+
+    pc.oniceconnectionstatechange = () => {
+        const state = pc.iceConnectionState
+        if (state === "connected" || state === "completed") {
+            if (peerConnection.obj === pc && recovery.lostAt !== null) {
+                console.log("connection recovered by " + recovery.method + " in " + Math.round(performance.now() - recovery.lostAt) + " ms")
+                clearTimeout(recovery.timeout)
+                recovery.lostAt = null
+            }
+        } else if (state === "disconnected" || state === "failed") {
+            lost(state)
+        }
+    }
+    // a silent peer is lost long before ICE gives up on it
+    peerConnection.heartbeat.onDead = () => lost("dead")
+}
+
 function sleep(ms) {
     return new Promise(resolve => setTimeout(resolve, ms));
 }
 
 function addNegotiationNeededHandler(peerConnection, makingOffer, username) {
-    var collectedIce = false
     peerConnection.obj.onnegotiationneeded = async () => {
         try {
             makingOffer.obj = true
+            // no waiting for ICE gathering, the candidates are trickled through onicecandidate
             await peerConnection.obj.setLocalDescription()
-            if (!collectedIce) {
-                await common.waitForAllICE(peerConnection)
-                collectedIce = true
-            }
 
             const localOfferWithICECandidates = peerConnection.obj.localDescription
             await fetch('http://127.0.0.1:10000/sdp', {
                 method: 'POST',
-                body: JSON.stringify({ "user": username, "sdp": localOfferWithICECandidates })
+                body: JSON.stringify({ "room": room, "user": username, "sdp": localOfferWithICECandidates })
             })
         } catch (err) {
             console.log(err)
@@ -7,8 +7,16 @@ import django_eventstream
 
 urlpatterns = [
     path('sdp', views.sdp, name='sdp'),
-    path('events/', include(django_eventstream.urls), {
-        'channels': ['testchannel']
+    path('candidate', views.candidate, name='candidate'),
+    path('stats', views.stats, name='stats'),
+    path('metrics', views.metrics_view, name='metrics'),
+    # the subscriber named by <user> is not sent its own messages, see rooms.publish
+    path('events/<slug:room>/<slug:user>/', include(django_eventstream.urls), {
+        'format-channels': ['room-{room}.{user}']
+    }),
+    path('events/<slug:room>/', include(django_eventstream.urls), {
+        'format-channels': ['room-{room}']
     }),
     path('home/<user>', views.home, name='home'),
+    path('home/<slug:room>/<user>', views.home, name='home_room'),
 ]
\ No newline at end of file
@@ -1,21 +1,78 @@
 from django.shortcuts import render
-from django.views.decorators.csrf import csrf_exempt
-from django_eventstream import send_event
-from django.http.response import HttpResponse
-import json
-import time
+from django.http.response import HttpResponse, HttpResponseBadRequest
+
+from . import metrics
+from .rooms import DEFAULT_ROOM, ROOM_PATTERN, get_room, publish
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    # orjson is optional, the stdlib codec gives the same result, only slower
+    from json import loads as json_loads
 
 """
 Request body contains:
-sdp
+sdp (for /sdp) or candidate (for /candidate, null marks the end of candidates)
 user
+room (optional, defaults to DEFAULT_ROOM)
+
+The same messages can be exchanged over the ws/<room>/ websocket, see consumers.py
+
+/stats takes the statistics a peer sampled instead: user, room and stats, a flat
+object of numbers, served on /metrics until the peer posts the next one
 """
 
-@csrf_exempt
-def sdp(request):
+
+def async_csrf_exempt(view):
+    # django 3.2's csrf_exempt wraps the view in a sync function, which would
+    # hide the coroutine from the handler and push the view into the thread pool
+    view.csrf_exempt = True
+    return view
+
+
+@async_csrf_exempt
+async def sdp(request):
     if request.method == "POST":
-        send_event('testchannel', 'message', json.loads(request.body))
+        request_body = json_loads(request.body)
+        room = get_room(request_body)
+        if room is None:
+            return HttpResponseBadRequest("invalid room")
+        # parsed once, send_event encodes it once more for the event stream.
+        # only the subscribers of this room receive the message
+        await publish(room, request_body, request.body.decode())
         return HttpResponse("ok")
 
-def home(request, user):
-    return render(request, 'mainapp/index.html', {"user": user})
\ No newline at end of file
+@async_csrf_exempt
+async def candidate(request):
+    if request.method == "POST":
+        request_body = json_loads(request.body)
+        room = get_room(request_body)
+        if room is None:
+            return HttpResponseBadRequest("invalid room")
+        if 'candidate' not in request_body:
+            return HttpResponseBadRequest("missing candidate")
+        # trickled ICE candidates go through the room like any other signaling message
+        await publish(room, request_body, request.body.decode())
+        return HttpResponse("ok")
+
+@async_csrf_exempt
+async def stats(request):
+    if request.method == "POST":
+        request_body = json_loads(request.body)
+        room = get_room(request_body)
+        if room is None:
+            return HttpResponseBadRequest("invalid room")
+        user = request_body.get('user')
+        # a label of every gauge, a slug like the users of the event streams
+        if not isinstance(user, str) or not ROOM_PATTERN.match(user):
+            return HttpResponseBadRequest("invalid user")
+        if not isinstance(request_body.get('stats'), dict):
+            return HttpResponseBadRequest("missing stats")
+        metrics.PEER_STATS.update(room, user, request_body['stats'])
+        return HttpResponse("ok")
+
+async def metrics_view(request):
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def home(request, user, room=DEFAULT_ROOM):
+    return render(request, 'mainapp/index.html', {"user": user, "room": room})
\ No newline at end of file
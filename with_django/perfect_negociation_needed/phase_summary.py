@@ -0,0 +1,101 @@
+"""
+Percentiles of the setup phases recorded by the peers' --timing option.
+
+    python phase_summary.py timing.jsonl [more.jsonl ...] [--json]
+
+For every script/role and phase: how long the phase took (duration) and when
+it ended, counted from the start of the peer (at). Phases that happened more
+than once in a run (renegotiation) count once per occurrence. Recoveries of
+a lost connection are listed apart, per recovery method, "at" counted from
+the loss.
+"""
+import argparse
+import json
+from collections import defaultdict
+from pathlib import Path
+
+from latency import percentile
+
+# the order phases usually happen in, the others are listed after them
+PHASE_ORDER = [
+    "signaling_wait", "offer_received", "createOffer", "createAnswer", "setLocalDescription",
+    "ice_gathering_complete", "signaling_send", "answer_received", "setRemoteDescription",
+    "ice_connected", "recovered", "dtls_connected", "datachannel_open",
+]
+
+
+def load(paths):
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def stats(values):
+    ordered = sorted(values)
+    return {
+        "p50": round(percentile(ordered, 50), 1),
+        "p90": round(percentile(ordered, 90), 1),
+        "p99": round(percentile(ordered, 99), 1),
+        "max": round(ordered[-1], 1),
+    }
+
+
+def summarize_runs(records):
+    groups = defaultdict(lambda: {"runs": 0, "completed": 0, "phases": defaultdict(lambda: ([], []))})
+    for record in records:
+        key = "%s/%s" % (record["script"], record["role"])
+        if "recovery" in record:
+            key += " recovery by %s" % record["recovery"]["method"]
+        group = groups[key]
+        group["runs"] += 1
+        group["completed"] += record["completed"]
+        for phase in record["phases"]:
+            durations, ends = group["phases"][phase["phase"]]
+            durations.append(phase["end_ms"] - phase["start_ms"])
+            ends.append(phase["end_ms"])
+
+    def order(name):
+        return (PHASE_ORDER.index(name) if name in PHASE_ORDER else len(PHASE_ORDER), name)
+
+    return {
+        key: {
+            "runs": group["runs"],
+            "completed": group["completed"],
+            "phases": {
+                name: {"count": len(group["phases"][name][0]),
+                       "duration_ms": stats(group["phases"][name][0]),
+                       "at_ms": stats(group["phases"][name][1])}
+                for name in sorted(group["phases"], key=order)
+            },
+        }
+        for key, group in sorted(groups.items())
+    }
+
+
+def print_table(summary):
+    for key, group in summary.items():
+        print("%s: %d runs, %d completed" % (key, group["runs"], group["completed"]))
+        print("  %-24s %6s %10s %10s %10s %10s %10s" % (
+            "phase", "count", "dur p50", "dur p90", "dur p99", "at p50", "at p99"))
+        for name, phase in group["phases"].items():
+            print("  %-24s %6d %10.1f %10.1f %10.1f %10.1f %10.1f" % (
+                name, phase["count"], phase["duration_ms"]["p50"], phase["duration_ms"]["p90"],
+                phase["duration_ms"]["p99"], phase["at_ms"]["p50"], phase["at_ms"]["p99"]))
+        print()
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Aggregate the setup phase timings of many runs")
+    ap.add_argument("files", type=Path, nargs="+", help="JSON lines written with --timing")
+    ap.add_argument("--json", action="store_true", help="Print the summary as JSON instead of a table")
+    return ap.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    summary = summarize_runs(load(args.files))
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_table(summary)
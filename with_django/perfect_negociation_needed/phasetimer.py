@@ -0,0 +1,116 @@
+# phasetimer.py
+"""
+Where the setup time of a peer connection goes.
+
+A PhaseTimer records, in ms since the peer started:
+- timed phases, `with timer.phase("createOffer"): ...`, with their start and end
+- instants, timer.mark("offer_received")
+- the transport milestones of the peer connection once watch(pc) is called:
+  ice_gathering_complete, ice_connected, dtls_connected (connectionState
+  "connected", i.e. DTLS done on every transport)
+- datachannel_open, which ends the setup and appends the record as one JSON
+  line to the --timing file
+
+A lost connection is timed by a new timer, for_recovery(), counting from the
+loss: its record says how the connection came back (ICE restart or rebuild)
+and "recovered" marks when ICE was connected again.
+
+phase_summary.py aggregates those files into percentiles.
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+
+class PhaseTimer:
+    def __init__(self, script: str, session: str, role: str, path: Optional[Path] = None):
+        self.script = script
+        self.session = session
+        self.role = role
+        self.path = path
+        self.started = time.monotonic()
+        self.started_wall = time.time()
+        self.phases = []
+        self.written = False
+        # {"lost": ICE state, "method": how it came back}, for the timer of a recovery
+        self.recovery = None
+
+    def for_recovery(self, lost_state: str) -> "PhaseTimer":
+        timer = PhaseTimer(self.script, self.session, self.role, self.path)
+        timer.recovery = {"lost": lost_state, "method": None}
+        return timer
+
+    def now_ms(self) -> float:
+        return round((time.monotonic() - self.started) * 1000, 3)
+
+    @contextmanager
+    def phase(self, name: str):
+        start = self.now_ms()
+        try:
+            yield
+        finally:
+            self.phases.append({"phase": name, "start_ms": start, "end_ms": self.now_ms()})
+
+    def mark(self, name: str) -> None:
+        at = self.now_ms()
+        self.phases.append({"phase": name, "start_ms": at, "end_ms": at})
+
+    def mark_once(self, name: str) -> None:
+        if not any(p["phase"] == name for p in self.phases):
+            self.mark(name)
+
+    def watch(self, pc) -> None:
+        @pc.on("icegatheringstatechange")
+        def _on_gathering():
+            if pc.iceGatheringState == "complete":
+                self.mark_once("ice_gathering_complete")
+
+        @pc.on("iceconnectionstatechange")
+        def _on_ice():
+            if pc.iceConnectionState in ("connected", "completed"):
+                self.mark_once("ice_connected")
+
+        @pc.on("connectionstatechange")
+        def _on_connection():
+            if pc.connectionState == "connected":
+                self.mark_once("dtls_connected")
+
+    def watch_channel(self, dc) -> None:
+        if dc.readyState == "open":
+            self.channel_open()
+        else:
+            dc.once("open", self.channel_open)
+
+    def channel_open(self) -> None:
+        self.mark_once("datachannel_open")
+        self.finish(completed=True)
+
+    def record(self, completed: bool) -> dict:
+        record = {
+            "script": self.script,
+            "session": self.session,
+            "role": self.role,
+            "started": self.started_wall,
+            "completed": completed,
+            "total_ms": self.now_ms(),
+            "phases": self.phases,
+        }
+        if self.recovery is not None:
+            record["recovery"] = self.recovery
+        return record
+
+    def finish(self, completed: bool = False) -> None:
+        """Append the record once; a peer that never got its channel open is recorded as incomplete."""
+        if self.written or self.path is None:
+            return
+        self.written = True
+        line = (json.dumps(self.record(completed)) + "\n").encode()
+        # a single O_APPEND write, several peers can share the file
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
@@ -0,0 +1,186 @@
+# shard.py
+"""
+Spread file-signaling sessions over one worker process per core.
+
+aiortc's DTLS, SRTP and SCTP run as Python on the event loop, so a single
+loop saturates one core early. Each worker here has its own process and
+loop, and a session always lands on the same worker: session ids are mapped
+to workers with a consistent hash ring, so adding a worker only moves the
+sessions of the ring segments it takes over.
+
+Two modes:
+- serve: one Supervisor per worker, each answering only the offers of the
+  sessions it owns in the shared mailbox directory.
+- pairs: a load run; each worker runs both ends of its sessions with
+  main_gpt2.run() and the launcher reports the aggregate throughput.
+
+    python shard.py pairs --sessions 64 --count 200
+    python shard.py serve --workers 4
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from latency import summarize
+
+
+class HashRing:
+    def __init__(self, workers: int, replicas: int = 64):
+        # a few virtual nodes per worker evens out the share of each
+        self.ring = sorted((self.hash(f"worker-{worker}#{replica}"), worker)
+                           for worker in range(workers) for replica in range(replicas))
+        self.points = [point for point, _ in self.ring]
+
+    @staticmethod
+    def hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+    def worker_for(self, session: str) -> int:
+        index = bisect.bisect(self.points, self.hash(session)) % len(self.ring)
+        return self.ring[index][1]
+
+    def assign(self, sessions: List[str]) -> Dict[int, List[str]]:
+        shards = {}
+        for session in sessions:
+            shards.setdefault(self.worker_for(session), []).append(session)
+        return shards
+
+
+def quiet(verbose: bool) -> None:
+    # hundreds of sessions printing every ping would cost more than the pings
+    if not verbose:
+        sys.stdout = open(os.devnull, "w")
+
+
+# ----------------- serve -----------------
+def serve_worker(worker: int, workers: int, stun_url: Optional[str], idle_timeout: float,
+                 status_every: float, verbose: bool) -> None:
+    from supervisor import Supervisor
+
+    ring = HashRing(workers)
+    supervisor = Supervisor(Path("."), stun_url, idle_timeout,
+                            owns=lambda name: ring.worker_for(name) == worker)
+    status_file = Path(f"shard-{worker}.status.json")
+    quiet(verbose)
+    try:
+        asyncio.run(supervisor.serve(status_every, status_file))
+    except KeyboardInterrupt:
+        pass
+
+
+def serve(args) -> None:
+    processes = [multiprocessing.Process(target=serve_worker, args=(
+        worker, args.workers, args.stun, args.idle_timeout, args.status_every, args.verbose))
+        for worker in range(args.workers)]
+    for process in processes:
+        process.start()
+    print(f"{args.workers} supervisors running, status in shard-<n>.status.json")
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
+
+
+# ----------------- pairs -----------------
+def pairs_worker(worker: int, sessions: List[str], stun_url: Optional[str], count: int,
+                 interval: float, verbose: bool) -> dict:
+    from main_gpt2 import run, session_paths
+
+    async def pair(session):
+        for path in session_paths(session).values():
+            path.unlink(missing_ok=True)  # leftovers of an interrupted run
+        # the first run() to take the session lock becomes the initiator, the other one answers
+        return await asyncio.gather(run(session, stun_url, None, count=count, interval=interval),
+                                    run(session, stun_url, None, count=count, interval=interval))
+
+    async def main():
+        started = time.monotonic()
+        results = await asyncio.gather(*(pair(session) for session in sessions))
+        return time.monotonic() - started, [r for both in results for r in both if r and r["role"] == "initiator"]
+
+    quiet(verbose)
+    elapsed, initiators = asyncio.run(main())
+    return {
+        "worker": worker,
+        "pid": os.getpid(),
+        "sessions": len(sessions),
+        "elapsed_s": elapsed,
+        "exchanges": sum(r["exchanges"] for r in initiators),
+        "rtts": [rtt for r in initiators for rtt in r["rtts"]],
+    }
+
+
+def pairs(args) -> dict:
+    sessions = [f"{args.prefix}-{i}" for i in range(args.sessions)]
+    shards = HashRing(args.workers).assign(sessions)
+    started = time.monotonic()
+    with multiprocessing.Pool(len(shards)) as pool:
+        results = pool.starmap(pairs_worker, [
+            (worker, shard, args.stun, args.count, args.interval, args.verbose)
+            for worker, shard in sorted(shards.items())])
+    wall = time.monotonic() - started
+
+    exchanges = sum(r["exchanges"] for r in results)
+    return {
+        "workers": args.workers,
+        "sessions": args.sessions,
+        "exchanges": exchanges,
+        "expected": args.sessions * args.count,
+        "wall_s": round(wall, 2),
+        # each exchange is a ping and a pong
+        "messages_per_s": round(2 * exchanges / wall, 1),
+        "rtt_ms": summarize([rtt for r in results for rtt in r["rtts"]]),
+        "per_worker": [{
+            "worker": r["worker"],
+            "sessions": r["sessions"],
+            "exchanges": r["exchanges"],
+            "elapsed_s": round(r["elapsed_s"], 2),
+            "messages_per_s": round(2 * r["exchanges"] / r["elapsed_s"], 1),
+        } for r in results],
+    }
+
+
+# ----------------- CLI -----------------
+def parse_args():
+    ap = argparse.ArgumentParser(description="Shard file-signaling sessions over worker processes")
+    ap.add_argument("mode", choices=["serve", "pairs"])
+    ap.add_argument("--workers", type=int, default=os.cpu_count(),
+                    help="Worker processes (default: one per core)")
+    ap.add_argument("--stun", default=None,
+                    help="Optional STUN URL, e.g. stun:stun.l.google.com:19302")
+    ap.add_argument("--verbose", action="store_true", help="Keep the per-session output of the workers")
+    ap.add_argument("--idle-timeout", type=float, default=30.0, help="serve: per-session idle timeout")
+    ap.add_argument("--status-every", type=float, default=5.0, help="serve: seconds between status files")
+    ap.add_argument("--sessions", type=int, default=32, help="pairs: number of sessions")
+    ap.add_argument("--prefix", default="shard", help="pairs: session names are <prefix>-<n>")
+    ap.add_argument("--count", type=int, default=100, help="pairs: ping/pong exchanges per session")
+    ap.add_argument("--interval", type=float, default=0.0, help="pairs: seconds between exchanges")
+    ap.add_argument("--output", type=Path, default=None, help="pairs: also write the report here")
+    args = ap.parse_args()
+    # neither an empty ring nor an empty pool can run
+    if args.workers < 1:
+        ap.error("--workers must be at least 1")
+    if args.mode == "pairs" and args.sessions < 1:
+        ap.error("--sessions must be at least 1")
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.mode == "serve":
+        serve(args)
+    else:
+        report = pairs(args)
+        text = json.dumps(report, indent=2)
+        print(text)
+        if args.output:
+            args.output.write_text(text)
@@ -0,0 +1,145 @@
+"""
+Transports to the signaling server for the aiortc peers.
+
+Both expose the same two calls:
+- await send(message), deliver a message (description or candidate) to the room
+- async for data in messages(), the raw JSON text of every message of the room
+
+HttpSignaling posts to /sdp or /candidate and reads the SSE stream of events/<room>/.
+WebSocketSignaling does both over one persistent ws/<room>/ connection.
+Given the user, both subscribe under its name and the server does not send
+its own messages back to it.
+
+Neither blocks the event loop, so DTLS/SCTP keep being served while a
+message is on its way.
+"""
+import asyncio
+import json
+
+import aiohttp
+
+
+class HttpSignaling:
+    """
+    The SSE stream and the POSTs share one aiohttp session, whose keep-alive
+    pool saves a TCP connect per message. A POST is retried on connection
+    errors, timeouts and 5xx responses, with exponential backoff. The SSE
+    stream reconnects on its own and resumes from the last event id it saw.
+    """
+
+    def __init__(self, url, room, user=None, timeout=5.0, retries=3, backoff=0.1, pool_size=4):
+        self.url = url
+        self.room = room
+        self.events_url = url + '/events/' + room + '/' + (user + '/' if user else '')
+        # seconds for a whole POST, including the connect
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.session = None
+        self.last_event_id = None
+
+    def get_session(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60))
+        return self.session
+
+    async def send(self, message):
+        path = "/candidate" if "candidate" in message else "/sdp"
+        body = json.dumps(dict(message, room=self.room))
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.get_session().post(self.url + path, data=body,
+                                                   timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+                    if response.status < 500 or attempt == self.retries:
+                        response.raise_for_status()
+                        return
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def messages(self):
+        while True:
+            headers = {'Last-Event-ID': self.last_event_id} if self.last_event_id else {}
+            try:
+                # the server sends a keep-alive event every 20 s, a silent minute means a dead stream
+                async with self.get_session().get(self.events_url, headers=headers,
+                                                  timeout=aiohttp.ClientTimeout(total=None, sock_read=60)) as response:
+                    response.raise_for_status()
+                    async for event, data, event_id in read_events(response.content):
+                        if event_id:
+                            self.last_event_id = event_id
+                        if event == 'message' and data:
+                            yield data
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print("signaling stream lost, reconnecting:", e)
+            await asyncio.sleep(self.backoff)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+async def read_events(stream):
+    """Parse a text/event-stream body into (event type, data, event id) tuples."""
+    event, data, event_id = 'message', [], None
+    async for line in stream:
+        line = line.decode().rstrip('\r\n')
+        if not line:
+            if data:
+                yield event, '\n'.join(data), event_id
+            event, data, event_id = 'message', [], None
+            continue
+        field, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+        if field == 'data':
+            data.append(value)
+        elif field == 'event':
+            event = value
+        elif field == 'id':
+            event_id = value
+
+
+class WebSocketSignaling:
+    def __init__(self, url, room, user=None):
+        self.url = url.replace("http", "ws", 1) + '/ws/' + room + '/' + ('?user=' + user if user else '')
+        self.room = room
+        self.session = None
+        self.ws = None
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        # send() and messages() can both be the first to need the connection
+        async with self.lock:
+            if self.ws is None:
+                self.session = aiohttp.ClientSession()
+                self.ws = await self.session.ws_connect(self.url, heartbeat=20)
+        return self.ws
+
+    async def send(self, message):
+        ws = await self.connect()
+        # the room is implied by the connection
+        await ws.send_str(json.dumps(message))
+
+    async def messages(self):
+        ws = await self.connect()
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                yield msg.data
+            elif msg.type == aiohttp.WSMsgType.ERROR:
+                break
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+            await self.session.close()
+
+
+def create_signaling(transport, url, room, user=None):
+    if transport == "ws":
+        return WebSocketSignaling(url, room, user)
+    return HttpSignaling(url, room, user)
@@ -13,14 +13,30 @@ from django.urls import re_path
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 import django_eventstream as django_eventstream
+from mainapp.consumers import SignalingConsumer
+from mainapp import rooms
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "server.settings")
 
-application = ProtocolTypeRouter({
+router = ProtocolTypeRouter({
     'http': URLRouter([
-        re_path(r'^events/', AuthMiddlewareStack(
+        # before events/<room>/, which would take the user for the rest of the path
+        re_path(r'^events/(?P<room>[-a-zA-Z0-9_]+)/(?P<user>[-a-zA-Z0-9_]+)/', AuthMiddlewareStack(
             URLRouter(django_eventstream.routing.urlpatterns)
-        ), { 'channels': ['testchannel'] }),
+        ), { 'format-channels': ['room-{room}.{user}'] }),
+        re_path(r'^events/(?P<room>[-a-zA-Z0-9_]+)/', AuthMiddlewareStack(
+            URLRouter(django_eventstream.routing.urlpatterns)
+        ), { 'format-channels': ['room-{room}'] }),
         re_path(r'', get_asgi_application()),
     ]),
+    'websocket': AuthMiddlewareStack(URLRouter([
+        re_path(r'^ws/(?P<room>[-a-zA-Z0-9_]+)/$', SignalingConsumer.as_asgi()),
+    ])),
 })
+
+
+async def application(scope, receive, send):
+    # the link to the broker needs the event loop of the server, the first connection brings it
+    if rooms.broker is not None:
+        rooms.broker.start()
+    await router(scope, receive, send)
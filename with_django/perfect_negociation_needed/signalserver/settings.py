@@ -44,6 +44,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so that the request latency covers the other middlewares too
+    'mainapp.metrics.metrics_middleware',
     'django_grip.GripMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -85,6 +87,14 @@ TEMPLATES = [
 WSGI_APPLICATION = 'signalserver.wsgi.application'
 ASGI_APPLICATION = 'signalserver.asgi.application'
 
+# knows which users are subscribed to which room, so that nobody is sent its own messages
+EVENTSTREAM_CHANNELMANAGER_CLASS = 'mainapp.rooms.RoomChannelManager'
+
+# Unix socket of the broker relaying the room messages between the worker
+# processes (python -m mainapp.broker <path>, see mainapp/broker.py). Unset
+# for a single worker
+SIGNAL_BROKER = os.environ.get('SIGNAL_BROKER')
+
 
 
 # Database
@@ -0,0 +1,221 @@
+# statssampler.py
+"""
+Transport and RTP statistics of a peer connection, sampled every few seconds.
+
+    sampler = StatsSampler(pc, interval=2.0, sinks=[JsonLinesSink(Path("stats.jsonl"))])
+    sampler.start()
+    ...
+    await sampler.stop()
+
+Every sample is one flat record of numbers, the rates and counts being the
+deltas since the previous sample:
+- send_kbps, recv_kbps, packets_sent, packets_received: the whole transport
+- <kind>_send_kbps, <kind>_packets_sent: the RTP streams sent, per kind
+- <kind>_packets_received, <kind>_packets_lost, <kind>_jitter_ms: received
+- <kind>_rtt_ms, <kind>_fraction_lost: as reported back by the remote peer
+- sctp_buffered_bytes, sctp_rtt_ms, sctp_cwnd_bytes, sctp_flight_bytes: the
+  data channels, read from aiortc internals as getStats() has nothing on SCTP
+- sample_cpu_ms, cpu_share, interval_s: the cost of sampling itself
+
+A sample runs without yielding to the loop, so the thread CPU time spent in
+it is its own. When that cost would exceed `cpu_budget` (a share of one CPU)
+at `interval`, the sampler samples less often instead.
+
+Sinks: JsonLinesSink appends the records to a file, MetricsSink posts them to
+the /stats endpoint of the signaling server, which serves the last one of
+every peer on /metrics.
+"""
+import asyncio
+import json
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+import aiohttp
+from aiortc import RTCPeerConnection
+
+from common import spawn
+
+# RTP clock rates, the jitter of aiortc is in timestamp units
+CLOCK_RATES = {"audio": 48000, "video": 90000}
+
+
+class StatsSampler:
+    def __init__(self, pc: RTCPeerConnection, interval: float = 2.0, sinks: Iterable = (),
+                 cpu_budget: float = 0.005):
+        self.pc = pc
+        self.interval = interval
+        self.sinks = list(sinks)
+        self.cpu_budget = cpu_budget
+        self.previous: Dict[str, float] = {}
+        self.previous_time: Optional[float] = None
+        self.cost: Optional[float] = None  # seconds of CPU per sample, smoothed
+        self.current_interval = interval
+        self.samples = 0
+        self.cpu_total = 0.0
+        self.task = None
+
+    def watch(self, pc: RTCPeerConnection) -> None:
+        # a new peer connection replacing ours, its counters start from zero
+        self.pc = pc
+        self.previous = {}
+        self.previous_time = None
+
+    def start(self) -> None:
+        self.task = spawn(self._run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        for sink in self.sinks:
+            await sink.close()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.current_interval)
+            if self.pc.connectionState == "closed":
+                continue
+            start = time.thread_time()
+            record = await self.sample()
+            cost = time.thread_time() - start
+            self.samples += 1
+            self.cpu_total += cost
+            # smoothed, a single slow sample does not stretch the interval
+            self.cost = cost if self.cost is None else 0.8 * self.cost + 0.2 * cost
+            self.current_interval = max(self.interval, self.cost / self.cpu_budget)
+            record["sample_cpu_ms"] = round(cost * 1000, 3)
+            record["cpu_share"] = round(self.cost / self.current_interval, 6)
+            record["interval_s"] = round(self.current_interval, 3)
+            for sink in self.sinks:
+                sink.write(record)
+
+    async def report(self) -> dict:
+        # the senders and receivers one after the other, pc.getStats() would gather them in tasks
+        merged = {}
+        for sender in self.pc.getSenders():
+            merged.update(await sender.getStats())
+        for receiver in self.pc.getReceivers():
+            merged.update(await receiver.getStats())
+        sctp = self.pc.sctp
+        if sctp is not None and sctp.transport.state == "connected":
+            # the data channels' transport, the same one as the media when bundled
+            merged.update(sctp.transport._get_stats())
+        return merged
+
+    async def sample(self) -> dict:
+        now = time.monotonic()
+        elapsed = now - self.previous_time if self.previous_time is not None else None
+        self.previous_time = now
+        counters = {}
+        record = {"time": round(time.time(), 3)}
+
+        def count(key, value):
+            counters[key] = counters.get(key, 0) + value
+
+        for stats in (await self.report()).values():
+            if stats.type == "transport":
+                count("send_bytes", stats.bytesSent)
+                count("recv_bytes", stats.bytesReceived)
+                count("packets_sent", stats.packetsSent)
+                count("packets_received", stats.packetsReceived)
+            elif stats.type == "outbound-rtp":
+                count(stats.kind + "_send_bytes", stats.bytesSent)
+                count(stats.kind + "_packets_sent", stats.packetsSent)
+            elif stats.type == "inbound-rtp":
+                count(stats.kind + "_packets_received", stats.packetsReceived)
+                count(stats.kind + "_packets_lost", stats.packetsLost)
+                if stats.jitter is not None:
+                    jitter = stats.jitter * 1000 / CLOCK_RATES.get(stats.kind, 90000)
+                    record[stats.kind + "_jitter_ms"] = max(record.get(stats.kind + "_jitter_ms", 0), round(jitter, 3))
+            elif stats.type == "remote-inbound-rtp":
+                # None until the remote peer sent a receiver report on a sender report of ours
+                if stats.roundTripTime is not None:
+                    record[stats.kind + "_rtt_ms"] = round(stats.roundTripTime * 1000, 3)
+                record[stats.kind + "_fraction_lost"] = stats.fractionLost
+
+        # deltas of the cumulative counters, the bytes as rates. none for the first sample
+        for key, value in counters.items():
+            if not elapsed:
+                break
+            delta = value - self.previous.get(key, 0)
+            if key.endswith("_bytes"):
+                record[key[:-len("_bytes")] + "_kbps"] = round(delta * 8 / elapsed / 1000, 3)
+            else:
+                record[key] = delta
+        self.previous = counters
+
+        sctp = self.pc.sctp
+        if sctp is not None:
+            # aiortc internals, read defensively
+            channels = getattr(sctp, "_data_channels", {}).values()
+            record["sctp_buffered_bytes"] = sum(channel.bufferedAmount for channel in channels)
+            srtt = getattr(sctp, "_srtt", None)
+            if srtt is not None:
+                record["sctp_rtt_ms"] = round(srtt * 1000, 3)
+            record["sctp_cwnd_bytes"] = getattr(sctp, "_cwnd", 0)
+            record["sctp_flight_bytes"] = getattr(sctp, "_flight_size", 0)
+        return record
+
+    def overhead(self) -> dict:
+        return {
+            "samples": self.samples,
+            "cpu_ms_per_sample": round(self.cpu_total * 1000 / self.samples, 3) if self.samples else None,
+            "cpu_share": round(self.cost / self.current_interval, 6) if self.cost is not None else None,
+            "interval_s": round(self.current_interval, 3),
+        }
+
+
+class JsonLinesSink:
+    def __init__(self, path: Path):
+        self.file = path.open("a")
+
+    def write(self, record: dict) -> None:
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    async def close(self) -> None:
+        self.file.close()
+
+
+class MetricsSink:
+    """
+    Posts the records to <url>/stats. At most one post in flight: a record coming
+    while the previous one is still on its way replaces the one waiting.
+    """
+
+    def __init__(self, url: str, room: str, user: str, timeout: float = 2.0):
+        self.url = url + "/stats"
+        self.room = room
+        self.user = user
+        self.timeout = timeout
+        self.session = None
+        self.waiting = None
+        self.task = None
+
+    def write(self, record: dict) -> None:
+        self.waiting = record
+        if self.task is None:
+            self.task = spawn(self._post())
+
+    async def _post(self) -> None:
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        try:
+            while self.waiting is not None:
+                record, self.waiting = self.waiting, None
+                body = json.dumps({"room": self.room, "user": self.user, "stats": record})
+                try:
+                    async with self.session.post(self.url, data=body,
+                                                 timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+                        response.raise_for_status()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    print("stats not posted:", e)
+        finally:
+            self.task = None
+
+    async def close(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+        if self.session is not None:
+            await self.session.close()
@@ -0,0 +1,171 @@
+"""
+Memory of a long-lived peer over thousands of renegotiations.
+
+Two aiortc peer connections in one process, connected directly: the
+descriptions are handed over in memory, no signaling server is involved.
+Each round renegotiates and waits on events and timers the way main.py does:
+the signaling state going back to stable, an echo on the data channel, and a
+watchdog timer cancelled once the round is done.
+
+    python stress_renegotiation.py --rounds 3000
+    python stress_renegotiation.py --rounds 3000 --primitives legacy
+
+--primitives scoped uses the waits and timers of common.py, legacy a copy of
+the ones they replaced, whose listeners and tasks outlive every wait. Every
+--every rounds the RSS, the Python heap (tracemalloc), the live tasks and the
+listeners registered on the peer connections and channels are sampled, and
+the report gives their growth per 1000 rounds.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import time
+import tracemalloc
+
+from aiortc import RTCPeerConnection
+
+import common
+from supervisor import rss_mb
+
+
+# ----------------- The primitives common.py had before -----------------
+async def legacyWaitForEvent(user_function, timeout = 10):
+    event = asyncio.Event()
+    fulfilled_value = None
+
+    def fulfill(value):
+        nonlocal fulfilled_value
+        fulfilled_value = value
+        event.set()
+
+    async def waiter():
+        await event.wait()
+
+    asyncio.create_task(user_function(fulfill))
+    await asyncio.wait_for(waiter(), timeout=timeout)
+    return fulfilled_value
+
+
+def legacySetTimeout(func, delay):
+    async def inner():
+        await asyncio.sleep(delay)
+        func()
+    asyncio.create_task(inner())
+
+
+def legacyWaitForEmitterEvent(emitter, event, timeout = 10, predicate = None):
+    # the way main.py used legacyWaitForEvent: a listener registered, never removed
+    async def inner(fulfill):
+        def listener(*args):
+            if predicate is None or predicate(*args):
+                fulfill(args[0] if args else None)
+        emitter.add_listener(event, listener)
+
+    return legacyWaitForEvent(inner, timeout)
+
+
+PRIMITIVES = {
+    "scoped": (common.waitForEmitterEvent, common.setTimeout, common.clearTimeout),
+    "legacy": (legacyWaitForEmitterEvent, legacySetTimeout, lambda handle: None),
+}
+
+
+# ----------------- Rounds -----------------
+async def listening(coroutine):
+    # the wait registers its listener a few steps after it is started, before the event can happen
+    task = common.spawn(coroutine)
+    for _ in range(3):
+        await asyncio.sleep(0)
+    return task
+
+
+async def connect():
+    caller, callee = RTCPeerConnection(), RTCPeerConnection()
+    callerChannel = caller.createDataChannel(common.CHAT_CHANNEL, negotiated=True, id=0)
+    calleeChannel = callee.createDataChannel(common.CHAT_CHANNEL, negotiated=True, id=0)
+    calleeChannel.on('message', calleeChannel.send)  # echo
+    await renegotiate(caller, callee)
+    await common.waitForEmitterEvent(callerChannel, 'open')
+    return caller, callee, callerChannel, calleeChannel
+
+
+async def renegotiate(caller, callee):
+    await caller.setLocalDescription(await caller.createOffer())
+    await callee.setRemoteDescription(caller.localDescription)
+    await callee.setLocalDescription(await callee.createAnswer())
+    await caller.setRemoteDescription(callee.localDescription)
+
+
+async def renegotiationRound(number, caller, callee, channel, primitives):
+    waitFor, setTimeout, clearTimeout = primitives
+    watchdog = setTimeout(lambda: print("round %d stuck" % number), 60)
+
+    stable = await listening(waitFor(caller, 'signalingstatechange',
+                                     predicate=lambda: caller.signalingState == "stable"))
+    await renegotiate(caller, callee)
+    await stable
+
+    echo = await listening(waitFor(channel, 'message'))
+    channel.send("round %d" % number)
+    await echo
+    clearTimeout(watchdog)
+
+
+def listeners(*emitters):
+    return sum(len(emitter.listeners(event)) for emitter in emitters for event in emitter.event_names())
+
+
+def sample(number, started, emitters):
+    # what is still reachable, not what the cycle collector did not get to yet
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    return {
+        "round": number,
+        "elapsed_s": round(time.monotonic() - started, 1),
+        "rss_mb": round(rss_mb(), 1),
+        "heap_kb": round(current / 1024),
+        "tasks": len(asyncio.all_tasks()),
+        "listeners": listeners(*emitters),
+    }
+
+
+def growth(samples, key):
+    # per 1000 rounds, from the first sample after the warm-up to the last one
+    first, last = samples[1], samples[-1]
+    return round((last[key] - first[key]) * 1000 / (last["round"] - first["round"]), 2)
+
+
+async def main(rounds, every, primitives):
+    caller, callee, callerChannel, calleeChannel = await connect()
+    emitters = (caller, callee, callerChannel, calleeChannel)
+    tracemalloc.start()
+    started = time.monotonic()
+    samples = [sample(0, started, emitters)]
+    for number in range(1, rounds + 1):
+        await renegotiationRound(number, caller, callee, callerChannel, PRIMITIVES[primitives])
+        if number % every == 0:
+            samples.append(sample(number, started, emitters))
+            print(json.dumps(samples[-1]))
+    await caller.close()
+    await callee.close()
+
+    report = {"primitives": primitives, "rounds": rounds, "samples": samples}
+    if len(samples) > 2:
+        report["growth_per_1000_rounds"] = {key: growth(samples, key)
+                                            for key in ("rss_mb", "heap_kb", "tasks", "listeners")}
+    return report
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Memory of one peer over thousands of renegotiations")
+    ap.add_argument("--rounds", type=int, default=3000, help="Renegotiations to run (default: 3000)")
+    ap.add_argument("--every", type=int, default=250, help="Rounds between two samples (default: 250)")
+    ap.add_argument("--primitives", choices=sorted(PRIMITIVES), default="scoped",
+                    help="scoped: the waits and timers of common.py, legacy: the ones they replaced")
+    return ap.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(main(args.rounds, args.every, args.primitives))
+    print(json.dumps({k: v for k, v in report.items() if k != "samples"}, indent=2))
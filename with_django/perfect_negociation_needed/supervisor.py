@@ -0,0 +1,259 @@
+# supervisor.py
+"""
+Many file-signaling sessions served by one process, on one event loop.
+
+The supervisor is the responder of every session whose offer lands in the
+mailbox directory: start main_gpt2.py initiators with any --session name and
+the supervisor picks each <session>.offer.json up, answers it and runs the
+session (hello, ping -> pong, file chunks, bye) on the channels of
+main_gpt2.CHANNELS.
+
+A session is closed when the peer says bye, when its connection fails, or
+after --idle-timeout seconds without a message. Closing releases the peer
+connection right away; nothing waits on a fixed sleep.
+
+Every --status-every seconds a JSON line reports the process RSS and the
+state and counters of each session, also written to --status-file if given.
+"""
+import argparse
+import asyncio
+import json
+import resource
+import time
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+from aiortc import RTCSessionDescription
+
+import filewatch
+from filetransfer import FileReceiver
+from main_gpt2 import CONTROL_LABEL, gather_local_desc, make_pc, negotiated_channels, session_paths, write_json
+
+OFFER_SUFFIX = ".offer.json"
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # peak rather than current, but better than nothing outside of Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Session:
+    def __init__(self, name: str, run_id: Optional[str], stun_url: Optional[str], recv_dir: Path):
+        self.name = name
+        self.run_id = run_id
+        self.pc = make_pc(stun_url)
+        self.channels = negotiated_channels(self.pc)
+        self.control = self.channels[CONTROL_LABEL]
+        self.receiver = FileReceiver(recv_dir / name)
+        self.created = time.monotonic()
+        self.last_activity = self.created
+        self.state = "negotiating"
+        self.close_reason = None
+        self.messages_in = 0
+        self.messages_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def send(self, data) -> None:
+        if self.control.readyState == "open":
+            self.control.send(data)
+            self.messages_out += 1
+            self.bytes_out += len(data)
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        return {
+            "session": self.name,
+            "state": self.state,
+            "connection": self.pc.connectionState,
+            "age_s": round(now - self.created, 1),
+            "idle_s": round(now - self.last_activity, 1),
+            "messages_in": self.messages_in,
+            "messages_out": self.messages_out,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            # bytes queued on the channels, the part of the session memory that grows with a slow peer
+            "buffered": self.channels.bufferedAmount,
+        }
+
+
+class Supervisor:
+    def __init__(self, directory: Path = Path("."), stun_url: Optional[str] = None,
+                 idle_timeout: float = 30.0, max_sessions: int = 500,
+                 recv_dir: Path = Path("received"), owns: Optional[Callable[[str], bool]] = None):
+        self.directory = directory
+        self.stun_url = stun_url
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.recv_dir = recv_dir
+        # which sessions this supervisor answers, when several share the mailbox (see shard.py)
+        self.owns = owns or (lambda name: True)
+        self.sessions: Dict[str, Session] = {}
+        self.accepted = 0
+        self.closed = {}  # close reason -> count
+
+    # ----------------- Session lifecycle -----------------
+    async def accept(self, name: str, offer: dict) -> None:
+        if name in self.sessions:
+            # the initiator restarted, its old connection is gone
+            await self.close_session(name, "replaced")
+        session = Session(name, offer.get("run"), self.stun_url, self.recv_dir)
+        self.sessions[name] = session
+        self.accepted += 1
+        self.attach(session)
+
+        await session.pc.setRemoteDescription(RTCSessionDescription(**offer["sdp"]))
+        answer = await gather_local_desc(session.pc, "answer")
+        await write_json(self.directory / session_paths(name)["answer"].name,
+                         {"sdp": answer, "run": session.run_id})
+
+    def attach(self, session: Session) -> None:
+        @session.pc.on("connectionstatechange")
+        def _on_state():
+            if session.pc.connectionState == "failed":
+                asyncio.ensure_future(self.close_session(session.name, "failed", session))
+
+        @session.control.on("open")
+        def _on_open():
+            session.state = "open"
+            session.last_activity = time.monotonic()
+            session.send(json.dumps({"type": "hello", "role": "supervisor", "run": session.run_id}))
+
+        def _on_message(msg):
+            session.last_activity = time.monotonic()
+            session.messages_in += 1
+            session.bytes_in += len(msg)
+            if isinstance(msg, bytes):
+                try:
+                    session.receiver.write_chunk(msg)
+                except ValueError as e:
+                    print(f"[{session.name}] dropped chunk: {e}")
+                return
+            try:
+                obj = json.loads(msg)
+            except ValueError:
+                return
+            typ = obj.get("type")
+            if typ == "ping":
+                session.send(json.dumps({"type": "pong", "seq": obj.get("seq"), "t": obj.get("t")}))
+            elif typ == "file":
+                try:
+                    session.receiver.start(obj)
+                except ValueError as e:
+                    print(f"[{session.name}] transfer refused: {e}")
+            elif typ == "file-end":
+                try:
+                    session.receiver.finish(obj)
+                except (OSError, ValueError) as e:
+                    print(f"[{session.name}] transfer failed: {e}")
+            elif typ == "bye":
+                asyncio.ensure_future(self.close_session(session.name, "bye", session))
+
+        for channel in session.channels:
+            channel.on("message", _on_message)
+
+    async def close_session(self, name: str, reason: str, session: Optional[Session] = None) -> None:
+        current = self.sessions.get(name)
+        # a stale callback must not close the session that replaced its own
+        if current is None or (session is not None and current is not session):
+            return
+        del self.sessions[name]
+        current.state = "closed"
+        current.close_reason = reason
+        current.receiver.abort()
+        self.closed[reason] = self.closed.get(reason, 0) + 1
+        await current.pc.close()
+        print(f"[{name}] closed ({reason}) after {time.monotonic() - current.created:.1f}s")
+
+    # ----------------- Loops -----------------
+    async def accept_offers(self) -> None:
+        watcher = filewatch.get_watcher()
+        while True:
+            for path in self.directory.glob("*" + OFFER_SUFFIX):
+                name = path.name[:-len(OFFER_SUFFIX)]
+                if not self.owns(name):
+                    continue
+                if len(self.sessions) >= self.max_sessions and name not in self.sessions:
+                    continue  # left in the mailbox until a slot frees up
+                try:
+                    offer = json.loads(path.read_text())
+                    path.unlink()
+                except (OSError, ValueError):
+                    continue  # consumed by someone else, or not completely written yet
+                try:
+                    await self.accept(name, offer)
+                    print(f"[{name}] accepted ({len(self.sessions)} sessions)")
+                except Exception as e:
+                    print(f"[{name}] rejected: {e}")
+                    await self.close_session(name, "error")
+            await watcher.wait_for_change(self.directory, timeout=1.0)
+
+    async def reap_idle(self, period: float = 1.0) -> None:
+        while True:
+            await asyncio.sleep(period)
+            now = time.monotonic()
+            idle = [name for name, session in self.sessions.items()
+                    if now - session.last_activity > self.idle_timeout]
+            await asyncio.gather(*(self.close_session(name, "idle") for name in idle))
+
+    def stats(self) -> dict:
+        rss = rss_mb()
+        return {
+            "time": time.time(),
+            "rss_mb": round(rss, 1),
+            "active": len(self.sessions),
+            "accepted": self.accepted,
+            "closed": dict(self.closed),
+            "rss_kb_per_session": round(rss * 1024 / len(self.sessions)) if self.sessions else None,
+            "sessions": [session.snapshot() for session in self.sessions.values()],
+        }
+
+    async def report(self, every: float, status_file: Optional[Path]) -> None:
+        while True:
+            await asyncio.sleep(every)
+            stats = self.stats()
+            print(json.dumps({k: v for k, v in stats.items() if k != "sessions"}))
+            if status_file:
+                await write_json(status_file, stats)
+
+    async def serve(self, status_every: float = 5.0, status_file: Optional[Path] = None) -> None:
+        loops = [self.accept_offers(), self.reap_idle()]
+        if status_every:
+            loops.append(self.report(status_every, status_file))
+        try:
+            await asyncio.gather(*loops)
+        finally:
+            await asyncio.gather(*(self.close_session(name, "shutdown") for name in list(self.sessions)))
+
+
+# ----------------- CLI -----------------
+def parse_args():
+    ap = argparse.ArgumentParser(description="Answer and run many file-signaling sessions in one process")
+    ap.add_argument("--stun", default=None,
+                    help="Optional STUN URL, e.g. stun:stun.l.google.com:19302")
+    ap.add_argument("--idle-timeout", type=float, default=30.0,
+                    help="Close a session after this many seconds without a message (default: 30)")
+    ap.add_argument("--max-sessions", type=int, default=500,
+                    help="Offers beyond this many live sessions wait in the mailbox (default: 500)")
+    ap.add_argument("--recv-dir", type=Path, default=Path("received"),
+                    help="Received files go to <recv-dir>/<session>/ (default: ./received)")
+    ap.add_argument("--status-every", type=float, default=5.0,
+                    help="Seconds between status lines, 0 to disable (default: 5)")
+    ap.add_argument("--status-file", type=Path, default=None,
+                    help="Also write the full status, per-session counters included, to this JSON file")
+    return ap.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    supervisor = Supervisor(Path("."), args.stun, args.idle_timeout, args.max_sessions, args.recv_dir)
+    try:
+        asyncio.run(supervisor.serve(args.status_every, args.status_file))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,131 @@
+# synthetic.py
+"""
+Synthetic media tracks, for the media path on machines without a camera or
+a microphone.
+
+SyntheticVideoTrack generates yuv420p frames with NumPy at any resolution
+and frame rate: a gradient scrolling a little every frame, so that the
+encoder has real work, under a stamp of two rows of STAMP_BITS blocks. The
+first row is the frame index, the second the wall clock time the frame was
+generated at, in ms (modulo 2**32). Blocks are black or white and at least
+MIN_BLOCK pixels wide, they survive the video codec; read_stamp() reads them
+back from the decoded frame on the receiving side.
+
+SyntheticAudioTrack generates a sine tone. The audio codec does not keep
+sample values, its frames carry their index in pts only.
+"""
+import asyncio
+import fractions
+import math
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+from av import AudioFrame, VideoFrame
+
+VIDEO_CLOCK_RATE = 90000
+VIDEO_TIME_BASE = fractions.Fraction(1, VIDEO_CLOCK_RATE)
+STAMP_BITS = 32
+MIN_BLOCK = 8
+BIT_WEIGHTS = 1 << np.arange(STAMP_BITS - 1, -1, -1, dtype=np.uint64)
+
+
+def wall_ms() -> int:
+    return int(time.time() * 1000) & 0xFFFFFFFF
+
+
+class SyntheticVideoTrack(MediaStreamTrack):
+    kind = "video"
+
+    def __init__(self, width: int = 640, height: int = 480, fps: float = 30):
+        super().__init__()
+        self.block = width // STAMP_BITS
+        if self.block < MIN_BLOCK or height < 2 * self.block or width % 2 or height % 2:
+            raise ValueError(f"{width}x{height}: even sizes of at least {STAMP_BITS * MIN_BLOCK} pixels wide")
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.index = 0
+        self.start = None
+        self.gradient = (np.arange(width) * 256 // width).astype(np.uint8)
+        # the Y plane then the U and V planes below it, as VideoFrame.from_ndarray wants yuv420p
+        self.buffer = np.full((height * 3 // 2, width), 128, np.uint8)
+
+    async def recv(self) -> VideoFrame:
+        if self.readyState != "live":
+            raise MediaStreamError
+        if self.start is None:
+            self.start = time.monotonic()
+        else:
+            # paced on the start, a late frame does not delay the following ones
+            wait = self.start + self.index / self.fps - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+        luma = self.buffer[:self.height]
+        luma[:] = np.roll(self.gradient, self.index * 4)
+        self.stamp(luma, 0, self.index & 0xFFFFFFFF)
+        self.stamp(luma, 1, wall_ms())
+
+        frame = VideoFrame.from_ndarray(self.buffer, format="yuv420p")
+        frame.pts = int(self.index * VIDEO_CLOCK_RATE / self.fps)
+        frame.time_base = VIDEO_TIME_BASE
+        self.index += 1
+        return frame
+
+    def stamp(self, luma: np.ndarray, row: int, value: int) -> None:
+        bits = (np.uint64(value) // BIT_WEIGHTS) & np.uint64(1)
+        blocks = np.repeat(bits.astype(np.uint8) * 255, self.block)
+        luma[row * self.block:(row + 1) * self.block, :blocks.size] = blocks
+
+
+def read_stamp(array: np.ndarray) -> Tuple[int, int]:
+    """
+    (frame index, generation time in ms) of a decoded frame of a SyntheticVideoTrack,
+    given as a gray (height, width) or color (height, width, 3) array.
+    """
+    if array.ndim == 3:
+        array = array[:, :, 1]
+    block = array.shape[1] // STAMP_BITS
+    centers = array[block // 2::block, block // 2::block][:2, :STAMP_BITS]
+    bits = (centers > 128).astype(np.uint64)
+    index, sent_ms = (bits * BIT_WEIGHTS).sum(axis=1)
+    return int(index), int(sent_ms)
+
+
+def frame_age_ms(sent_ms: int, now_ms: Optional[int] = None) -> int:
+    # both peers read the same clock over loopback, across machines it has to be synchronized
+    return ((wall_ms() if now_ms is None else now_ms) - sent_ms) & 0xFFFFFFFF
+
+
+class SyntheticAudioTrack(MediaStreamTrack):
+    kind = "audio"
+
+    def __init__(self, sample_rate: int = 48000, ptime: float = 0.02, frequency: float = 440.0):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.samples = int(sample_rate * ptime)
+        self.step = 2 * math.pi * frequency / sample_rate
+        self.index = 0
+        self.start = None
+
+    async def recv(self) -> AudioFrame:
+        if self.readyState != "live":
+            raise MediaStreamError
+        if self.start is None:
+            self.start = time.monotonic()
+        else:
+            wait = self.start + self.index * self.samples / self.sample_rate - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+        first = self.index * self.samples
+        tone = np.sin(np.arange(first, first + self.samples) * self.step) * 0.3 * 32767
+        frame = AudioFrame.from_ndarray(tone.astype(np.int16).reshape(1, -1), format="s16", layout="mono")
+        frame.sample_rate = self.sample_rate
+        frame.pts = first
+        frame.time_base = fractions.Fraction(1, self.sample_rate)
+        self.index += 1
+        return frame
@@ -0,0 +1,125 @@
+"""
+Processing of the frames of a received media track, without ever falling behind it.
+
+A reader pulls the frames with track.recv() into a queue of `queueSize`
+frames. A worker takes them one at a time, converts each to a NumPy array
+(frame.to_ndarray, in a thread) and runs onFrame(array) in `executor`: a
+ThreadPoolExecutor, or a ProcessPoolExecutor for callbacks holding the GIL,
+onFrame and its result have to be picklable then. None runs it in the
+default executor of the loop.
+
+When onFrame is slower than the track, the queue fills up and the reader
+drops its oldest frame for the new one: the worker always gets one of the
+last `queueSize` frames, the latency stays bounded by the processing time
+of `queueSize` + 1 frames instead of growing with the backlog.
+
+stats() gives the frames received, processed and dropped, the received and
+processed fps over the last FPS_WINDOW seconds, and the latency from
+track.recv() returning a frame to onFrame being done with it.
+"""
+from collections import deque
+import asyncio
+import time
+
+from aiortc.mediastreams import MediaStreamError
+
+from common import spawn
+from latency import summarize
+
+FPS_WINDOW = 2.0        # seconds the fps are averaged over
+LATENCY_SAMPLES = 300   # latencies kept for the percentiles, the most recent ones
+
+
+class TrackConsumer:
+    def __init__(self, track, onFrame, executor=None, queueSize=2, videoFormat="bgr24"):
+        self.track = track
+        self.onFrame = onFrame
+        self.executor = executor
+        self.videoFormat = videoFormat
+        self.queue = asyncio.Queue(queueSize)
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.receivedAt = deque()
+        self.processedAt = deque()
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.tasks = []
+        self.ended = asyncio.Event()
+
+    def start(self):
+        self.tasks = [spawn(self.__read()), spawn(self.__work())]
+
+    def stop(self):
+        # also called by the reader once the track ended, which then just returns
+        current = asyncio.current_task()
+        for task in self.tasks:
+            if task is not current:
+                task.cancel()
+        self.tasks = []
+        self.ended.set()
+
+    async def __read(self):
+        try:
+            while True:
+                frame = await self.track.recv()
+                now = time.monotonic()
+                self.received += 1
+                self.__tick(self.receivedAt, now)
+                if self.queue.full():
+                    # the oldest frame is the least worth processing
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                self.queue.put_nowait((frame, now))
+        except MediaStreamError:
+            # the track ended: the remote stopped it or the connection closed
+            pass
+        finally:
+            self.stop()
+
+    async def __work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            frame, receivedAt = await self.queue.get()
+            try:
+                array = await asyncio.to_thread(self.__toArray, frame)
+                await loop.run_in_executor(self.executor, self.onFrame, array)
+            except Exception as e:
+                self.failed += 1
+                print("track %s: frame processing failed: %r" % (self.track.id, e))
+                continue
+            now = time.monotonic()
+            self.processed += 1
+            self.__tick(self.processedAt, now)
+            self.latencies.append((now - receivedAt) * 1000)
+
+    def __toArray(self, frame):
+        if self.track.kind == "video":
+            return frame.to_ndarray(format=self.videoFormat)
+        return frame.to_ndarray()
+
+    @staticmethod
+    def __tick(times, now):
+        times.append(now)
+        while now - times[0] > FPS_WINDOW:
+            times.popleft()
+
+    @staticmethod
+    def __fps(times):
+        now = time.monotonic()
+        recent = [t for t in times if now - t <= FPS_WINDOW]
+        return round(len(recent) / FPS_WINDOW, 1)
+
+    def stats(self):
+        return {
+            "track": self.track.id,
+            "kind": self.track.kind,
+            "ended": self.ended.is_set(),
+            "received": self.received,
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "fps_in": self.__fps(self.receivedAt),
+            "fps_out": self.__fps(self.processedAt),
+            "latency_ms": summarize(list(self.latencies)),
+        }
@@ -0,0 +1,165 @@
+"""
+Operational metrics of the signaling server, served by /metrics in the
+Prometheus text format.
+
+Cheap enough to leave on: a request or a published event costs a bisect and
+a few additions under a lock. The gauges (subscribers per channel, pending
+sessions) are not maintained on the hot path at all, they are read from the
+live structures when /metrics is scraped.
+
+The metrics live in the memory of the process, each worker process serves its own.
+"""
+import asyncio
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from django_eventstream.consumers import get_listener_manager
+
+from .sessionstore import get_session_store
+
+# seconds, from a fraction of a ms for a quiet server up to the seconds of a saturated one
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for value in values)
+    return '{%s}' % ','.join('%s="%s"' % (name, value) for name, value in zip(names, escaped))
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        yield '# HELP %s %s' % (self.name, self.help)
+        yield '# TYPE %s counter' % self.name
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            yield '%s%s %s' % (self.name, format_labels(self.labels, label_values), value)
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # label values -> [count per bucket, the last one for +Inf], sum, count
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render(self):
+        yield '# HELP %s %s' % (self.name, self.help)
+        yield '# TYPE %s histogram' % self.name
+        with self.lock:
+            values = [(label_values, list(counts), total, count)
+                      for label_values, (counts, total, count) in self.values.items()]
+        names = self.labels + ('le',)
+        for label_values, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                yield '%s_bucket%s %s' % (self.name, format_labels(names, label_values + (bound,)), cumulative)
+            yield '%s_sum%s %s' % (self.name, format_labels(self.labels, label_values), total)
+            yield '%s_count%s %s' % (self.name, format_labels(self.labels, label_values), count)
+
+
+def render_gauge(name, help, samples, labels=()):
+    yield '# HELP %s %s' % (name, help)
+    yield '# TYPE %s gauge' % name
+    for label_values, value in samples:
+        yield '%s%s %s' % (name, format_labels(labels, label_values), value)
+
+
+REQUEST_SECONDS = Histogram(
+    'signaling_request_duration_seconds', 'Time spent handling a signaling request.', ('view',))
+EVENTS_PUBLISHED = Counter(
+    'signaling_events_published_total', 'Events published to the room channels.')
+FANOUT_SECONDS = Histogram(
+    'signaling_fanout_duration_seconds', 'Time to hand a published event to every subscriber of its channel.')
+
+
+@contextmanager
+def fanout():
+    EVENTS_PUBLISHED.inc()
+    with FANOUT_SECONDS.time():
+        yield
+
+
+def metrics_middleware(get_response):
+    """Times the requests of every named view. The event streams have no name and are left out."""
+
+    def observe(request, start):
+        match = request.resolver_match
+        if match is not None and match.url_name:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, match.url_name)
+
+    if asyncio.iscoroutinefunction(get_response):
+        # stays async, a sync middleware would move every async view into the thread pool
+        async def middleware(request):
+            start = time.perf_counter()
+            response = await get_response(request)
+            observe(request, start)
+            return response
+    else:
+        def middleware(request):
+            start = time.perf_counter()
+            response = get_response(request)
+            observe(request, start)
+            return response
+    return middleware
+
+
+metrics_middleware.sync_capable = True
+metrics_middleware.async_capable = True
+
+
+def sse_subscribers():
+    manager = get_listener_manager()
+    with manager.lock:
+        return [((channel,), len(listeners)) for channel, listeners in manager.listeners_by_channel.items()]
+
+
+def render():
+    lines = []
+    lines.extend(REQUEST_SECONDS.render())
+    lines.extend(EVENTS_PUBLISHED.render())
+    lines.extend(FANOUT_SECONDS.render())
+    lines.extend(render_gauge(
+        'signaling_subscribers', 'Open event stream subscribers per channel.',
+        [((channel, 'sse'), count) for (channel,), count in sse_subscribers()], ('channel', 'transport')))
+    lines.extend(render_gauge(
+        'signaling_pending_sessions', 'Sessions with an offer waiting in the session store.',
+        [((), len(get_session_store()))]))
+    return '\n'.join(lines) + '\n'
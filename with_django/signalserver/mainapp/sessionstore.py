@@ -0,0 +1,241 @@
+"""
+Pending offers, one slot per (session, user), at most OFFERS_PER_SESSION users
+per session.
+
+A peer posts its offer to a session and gets back the offer of the other
+peer of that session (if any). The backend is picked with the
+SIGNAL_SESSION_STORE setting, in the same shape as Django's CACHES:
+
+SIGNAL_SESSION_STORE = {
+    'BACKEND': 'mainapp.sessionstore.MemorySessionStore',
+    'OPTIONS': {'max_sessions': 10000, 'ttl': 300},
+}
+
+Offers are stored as opaque JSON encoded bytes, the store never looks inside them.
+
+- MemorySessionStore: in the process, lost on restart
+- PersistentSessionStore: in the process, written behind to SQLite and loaded
+  back on start, so a restart does not make the peers negotiate again
+- SQLiteSessionStore: in SQLite only, shared by the worker processes of a host
+"""
+from collections import OrderedDict
+from functools import lru_cache
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .persist import DEFAULT_PURGE_INTERVAL, BatchWriter, connect
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_SESSIONS = 10000
+# a session is a pair, a third user posting to it drops the one that wrote least recently
+OFFERS_PER_SESSION = 2
+
+# the tables of PersistentSessionStore and SQLiteSessionStore are the same, they can share a database
+PENDING_OFFER_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS pending_offer ('
+    ' session TEXT NOT NULL,'
+    ' user TEXT NOT NULL,'
+    ' offer BLOB NOT NULL,'
+    ' updated REAL NOT NULL,'
+    ' PRIMARY KEY (session, user))',
+    'CREATE INDEX IF NOT EXISTS pending_offer_updated ON pending_offer (updated)',
+)
+UPSERT_OFFER = (
+    'INSERT INTO pending_offer (session, user, offer, updated) VALUES (?, ?, ?, ?)'
+    ' ON CONFLICT (session, user) DO UPDATE SET offer = excluded.offer, updated = excluded.updated')
+TRIM_OFFERS = (
+    'DELETE FROM pending_offer WHERE session = ? AND user NOT IN ('
+    ' SELECT user FROM pending_offer WHERE session = ? ORDER BY updated DESC LIMIT %d)' % OFFERS_PER_SESSION)
+
+
+def put_offer(offers, user, offer):
+    """Write the offer of `user` last in `offers`, keeping the OFFERS_PER_SESSION last written."""
+    offers.pop(user, None)
+    offers[user] = offer
+    while len(offers) > OFFERS_PER_SESSION:
+        del offers[next(iter(offers))]
+
+
+def default_path():
+    return settings.BASE_DIR / 'sessions.sqlite3'
+
+
+class BaseSessionStore:
+    # the methods wait for the disk or a lock of another process, the async views call them in a thread
+    blocking = False
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        # seconds a session lives after its last write
+        self.ttl = ttl
+
+    def exchange(self, session, user, offer):
+        """Store the offer of `user` and return the offer of the other peer of `session`, or None."""
+        raise NotImplementedError()
+
+    def clear(self, session):
+        raise NotImplementedError()
+
+    def __len__(self):
+        raise NotImplementedError()
+
+
+class MemorySessionStore(BaseSessionStore):
+    """
+    Process local store. Sessions are kept in LRU order, so both the TTL and
+    the max_sessions bound are enforced by popping from the cold end.
+    Only usable with a single worker process.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_sessions=DEFAULT_MAX_SESSIONS):
+        super().__init__(ttl)
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        # session -> (expires_at, {user: offer}), least recently written first
+        self.sessions = OrderedDict()
+
+    def exchange(self, session, user, offer):
+        now = time.monotonic()
+        with self.lock:
+            self._evict(now)
+            entry = self.sessions.pop(session, None)
+            offers = entry[1] if entry is not None else {}
+            offers.pop(user, None)
+            peer_offer = next(reversed(offers.values()), None)
+            put_offer(offers, user, offer)
+            self.sessions[session] = (now + self.ttl, offers)
+            if len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+            return peer_offer
+
+    def clear(self, session):
+        with self.lock:
+            self.sessions.pop(session, None)
+
+    def _evict(self, now):
+        while self.sessions:
+            expires_at, _ = next(iter(self.sessions.values()))
+            if expires_at > now:
+                break
+            self.sessions.popitem(last=False)
+
+    def __len__(self):
+        with self.lock:
+            self._evict(time.monotonic())
+            return len(self.sessions)
+
+
+class PersistentSessionStore(MemorySessionStore):
+    """
+    MemorySessionStore whose sessions survive a restart of the server. Every
+    write is also queued to a SQLite database, committed in batches by a
+    thread of its own (see persist.py), and the sessions still alive are
+    loaded back on start. An exchange never waits for the disk.
+    Still a single worker process, SQLiteSessionStore shares the sessions.
+    """
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL, max_sessions=DEFAULT_MAX_SESSIONS,
+                 purge_interval=DEFAULT_PURGE_INTERVAL):
+        super().__init__(ttl, max_sessions)
+        path = path or default_path()
+        self.writer = BatchWriter(path, PENDING_OFFER_SCHEMA, self.purge, purge_interval)
+        self._load(path)
+
+    def _load(self, path):
+        connection = connect(path)
+        try:
+            rows = connection.execute(
+                'SELECT session, user, offer, updated FROM pending_offer WHERE updated > ? ORDER BY updated',
+                (time.time() - self.ttl,)).fetchall()
+        finally:
+            connection.close()
+        # the database has wall clock times, the memory monotonic ones
+        offset = time.monotonic() - time.time()
+        with self.lock:
+            # oldest first, which leaves the sessions and their offers in the order they were written
+            for session, user, offer, updated in rows:
+                entry = self.sessions.pop(session, None)
+                offers = entry[1] if entry is not None else {}
+                put_offer(offers, user, offer)
+                self.sessions[session] = (updated + offset + self.ttl, offers)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def exchange(self, session, user, offer):
+        peer_offer = super().exchange(session, user, offer)
+        self.writer.execute(UPSERT_OFFER, (session, user, offer, time.time()))
+        self.writer.execute(TRIM_OFFERS, (session, session))
+        return peer_offer
+
+    def clear(self, session):
+        super().clear(session)
+        self.writer.execute('DELETE FROM pending_offer WHERE session = ?', (session,))
+
+    def purge(self, connection):
+        # the sessions evicted from the memory by max_sessions go once their ttl is over too
+        connection.execute('DELETE FROM pending_offer WHERE updated <= ?', (time.time() - self.ttl,))
+
+
+class SQLiteSessionStore(BaseSessionStore):
+    """
+    Store shared by every worker process on the host, in a SQLite database in
+    WAL mode so readers never wait for the writer. Expired rows are purged
+    every `purge_every` writes.
+    """
+
+    blocking = True
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL, purge_every=100):
+        super().__init__(ttl)
+        self.path = str(path or default_path())
+        self.purge_every = purge_every
+        self.writes = 0
+        self.local = threading.local()
+        with self._connection() as connection:
+            for statement in PENDING_OFFER_SCHEMA:
+                connection.execute(statement)
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = connect(self.path)
+        return connection
+
+    def exchange(self, session, user, offer):
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            connection.execute(UPSERT_OFFER, (session, user, offer, now))
+            connection.execute(TRIM_OFFERS, (session, session))
+            row = connection.execute(
+                'SELECT offer FROM pending_offer WHERE session = ? AND user != ? AND updated > ?'
+                ' ORDER BY updated DESC LIMIT 1',
+                (session, user, now - self.ttl)).fetchone()
+        self.writes += 1
+        if self.writes % self.purge_every == 0:
+            self.purge(now)
+        return row[0] if row else None
+
+    def clear(self, session):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM pending_offer WHERE session = ?', (session,))
+
+    def purge(self, now=None):
+        now = time.time() if now is None else now
+        with self._connection() as connection:
+            connection.execute('DELETE FROM pending_offer WHERE updated <= ?', (now - self.ttl,))
+
+    def __len__(self):
+        row = self._connection().execute(
+            'SELECT COUNT(DISTINCT session) FROM pending_offer WHERE updated > ?',
+            (time.time() - self.ttl,)).fetchone()
+        return row[0]
+
+
+@lru_cache(maxsize=None)
+def get_session_store():
+    config = getattr(settings, 'SIGNAL_SESSION_STORE', {})
+    backend = import_string(config.get('BACKEND', 'mainapp.sessionstore.MemorySessionStore'))
+    return backend(**config.get('OPTIONS', {}))
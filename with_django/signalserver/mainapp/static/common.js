@@ -16,25 +16,25 @@ export function waitForEvent(user_function) {
     })
 }
 
-export function addConnectionStateHandler(peerConnection, username) {
+export function addConnectionStateHandler(peerConnection, username, room) {
     window.onbeforeunload = function() {
-        retrieveOffer(username) 
+        retrieveOffer(username, room)
     }
     peerConnection.onconnectionstatechange = function () {
         var state = peerConnection.connectionState;
         console.log(state)
         if (state === "disconnected" || state === "failed") {
-            retrieveOffer(username)
+            retrieveOffer(username, room)
         } else if (state === "connected") {
-            clearBothOffers()
+            clearBothOffers(room)
         }
     };
 }
 
-function clearBothOffers() {
-    fetch('http://127.0.0.1:10000/clear', { method: 'POST'})
+function clearBothOffers(room) {
+    fetch('http://127.0.0.1:10000/clear', { method: 'POST', body: JSON.stringify({"room": room})})
 }
 
-function retrieveOffer(username) {
-    fetch('http://127.0.0.1:10000/offer', { method: 'POST', body: JSON.stringify({"user": username, "offer": ''})})
+function retrieveOffer(username, room) {
+    fetch('http://127.0.0.1:10000/offer', { method: 'POST', body: JSON.stringify({"room": room, "user": username, "offer": ''})})
 }
\ No newline at end of file
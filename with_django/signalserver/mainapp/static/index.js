@@ -1,7 +1,11 @@
 import * as common from './common.js';
 console.log("\n".repeat(10))
 
-export async function start(username) {
+// signaling room, every message is posted to and received from this room only
+let room = "default"
+
+export async function start(username, roomName) {
+    room = roomName || room
     const [peerConnection, dataChannel] = initializeBeforeCreatingOffer(username)
     const localOffer = await prepareOfferSDP(peerConnection)
 
@@ -15,7 +19,7 @@ export async function start(username) {
 
 function initializeBeforeCreatingOffer(username) {
     const peerConnection = new RTCPeerConnection()
-    common.addConnectionStateHandler(peerConnection, username)
+    common.addConnectionStateHandler(peerConnection, username, room)
     const dataChannel = peerConnection.createDataChannel(common.CHAT_CHANNEL)
     dataChannel.onmessage = function (e) {
         console.log("Received message: ", e.data)
@@ -33,7 +37,7 @@ async function prepareOfferSDP(peerConnection) {
 
 async function sendLocalOfferAndQueryRemoteOffer(localOffer, username) {
     const response = await fetch('http://127.0.0.1:10000/offer', { method: 'POST',
-        body: JSON.stringify({ "user": username, "offer": localOffer})
+        body: JSON.stringify({ "room": room, "user": username, "offer": localOffer })
     })
     const remoteOffer = (await response.json()).offer
     return remoteOffer
@@ -58,7 +62,7 @@ async function sendAnswerSDP(peerConnection) {
     await common.waitForAllICE(peerConnection)
     const localAnswerWithICECandidates = peerConnection.localDescription
     await fetch('http://127.0.0.1:10000/answer', { method: 'POST',
-        body: JSON.stringify({"answer": localAnswerWithICECandidates})
+        body: JSON.stringify({ "room": room, "answer": localAnswerWithICECandidates })
     })
 }
 
@@ -87,7 +91,7 @@ async function receiveAnswerSDP(peerConnection) {
 
 function waitForAnswer() {
     return common.waitForEvent((fullfill) => {
-        var es = new ReconnectingEventSource('/events?channel=testchannel');
+        var es = new ReconnectingEventSource('/events/' + room + '/');
         es.addEventListener('message', function (e) {
             const remoteAnswer = JSON.parse(e.data)
             fullfill(remoteAnswer)
@@ -8,8 +8,10 @@ urlpatterns = [
     path('offer', views.offer, name='offer'),
     path('answer', views.answer, name='answer'),
     path('clear', views.clear, name='clear'),
-    path('events/', include(django_eventstream.urls), {
-        'channels': ['testchannel']
+    path('metrics', views.metrics_view, name='metrics'),
+    path('events/<slug:room>/', include(django_eventstream.urls), {
+        'format-channels': ['room-{room}']
     }),
     path('home/<user>', views.home, name='home'),
+    path('home/<slug:room>/<user>', views.home, name='home_room'),
 ]
\ No newline at end of file
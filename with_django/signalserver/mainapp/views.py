@@ -1,43 +1,91 @@
-from django.http import JsonResponse
+from asgiref.sync import sync_to_async
 from django.shortcuts import render
-from django.views.decorators.csrf import csrf_exempt
 from django_eventstream import send_event
-from django.http.response import HttpResponse
+from django.http.response import HttpResponse, HttpResponseBadRequest
 import json
+import re
 
-storage = {
-    "user1_chat_offer": '""',
-    "user2_chat_offer": '""'
-}
+from . import metrics
+from .sessionstore import get_session_store
 
-@csrf_exempt
-def offer(request):
+try:
+    from orjson import loads as json_loads, dumps as json_dumps
+except ImportError:
+    # orjson is optional, the stdlib codec gives the same result, only slower
+    from json import loads as json_loads
+
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+DEFAULT_ROOM = "default"
+ROOM_PATTERN = re.compile(r'^[-a-zA-Z0-9_]{1,64}$')
+
+
+def room_channel(room):
+    # must match the 'format-channels' of the events/<room>/ routes in urls.py and asgi.py
+    return 'room-%s' % room
+
+
+def get_room(request_body):
+    room = request_body.get('room', DEFAULT_ROOM)
+    if not isinstance(room, str) or not ROOM_PATTERN.match(room):
+        return None
+    return room
+
+
+async def call_store(method, *args):
+    # SQLiteSessionStore does disk I/O and can wait seconds for the write lock,
+    # which must not stall the other connections of the event loop
+    if get_session_store().blocking:
+        return await sync_to_async(method, thread_sensitive=False)(*args)
+    return method(*args)
+
+
+def async_csrf_exempt(view):
+    # django 3.2's csrf_exempt wraps the view in a sync function, which would
+    # hide the coroutine from the handler and push the view into the thread pool
+    view.csrf_exempt = True
+    return view
+
+
+@async_csrf_exempt
+async def offer(request):
     if request.method == "POST":
-        request_body = json.loads(request.body)
-        received_offer = json.dumps(request_body['offer'])
+        request_body = json_loads(request.body)
+        room = get_room(request_body)
+        if room is None:
+            return HttpResponseBadRequest("invalid room")
+        received_offer = json_dumps(request_body['offer'])
         user = request_body['user']
-        if "user1" == user:
-            storage["user1_chat_offer"] = received_offer
-            returned_offer = storage["user2_chat_offer"]
-        else:
-            storage["user2_chat_offer"] = received_offer
-            returned_offer = storage["user1_chat_offer"]
-        peer_offer_sdp = json.loads(returned_offer)
-        return JsonResponse({'offer': peer_offer_sdp})
-
-@csrf_exempt
-def answer(request):
+        returned_offer = await call_store(get_session_store().exchange, room, user, received_offer)
+        # the stored offer is already encoded, relay it without parsing it again
+        return HttpResponse(b'{"offer":' + (returned_offer or b'""') + b'}',
+                            content_type='application/json')
+
+@async_csrf_exempt
+async def answer(request):
     if request.method == "POST":
-        request_body = json.loads(request.body)
-        send_event('testchannel', 'message', request_body['answer'])
+        request_body = json_loads(request.body)
+        room = get_room(request_body)
+        if room is None:
+            return HttpResponseBadRequest("invalid room")
+        with metrics.fanout():
+            send_event(room_channel(room), 'message', request_body['answer'])
         return HttpResponse("ok")
 
-@csrf_exempt
-def clear(request):
+@async_csrf_exempt
+async def clear(request):
     if request.method == "POST":
-        storage["user1_chat_offer"] = '""'
-        storage["user2_chat_offer"] = '""'
+        request_body = json_loads(request.body or b'{}')
+        room = get_room(request_body)
+        if room is None:
+            return HttpResponseBadRequest("invalid room")
+        await call_store(get_session_store().clear, room)
         return HttpResponse("ok")
 
-def home(request, user):
-    return render(request, 'mainapp/index.html', {"user": user})
+async def metrics_view(request):
+    # counts the pending sessions, a query with SQLiteSessionStore
+    return HttpResponse(await call_store(metrics.render), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def home(request, user, room=DEFAULT_ROOM):
+    return render(request, 'mainapp/index.html', {"user": user, "room": room})
@@ -44,6 +44,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so that the request latency covers the other middlewares too
+    'mainapp.metrics.metrics_middleware',
     'django_grip.GripMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -81,6 +83,18 @@ TEMPLATES = [
 WSGI_APPLICATION = 'signalserver.wsgi.application'
 ASGI_APPLICATION = 'signalserver.asgi.application'
 
+# Pending offers. Use 'mainapp.sessionstore.SQLiteSessionStore' when running
+# more than one worker process, so that every worker sees the same sessions,
+# and 'mainapp.sessionstore.PersistentSessionStore' (options 'path' and
+# 'purge_interval' too) for a single worker keeping its sessions over restarts.
+SIGNAL_SESSION_STORE = {
+    'BACKEND': 'mainapp.sessionstore.MemorySessionStore',
+    'OPTIONS': {
+        'ttl': 300,
+        'max_sessions': 10000,
+    },
+}
+
 
 
 # Database